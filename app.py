@@ -8,7 +8,7 @@ import requests
 from flask import Flask, render_template, request, jsonify, session
 from scrap_module import Scraping_Job
 from scrap_pubmed import Pubmed_Job
-from clinical import get_numbers
+from clinical import iter_numbers
 from datetime import datetime
 from pdf_downloader.downloader import Downloader
 from text_extract import text_extract
@@ -52,12 +52,12 @@ def clinical_scrap():
         'conditions_disease': conditions_disease,
         'other_terms': other_terms
     }
-    nct_numbers = get_numbers(keyword=keyword)
-    if nct_numbers is None:
-        return jsonify({'results': [], 'excel_file': ''})
-
+    # the PubMed stage starts on the first NCT batches while the clinical stage is still streaming
     print('Pumbed Scraping with NCT Numbers stated.')
-    results, excel_file, file_name = Pubmed_Job(keyword=keyword, numbers=nct_numbers, result_folder="static/downloads")
+    results, excel_file, file_name = Pubmed_Job(keyword=keyword, numbers=iter_numbers(keyword=keyword),
+                                                result_folder="static/downloads")
+    if not excel_file:
+        return jsonify({'results': [], 'excel_file': ''})
     session['csv_name'] = file_name
     print(datetime.now())
     print('Clinical Scraping END.')
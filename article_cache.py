@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""
+    Persistent per-PMID article store
+
+    Parsed article records are kept in a local SQLite database shared by all scraping jobs and gunicorn workers.
+    Jobs resolve the PMID set of a query first and only fetch the articles missing from the store.
+"""
+import os
+import json
+import time
+import threading
+from dotenv import load_dotenv
+from sqlite_db import SQLiteDatabase, chunks
+
+load_dotenv()
+
+ARTICLE_CACHE = os.environ.get('ARTICLE_CACHE', 'on') == 'on'
+ARTICLE_CACHE_PATH = os.environ.get('ARTICLE_CACHE_PATH',
+                                    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'articles.db'))
+# seconds before a record is fetched again
+ARTICLE_CACHE_TTL = int(os.environ.get('ARTICLE_CACHE_TTL', 7 * 24 * 3600))
+# live data size above which the oldest records are evicted
+ARTICLE_CACHE_MAX_MB = int(os.environ.get('ARTICLE_CACHE_MAX_MB', 512))
+# records removed per eviction round
+EVICTION_BATCH = 1000
+
+
+class ArticleStore(SQLiteDatabase):
+    """
+    SQLite store of parsed article records keyed by (namespace, PMID).
+    The namespace separates record formats, e.g. scrap_module rows from scrap_pubmed rows.
+    """
+
+    def __init__(self, namespace, path=ARTICLE_CACHE_PATH, ttl=ARTICLE_CACHE_TTL, max_mb=ARTICLE_CACHE_MAX_MB):
+        super(ArticleStore, self).__init__(path)
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_bytes = max_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        connection = self.connection()
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS articles (
+                    namespace TEXT NOT NULL,
+                    pmid TEXT NOT NULL,
+                    record TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    ttl REAL NOT NULL,
+                    PRIMARY KEY (namespace, pmid)
+                )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS articles_fetched_at ON articles (fetched_at)")
+
+    def get_many(self, pmids):
+        """
+        Return the fresh records of the given PMIDs
+        :param pmids: list of PMIDs
+        :return: dict of pmid -> record
+        """
+        pmids = list(pmids)
+        now = time.time()
+        found = {}
+        connection = self.connection()
+        for chunk in chunks(pmids):
+            rows = connection.execute(
+                "SELECT pmid, record FROM articles WHERE namespace = ? AND fetched_at + ttl > ? AND pmid IN (%s)"
+                % ",".join("?" * len(chunk)), [self.namespace, now] + chunk)
+            for pmid, record in rows:
+                found[pmid] = json.loads(record)
+
+        with self.lock:
+            self.hits += len(found)
+            self.misses += len(pmids) - len(found)
+        return found
+
+    def put_many(self, records):
+        """
+        Store freshly fetched records and evict the oldest ones when the store is too big
+        :param records: dict of pmid -> record
+        :return: None
+        """
+        if not records:
+            return
+        now = time.time()
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "INSERT OR REPLACE INTO articles (namespace, pmid, record, fetched_at, ttl) VALUES (?, ?, ?, ?, ?)",
+                [(self.namespace, pmid, json.dumps(record), now, self.ttl) for pmid, record in records.items()])
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        self.evict()
+
+    def size(self):
+        """
+        Return the bytes used by live pages of the database
+        :return: int
+        """
+        connection = self.connection()
+        page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+        page_count = connection.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = connection.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def evict(self):
+        """
+        Drop expired records, then the oldest ones until the store fits in max_bytes
+        :return: None
+        """
+        connection = self.connection()
+        if self.size() <= self.max_bytes:
+            return
+        connection.execute("DELETE FROM articles WHERE fetched_at + ttl <= ?", (time.time(),))
+        while self.size() > self.max_bytes:
+            deleted = connection.execute(
+                "DELETE FROM articles WHERE rowid IN (SELECT rowid FROM articles ORDER BY fetched_at LIMIT ?)",
+                (EVICTION_BATCH,)).rowcount
+            if deleted == 0:
+                break
+
+    def stats(self):
+        """
+        Return hit/miss counters of this store
+        :return: dict
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+def pmid_from_link(link):
+    """
+    Return the PMID of a "Pubmed link" column value
+    :param link: e.g. https://pubmed.ncbi.nlm.nih.gov/32512345
+    :return: string, empty when the link has no PMID
+    """
+    pmid = link.rstrip('/').rsplit('/', 1)[-1]
+    return pmid if pmid.isdigit() else ""
+
+
+def pmid_key(values):
+    """
+    Dedupe key of a result row whose first unique field is the "Pubmed link": the PMID replaces the link
+    :param values: tuple of the unique fields of a row
+    :return: tuple, None for a row without PMID, which is never deduped
+    """
+    pmid = pmid_from_link(values[0])
+    if not pmid:
+        return None
+    return (pmid,) + tuple(values[1:])
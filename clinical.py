@@ -1,20 +1,28 @@
-import requests
 import re
 import os
+import math
 from dotenv import load_dotenv
-from time import sleep
-from bs4 import BeautifulSoup
-from multiprocessing import Process, Manager
+from parsers import make_soup
+from nct_record import NCTRecord
+from ctgov_api import ClinicalTrialsClient
+from http_cache import new_session
+from rate_limiter import share
+from multiprocessing import Process, Manager, JoinableQueue
+from scheduler import WorkQueue, WorkersStopped
 BASE_URL = "https://www.clinicaltrials.gov/ct2/results"
 load_dotenv()
 
 API_KEY = os.environ.get('API_KEY')
 PREMIUM_PROXY = os.environ.get('PREMIUM_PROXY')
 CREDENTIAL = os.environ.get('CREDENTIAL')
+# processes of a job, the host rate limits are split between them
+PROCESS_COUNT = int(os.environ.get('CLINICAL_PROCESSES', 20))
+# "api" streams ClinicalTrials.gov API v2, "legacy" scrapes the ct2/results rpc
+CLINICAL_BACKEND = os.environ.get('CLINICAL_BACKEND', 'api')
 
 
 def parse_soup(content):
-    return BeautifulSoup(content, 'html.parser')
+    return make_soup(content)
 
 
 def get_query_id(content):
@@ -42,17 +50,29 @@ def get_query_id(content):
 class MultiThread(Process):
     """
         Threading module
+        Pulls rpc pages from the shared work queue, failed pages are retried with backoff
         """
-    def __init__(self, _range, query_id, results):
+    def __init__(self, work_queue, query_id, results, processes=1):
         super(MultiThread, self).__init__()
-        self._range = _range
+        self.work_queue = work_queue
         self.query_id = query_id
         self.results = results
+        self.processes = processes
 
     def run(self):
-        clinical = Clinical(query_id=self.query_id, page_range=self._range)
-        records = clinical.run()
-        self.results.extend(records)
+        share(self.processes)
+        clinical = Clinical(query_id=self.query_id)
+        worker = self.work_queue.worker()
+        for task in iter(worker.get, None):
+            # a task is always finished, else close() waits for it forever
+            try:
+                records = clinical.fetch_page(task.payload)
+                if records is not None:
+                    self.results.extend(records)
+            except Exception as e:
+                print("Page %s failed" % task.payload, e)
+                records = None
+            worker.finish(task, ok=records is not None)
 
 
 class Clinical:
@@ -60,10 +80,9 @@ class Clinical:
     Extract data from clilical using requests module
     """
 
-    def __init__(self, query_id=None, page_range=None):
+    def __init__(self, query_id=None):
         self.post_url = ''
         self.query_id = query_id
-        self.page_range = page_range
         self.header = {
             "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36"
         }
@@ -71,6 +90,7 @@ class Clinical:
             'http': 'http://{}@{}'.format(CREDENTIAL, PREMIUM_PROXY),
             'https': 'https://{}@{}'.format(CREDENTIAL, PREMIUM_PROXY)
         }
+        self.session = new_session()
 
     def get_thread_count(self, keyword):
         params = {
@@ -83,15 +103,17 @@ class Clinical:
 
         return None, 0
 
-    def run(self):
-        records = []
-        for page in range(self.page_range[0], self.page_range[1]):
-            response = self.post_request(page*100)
-            if response is None or len(response['data']) == 0:
-                break
-            # total = response['recordsFiltered']
-            records += response['data']
-        return records
+    def fetch_page(self, page):
+        """
+        Return the NCT records of one rpc page of 100 rows
+        :param page:
+        :return: list of NCTRecord, None when the request failed
+        """
+        response = self.post_request(page*100)
+        if response is None:
+            return None
+        # total = response['recordsFiltered']
+        return [NCTRecord.from_row(row) for row in response['data']]
 
     def post_request(self, start):
         payload = {
@@ -99,49 +121,55 @@ class Clinical:
             'length': 100
         }
         self.post_url = BASE_URL + '/rpc/' + self.query_id
+        # pacing and retries are done by the session
         try:
-            response = requests.post(url=self.post_url, headers=self.header, data=payload)
+            response = self.session.post(url=self.post_url, headers=self.header, data=payload, timeout=60)
             return response.json()
-        except ConnectionError:
-            print('Connection Error')
-            sleep(1)
-            return self.post_request(start)
         except Exception as e:
             print(e)
             return None
 
     def do_request(self, url, params):
         try:
-            response = requests.request('GET', url=url, headers=self.header, params=params)
+            response = self.session.request('GET', url=url, headers=self.header, params=params, timeout=60)
             return response
-        except ConnectionError:
-            print('Connection Error')
-            sleep(1)
-            return self.do_request(url, params)
         except Exception as e:
             print(e)
             return None
 
 
-def get_thread_range(thread_count, total_count):
-    _range = []
-    end_number = total_count//100
-    if total_count % 100 != 0:
-        end_number += 1
-    interval = end_number // thread_count + 1
-    for i in range(thread_count):
-        if (i+1)*interval > end_number:
-            if end_number > i*interval:
-                _range.append([i*interval, end_number+1])
-            break
-        thread_range = [i*interval, (i+1)*interval]
-        _range.append(thread_range)
-    return _range
+def get_numbers(keyword, backend=CLINICAL_BACKEND):
+    """
+    Retrieving total NCT numbers by using clinical module
+    :param keyword: dict with conditions_disease and other_terms
+    :param backend: "api" or "legacy"
+    :return: list of NCTRecord, None when the query has no study
+    """
+    if backend == 'legacy':
+        return get_legacy_numbers(keyword)
 
+    records = ClinicalTrialsClient(keyword).records()
+    print(f'Clinical Total Count: {len(records)}')
+    return records or None
 
-def get_numbers(keyword):
+
+def iter_numbers(keyword, backend=CLINICAL_BACKEND):
     """
-    Retrieving total NCT numbers by using clinical module
+    Yield the NCT records as the clinical stage produces them
+    :param keyword: dict with conditions_disease and other_terms
+    :param backend: "api" streams page by page, "legacy" yields once every rpc process is done
+    :return: generator of NCTRecord
+    """
+    if backend == 'legacy':
+        yield from get_legacy_numbers(keyword) or []
+        return
+
+    yield from ClinicalTrialsClient(keyword).iter_records()
+
+
+def get_legacy_numbers(keyword):
+    """
+    Retrieving NCT numbers from the ct2/results rpc, capped at 20,000 studies
     """
     clinical = Clinical()
 
@@ -154,20 +182,31 @@ def get_numbers(keyword):
         total_count = 20000
 
     if total_count > 0:
+        pages = math.ceil(total_count / 100)
+        thread_count = min(PROCESS_COUNT, pages)
+        work_queue = WorkQueue(JoinableQueue(), workers=thread_count)
+        for page in range(pages):
+            work_queue.put(page)
+
         threads = []
-        thread_count = 20
-        ranges = get_thread_range(thread_count=thread_count, total_count=total_count)
-        for _range in ranges:
+        for _ in range(thread_count):
             thread = MultiThread(
+                work_queue=work_queue,
                 query_id=query_id,
-                _range=_range,
                 results=results,
+                processes=thread_count,
             )
             thread.start()
             threads.append(thread)
 
+        try:
+            work_queue.close(alive=lambda: all(thread.is_alive() for thread in threads))
+        except WorkersStopped as e:
+            # the workers left finish the queued pages, the pages of the dead one are lost
+            print(e)
+            work_queue.stop(alive=lambda: any(thread.is_alive() for thread in threads))
         for thread in threads:
             thread.join()
-        print("Total Count: ", len(results), ranges)
-        return results
+        print("Total Count: ", len(results), pages)
+        return list(results)
     return None
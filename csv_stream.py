@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+    Streaming CSV writer
+
+    Appends the rows of a job to "<file>.part" as the batches arrive and renames it to the final name
+    once the job is done. The part file is flushed every FLUSH_ROWS rows or FLUSH_INTERVAL seconds,
+    so it can be read while the job runs.
+"""
+import os
+import csv
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+FLUSH_ROWS = int(os.environ.get('CSV_FLUSH_ROWS', 500))
+# seconds, a slow job still shows its progress in the part file
+FLUSH_INTERVAL = float(os.environ.get('CSV_FLUSH_INTERVAL', 5))
+PART_SUFFIX = '.part'
+
+
+class CSVStream:
+    """
+    CSV file written row batch by row batch
+    """
+
+    def __init__(self, path, header, flush_rows=FLUSH_ROWS, flush_interval=FLUSH_INTERVAL):
+        """
+        :param path: final path of the CSV file
+        :param header: header line, written right away
+        :param flush_rows: rows written between two flushes
+        :param flush_interval: seconds between two flushes
+        """
+        self.path = path
+        self.part_path = path + PART_SUFFIX
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.count = 0
+        self.pending = 0
+        self.file = open(self.part_path, 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file, delimiter=',')
+        self.writer.writerow(header)
+        self.flush()
+
+    def flush(self):
+        """
+        Push the written rows to the part file
+        :return: None
+        """
+        self.file.flush()
+        self.pending = 0
+        self.flushed_at = time.monotonic()
+
+    def write_rows(self, rows):
+        """
+        Append a batch of rows, flushing when the policy says so
+        :param rows: list of tuples in header order
+        :return: None
+        """
+        self.writer.writerows(rows)
+        self.count += len(rows)
+        self.pending += len(rows)
+        if self.pending >= self.flush_rows or time.monotonic() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def close(self):
+        """
+        Finish the file and move it to its final name, replacing an older result
+        :return: path of the CSV file
+        """
+        self.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.part_path, self.path)
+        return self.path
+
+    def discard(self):
+        """
+        Drop the part file, for a job that ends without result
+        :return: None
+        """
+        self.file.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+    def iter_rows(self):
+        """
+        Yield the data rows of the closed file
+        :return: generator of lists
+        """
+        with open(self.path, encoding='utf-8', newline='') as readFile:
+            reader = csv.reader(readFile, delimiter=',')
+            next(reader, None)
+            for row in reader:
+                yield row
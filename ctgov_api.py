@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+    ClinicalTrials.gov API v2 client
+
+    Streams the studies of a query page by page with pageToken, asking only for the fields of the PubMed join.
+    The next pages are fetched in the background while the current one is converted, up to PREFETCH pages ahead.
+"""
+import os
+import queue
+import threading
+from dotenv import load_dotenv
+from http_cache import new_session
+from nct_record import NCTRecord
+
+load_dotenv()
+
+CTGOV_API_URL = os.environ.get('CTGOV_API_URL', 'https://clinicaltrials.gov/api/v2/')
+# studies per page, the API allows up to 1000
+PAGE_SIZE = 1000
+PREFETCH = int(os.environ.get('CTGOV_PREFETCH', 4))
+# seconds between two checks of the stop event while the page queue is full
+STOP_POLL_INTERVAL = 0.5
+STUDY_FIELDS = [
+    'NCTId', 'Condition', 'InterventionType', 'InterventionName', 'PrimaryOutcomeMeasure', 'SecondaryOutcomeMeasure'
+]
+
+
+def intervention_label(intervention):
+    """
+    Return an intervention the way the legacy results table shows it, e.g. "Dietary Supplement: Vitamin D"
+    :param intervention: dict of the armsInterventionsModule
+    :return: string
+    """
+    name = intervention.get('name', '')
+    kind = intervention.get('type')
+    if kind is None:
+        return name
+    return "%s: %s" % (kind.replace('_', ' ').title(), name)
+
+
+def study_record(study):
+    """
+    Build the NCT record of an API study
+    :param study: dict
+    :return: NCTRecord
+    """
+    protocol = study.get('protocolSection', {})
+    conditions = protocol.get('conditionsModule', {}).get('conditions', [])
+    interventions = protocol.get('armsInterventionsModule', {}).get('interventions', [])
+    outcomes = protocol.get('outcomesModule', {})
+    measures = [outcome.get('measure', '').strip() for outcome in
+                outcomes.get('primaryOutcomes', []) + outcomes.get('secondaryOutcomes', [])]
+    return NCTRecord(
+        protocol.get('identificationModule', {}).get('nctId', ''),
+        ' | '.join(condition.strip() for condition in conditions),
+        ' | '.join(intervention_label(intervention) for intervention in interventions),
+        ' | '.join(measures),
+    )
+
+
+class ClinicalTrialsClient:
+    """
+    Streaming client of the /studies endpoint
+    """
+
+    def __init__(self, keyword, page_size=PAGE_SIZE, prefetch=PREFETCH, session=None):
+        self.keyword = keyword
+        self.base_url = CTGOV_API_URL
+        self.page_size = page_size
+        self.prefetch = max(1, prefetch)
+        self.total_count = 0
+        self.session = session if session is not None else new_session()
+
+    def get_params(self, page_token=None):
+        """
+        Return the query parameters of one page
+        :param page_token: nextPageToken of the previous page
+        :return: dict
+        """
+        params = {
+            'format': 'json',
+            'fields': ','.join(STUDY_FIELDS),
+            'pageSize': self.page_size,
+        }
+        if self.keyword.get('conditions_disease'):
+            params['query.cond'] = self.keyword['conditions_disease']
+        if self.keyword.get('other_terms'):
+            params['query.term'] = self.keyword['other_terms']
+        if page_token is None:
+            params['countTotal'] = 'true'
+        else:
+            params['pageToken'] = page_token
+        return params
+
+    def fetch_page(self, page_token=None):
+        """
+        Fetch one page of studies
+        :param page_token:
+        :return: dict
+        """
+        res = self.session.get("%sstudies" % self.base_url, params=self.get_params(page_token), timeout=120)
+        res.raise_for_status()
+        return res.json()
+
+    @staticmethod
+    def put_page(pages, item, stop):
+        """
+        Put an item on the bounded page queue, giving up once the consumer stopped
+        :param pages: queue.Queue
+        :param item: page, exception or None
+        :param stop: threading.Event set when the records are no longer read
+        :return: False when the consumer stopped
+        """
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=STOP_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch_pages(self, pages, stop):
+        """
+        Follow the page tokens and put every page on the bounded queue, None marks the end
+        :param pages: queue.Queue
+        :param stop: threading.Event set when the records are no longer read
+        :return: None
+        """
+        page_token = None
+        try:
+            while not stop.is_set():
+                page = self.fetch_page(page_token)
+                if page_token is None:
+                    self.total_count = page.get('totalCount', 0)
+                    print("ClinicalTrials.gov total count %s" % self.total_count)
+                if not self.put_page(pages, page, stop):
+                    return
+                page_token = page.get('nextPageToken')
+                if not page_token:
+                    break
+        except Exception as e:
+            self.put_page(pages, e, stop)
+        finally:
+            self.put_page(pages, None, stop)
+
+    def iter_records(self):
+        """
+        Yield the NCT record of every study of the query
+        :return: generator
+        """
+        pages = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        fetcher = threading.Thread(target=self.fetch_pages, args=(pages, stop), daemon=True)
+        fetcher.start()
+        try:
+            while True:
+                page = pages.get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                for study in page.get('studies', []):
+                    yield study_record(study)
+            fetcher.join()
+        finally:
+            # a consumer stopping early, or a failure, lets the fetcher end instead of waiting on a full queue
+            stop.set()
+            self.session.close()
+
+    def records(self):
+        """
+        Return the NCT records of every study of the query
+        :return: list of NCTRecord
+        """
+        return list(self.iter_records())
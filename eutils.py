@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""
+    NCBI E-utilities backend for keyword scraping
+
+    esearch with usehistory=y resolves the query once on the NCBI side,
+    then efetch pulls the PubMed XML records in batches through the stored WebEnv.
+    The rows have the same columns as the HTML scraper in scrap_module.
+"""
+import os
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import urlsplit
+from dotenv import load_dotenv
+from utils import split_affiliations
+from http_cache import new_session
+from rate_limiter import set_rate
+
+load_dotenv()
+
+EUTILS_URL = os.environ.get('EUTILS_URL', 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/')
+NCBI_API_KEY = os.environ.get('NCBI_API_KEY')
+BATCH_SIZE = 500
+# esearch returns at most this many ids for one query
+ESEARCH_MAX = 10000
+PUBMED_URL = "https://pubmed.ncbi.nlm.nih.gov/"
+PMC_URL = "https://www.ncbi.nlm.nih.gov/pmc/articles/"
+
+# NCBI allows 3 requests per second, 10 with an api key
+set_rate(urlsplit(EUTILS_URL).hostname, 10 if NCBI_API_KEY else 3)
+
+
+def element_text(element):
+    """
+    Return the whole text of an xml element, including inline markup like <i> or <sup>
+    :param element:
+    :return: string
+    """
+    if element is None:
+        return ""
+    return "".join(element.itertext()).strip()
+
+
+class EUtilsUnit:
+    """
+    Scraping Unit backed by esearch/efetch
+    """
+
+    def __init__(self, keyword, batch_size=BATCH_SIZE, session=None, channel=None):
+        self.keyword = keyword
+        self.base_url = EUTILS_URL
+        self.batch_size = batch_size
+        self.channel = channel
+        self.total_count = 0
+        self.web_env = None
+        self.query_key = None
+        self.results_dict = []
+        self.count = 0
+        self.session = session if session is not None else new_session()
+
+    def get_params(self, **params):
+        """
+        Add the parameters shared by every E-utilities call
+        :return: dict
+        """
+        params['db'] = 'pubmed'
+        params['tool'] = 'pubmed-scraper'
+        if NCBI_API_KEY:
+            params['api_key'] = NCBI_API_KEY
+        return params
+
+    def search(self):
+        """
+        Run esearch and keep the WebEnv/query_key of the result set
+        :return: None
+        """
+        data = self.get_params(term=self.keyword, usehistory='y', retmax=0, retmode='json')
+        res = self.session.post("%sesearch.fcgi" % self.base_url, data=data, timeout=60)
+        res.raise_for_status()
+        result = res.json()['esearchresult']
+        self.total_count = int(result.get('count', 0))
+        self.web_env = result.get('webenv')
+        self.query_key = result.get('querykey')
+
+    def search_ids(self):
+        """
+        Return the PMIDs of the keyword in relevance order, without fetching any record
+        :return: list of PMIDs
+        """
+        data = self.get_params(term=self.keyword, retmax=ESEARCH_MAX, retmode='json', sort='relevance')
+        res = self.session.post("%sesearch.fcgi" % self.base_url, data=data, timeout=60)
+        res.raise_for_status()
+        result = res.json()['esearchresult']
+        self.total_count = int(result.get('count', 0))
+        return result.get('idlist', [])
+
+    def fetch_batch(self, retstart):
+        """
+        Fetch one batch of PubMed XML records from the history server
+        :param retstart: offset of the first record
+        :return: bytes
+        """
+        data = self.get_params(WebEnv=self.web_env, query_key=self.query_key, retstart=retstart,
+                               retmax=self.batch_size, retmode='xml')
+        res = self.session.post("%sefetch.fcgi" % self.base_url, data=data, timeout=120)
+        res.raise_for_status()
+        return res.content
+
+    def get_date(self, article):
+        """
+        Return the publication date the way the PubMed citation line shows it, e.g. "2020 Jun 15"
+        """
+        pub_date = article.find('Article/Journal/JournalIssue/PubDate')
+        if pub_date is None:
+            return ""
+        medline_date = pub_date.findtext('MedlineDate')
+        if medline_date:
+            return medline_date
+        parts = [pub_date.findtext(tag) for tag in ('Year', 'Month', 'Day')]
+        return " ".join(part for part in parts if part)
+
+    def get_abstract(self, article):
+        """
+        Return the abstract, one paragraph per labelled section
+        """
+        paragraphs = []
+        for section in article.findall('Article/Abstract/AbstractText'):
+            text = element_text(section)
+            label = section.get('Label')
+            if label:
+                text = "%s: %s" % (label.capitalize(), text)
+            paragraphs.append(text)
+        return "\n\n".join(paragraphs)
+
+    def get_authors(self, article):
+        """
+        Return author names and the distinct affiliations in author order
+        :return: array, array
+        """
+        authors_list = []
+        affiliations = []
+        for author in article.findall('Article/AuthorList/Author'):
+            collective_name = author.findtext('CollectiveName')
+            if collective_name:
+                authors_list.append(collective_name.strip())
+            else:
+                name = " ".join(part for part in (author.findtext('ForeName'), author.findtext('LastName')) if part)
+                authors_list.append(name)
+            for affiliation in author.findall('AffiliationInfo/Affiliation'):
+                text = element_text(affiliation)
+                if text and text not in affiliations:
+                    affiliations.append(text)
+        return authors_list, affiliations
+
+    def get_mesh_terms(self, citation):
+        """
+        Return mesh terms as PubMed renders them: "Descriptor / qualifier", with * on major topics
+        """
+        mesh_terms = []
+        for heading in citation.findall('MeshHeadingList/MeshHeading'):
+            descriptor = heading.find('DescriptorName')
+            name = element_text(descriptor)
+            qualifiers = heading.findall('QualifierName')
+            if not qualifiers:
+                mesh_terms.append(name + ("*" if descriptor.get('MajorTopicYN') == 'Y' else ""))
+            for qualifier in qualifiers:
+                mesh_terms.append("%s / %s%s" % (name, element_text(qualifier),
+                                                 "*" if qualifier.get('MajorTopicYN') == 'Y' else ""))
+        return mesh_terms
+
+    def parse_article(self, pubmed_article):
+        """
+        Return a row with the same keys and order as scrap_module.ScrapingUnit
+        :param pubmed_article: PubmedArticle element
+        :return: dict
+        """
+        citation = pubmed_article.find('MedlineCitation')
+        pmid = citation.findtext('PMID', '').strip()
+        ids = {}
+        for article_id in pubmed_article.findall('PubmedData/ArticleIdList/ArticleId'):
+            ids[article_id.get('IdType')] = (article_id.text or '').strip()
+        pmcid = ids.get('pmc', '')
+        doi = ids.get('doi', '')
+
+        authors_list, affiliations = self.get_authors(citation)
+        affiliation, author_email = split_affiliations(affiliations)
+
+        full_text_links = []
+        if doi:
+            full_text_links.append("https://doi.org/%s" % doi)
+        if pmcid:
+            full_text_links.append("%s%s/" % (PMC_URL, pmcid))
+
+        pub_types = [element_text(pub_type) for pub_type in
+                     citation.findall('Article/PublicationTypeList/PublicationType')]
+
+        return {
+            "Pubmed link": "%s%s" % (PUBMED_URL, pmid),
+            "heading_title": element_text(citation.find('Article/ArticleTitle')),
+            "date": self.get_date(citation),
+            "abstract": self.get_abstract(citation),
+            "authors_list": ", \n".join(authors_list),
+            "affiliation": affiliation,
+            "author_email": ", \n".join(author_email),
+            "pmcid": pmcid,
+            "doi": doi,
+            "full_text_links": ",\n".join(full_text_links),
+            "mesh_terms": ", \n".join(self.get_mesh_terms(citation)),
+            "publication_types": ", \n".join(pub_types),
+        }
+
+    def parse_xml(self, content):
+        """
+        Parse an efetch response and emit its rows
+        :param content: PubmedArticleSet xml
+        :return: None
+        """
+        root = ElementTree.fromstring(content)
+        results_data = []
+        for pubmed_article in root.iter('PubmedArticle'):
+            results_data.append(self.parse_article(pubmed_article))
+            self.count += 1
+
+        if self.channel is not None:
+            self.channel.send([tuple(row.values()) for row in results_data])
+        else:
+            self.results_dict += results_data
+
+    def batch_starts(self):
+        """
+        Return the retstart offset of every efetch batch
+        :return: range
+        """
+        return range(0, self.total_count, self.batch_size)
+
+    def do_scraping(self):
+        self.search()
+        print("E-utilities total count %s" % self.total_count)
+        for retstart in self.batch_starts():
+            print("Fetching records %s-%s" % (retstart, retstart + self.batch_size))
+            self.parse_xml(self.fetch_batch(retstart))
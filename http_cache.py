@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""
+    Raw HTTP response cache
+
+    Responses are stored gzip compressed on disk, keyed by a fingerprint of the request.
+    HTTP_CACHE=record saves every response fetched live, HTTP_CACHE=replay serves everything from the cache
+    without touching the network, so parser changes can be re-run over a recorded crawl.
+"""
+import os
+import gzip
+import json
+import hashlib
+import requests
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from requests.hooks import dispatch_hook
+from dotenv import load_dotenv
+from rate_limiter import ThrottledSession
+
+load_dotenv()
+
+# off, record or replay
+HTTP_CACHE = os.environ.get('HTTP_CACHE', 'off')
+HTTP_CACHE_DIR = os.environ.get('HTTP_CACHE_DIR',
+                                os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'http'))
+# parameters that change on every request without changing the response
+VOLATILE_FIELDS = {'no-cache', 'csrfmiddlewaretoken', 'api_key'}
+
+
+class CacheMiss(Exception):
+    """
+    Raised in replay mode when a request was never recorded
+    """
+    pass
+
+
+def strip_volatile(pairs):
+    """
+    Drop the volatile fields of query or form pairs and sort the others
+    :param pairs: list of (name, value)
+    :return: list of (name, value)
+    """
+    return sorted((name, value) for name, value in pairs if name not in VOLATILE_FIELDS)
+
+
+def fingerprint(request):
+    """
+    Return the cache key of a prepared request
+    :param request: requests.PreparedRequest
+    :return: hex digest
+    """
+    parts = urlsplit(request.url)
+    query = urlencode(strip_volatile(parse_qsl(parts.query, keep_blank_values=True)))
+    url = urlunsplit((parts.scheme, parts.netloc.lower(), parts.path, query, ''))
+
+    body = request.body or b''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if 'x-www-form-urlencoded' in request.headers.get('Content-Type', ''):
+        body = urlencode(strip_volatile(parse_qsl(body.decode('utf-8'), keep_blank_values=True))).encode('utf-8')
+
+    digest = hashlib.sha256()
+    for part in (request.method.encode('ascii'), url.encode('utf-8'),
+                 request.headers.get('Range', '').encode('ascii'), body):
+        digest.update(part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class CachedSession(ThrottledSession):
+    """
+    Throttled session that records responses to, or replays them from, the on-disk cache.
+    Each redirect hop is a cache entry of its own, so replayed redirects behave like live ones.
+    """
+
+    def __init__(self, mode=HTTP_CACHE, cache_dir=HTTP_CACHE_DIR):
+        super(CachedSession, self).__init__()
+        if mode not in ('off', 'record', 'replay'):
+            raise ValueError("HTTP_CACHE must be off, record or replay, not %r" % mode)
+        self.mode = mode
+        self.cache_dir = cache_dir
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], "%s.gz" % key)
+
+    def save(self, key, response):
+        """
+        Write a response to the cache, the body goes after a json line holding status, url and headers
+        :param key: request fingerprint
+        :param response: requests.Response
+        :return: None
+        """
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = {
+            'status_code': response.status_code,
+            'reason': response.reason,
+            'url': response.url,
+            'headers': dict(response.headers),
+        }
+        temp_path = "%s.%s.tmp" % (path, os.getpid())
+        with gzip.open(temp_path, 'wb') as f:
+            f.write(json.dumps(meta).encode('utf-8'))
+            f.write(b'\n')
+            f.write(response.content)
+        os.replace(temp_path, path)
+
+    def load(self, key, request):
+        """
+        Rebuild a response from the cache
+        :param key: request fingerprint
+        :param request: requests.PreparedRequest
+        :return: requests.Response, or None when the entry does not exist
+        """
+        path = self.entry_path(key)
+        if not os.path.exists(path):
+            return None
+        with gzip.open(path, 'rb') as f:
+            meta, content = f.read().split(b'\n', 1)
+        meta = json.loads(meta)
+
+        response = requests.Response()
+        response.status_code = meta['status_code']
+        response.reason = meta['reason']
+        response.url = meta['url']
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.request = request
+        response._content = content
+        response._content_consumed = True
+        return response
+
+    def send(self, request, **kwargs):
+        if self.mode == 'off':
+            return super(CachedSession, self).send(request, **kwargs)
+
+        allow_redirects = kwargs.pop('allow_redirects', True)
+        key = fingerprint(request)
+        if self.mode == 'replay':
+            response = self.load(key, request)
+            if response is None:
+                raise CacheMiss("%s %s" % (request.method, request.url))
+            response = dispatch_hook('response', request.hooks, response, **kwargs)
+        else:
+            response = super(CachedSession, self).send(request, allow_redirects=False, **kwargs)
+            self.save(key, response)
+
+        if allow_redirects:
+            response = self.follow_redirects(response, request, **kwargs)
+        return response
+
+
+def new_session():
+    """
+    Return a session honouring the HTTP_CACHE setting
+    :return: requests.Session
+    """
+    return CachedSession()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import argparse
-from scrap_module import Scraping_Job
+from scrap_module import Scraping_Job, BACKEND
+from page_engine import CONCURRENCY
 import os
 
 
@@ -13,9 +14,12 @@ if __name__ == '__main__':
     # arg parser
     parser = argparse.ArgumentParser()
     parser.add_argument('--keyword', type=str, required=True)
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    parser.add_argument('--backend', type=str, choices=['html', 'eutils'], default=BACKEND)
     args = parser.parse_args()
 
-    data, excel_file = Scraping_Job(keyword=args.keyword, result_folder="output")
+    data, excel_file, file_name = Scraping_Job(keyword=args.keyword, result_folder="output",
+                                               concurrency=args.concurrency, backend=args.backend)
 
     print("Scraping was successfully finished.")
     print("Total count of results is %s" % len(data))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+    Adaptive NCT query batching
+
+    Sizes the PubMed query batches of the clinical job from the observed response latency:
+    fast batches grow the next ones, slow batches shrink them, and a failing batch is split in half.
+    Terms too long for a GET search are resolved with a POST to esearch, or cut down when GET is the only path.
+"""
+import os
+from urllib.parse import quote_plus
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# PubMed field the NCT numbers are searched in, "si" is the secondary source id (databank link).
+# An empty value searches all fields, which also matches NCT numbers only quoted in an abstract.
+NCT_SEARCH_FIELD = os.environ.get('NCT_SEARCH_FIELD', 'si')
+MIN_BATCH = 10
+MAX_BATCH = int(os.environ.get('NCT_MAX_BATCH', 2000))
+INITIAL_BATCH = 200
+# seconds a batch should take, from the search to the last page
+TARGET_LATENCY = float(os.environ.get('NCT_BATCH_LATENCY', 30))
+# url encoded term length above which the search page is skipped for a POST to esearch
+GET_TERM_LIMIT = 4000
+
+
+class NCTBatcher:
+    """
+    Batch size controller of one PubMed process
+    """
+
+    def __init__(self, size=INITIAL_BATCH, min_size=MIN_BATCH, max_size=MAX_BATCH, target_latency=TARGET_LATENCY):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = min(max(size, min_size), max_size)
+        self.target_latency = target_latency
+
+    def query(self, batch):
+        """
+        Return the PubMed term of a batch
+        :param batch: list of NCTRecord
+        :return: string
+        """
+        if NCT_SEARCH_FIELD:
+            return ' OR '.join('%s[%s]' % (nct.nct_number, NCT_SEARCH_FIELD) for nct in batch)
+        return '(' + ' OR '.join('(' + nct.nct_number + ')' for nct in batch) + ')'
+
+    def fits_get(self, query):
+        """
+        Tell whether a term can go in the url of a search page request
+        :param query:
+        :return: bool
+        """
+        return len(quote_plus(query)) <= GET_TERM_LIMIT
+
+    def batch_size(self, records, get=False):
+        """
+        Return the size of the next batch of records, capped on the GET path to the longest term that fits the url
+        :param records: list of NCTRecord waiting to be batched
+        :param get: True when the batch is searched with a GET of the search page
+        :return: int
+        """
+        size = min(self.size, len(records))
+        if not get or self.fits_get(self.query(records[:size])):
+            return size
+        # the term grows with the batch, look for the largest batch that still fits
+        low, high = 1, size - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.fits_get(self.query(records[:middle])):
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def observe(self, batch_size, latency, ok):
+        """
+        Adapt the next batch size to the outcome of a batch
+        :param batch_size: records in the batch
+        :param latency: seconds the batch took
+        :param ok: False when the batch failed or its results were truncated
+        :return: None
+        """
+        if not ok:
+            self.size = max(self.min_size, min(self.size, batch_size) // 2)
+        elif latency < self.target_latency / 2 and batch_size >= self.size:
+            self.size = min(self.max_size, int(self.size * 1.5))
+        elif latency > self.target_latency:
+            self.size = max(self.min_size, int(self.size * self.target_latency / latency))
+
+    def split(self, batch):
+        """
+        Split a failing batch in two halves
+        :param batch: list of NCTRecord
+        :return: list of batches, empty when the batch cannot be split
+        """
+        if len(batch) < 2:
+            return []
+        middle = len(batch) // 2
+        return [batch[:middle], batch[middle:]]
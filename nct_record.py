@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""
+    NCT record
+
+    The columns of a ClinicalTrials.gov study used by the PubMed join, whichever clinical backend produced it
+"""
+from parsers import make_soup
+
+
+def flatten_list(html):
+    """
+    Join the list items of a rpc html cell
+    :param html: e.g. <ul><li>Cancer</li><li>Pain</li></ul>
+    :return: string, e.g. "Cancer | Pain"
+    """
+    items = [li.text.replace('\n', '').strip() for li in make_soup(html).find_all('li')]
+    return ' | '.join(items)
+
+
+class NCTRecord:
+    """
+    Columns of a trial used by the PubMed join, flattened once per trial
+    """
+    __slots__ = ('nct_number', 'conditions', 'interventions', 'outcome_measures')
+
+    def __init__(self, nct_number, conditions, interventions, outcome_measures):
+        self.nct_number = nct_number
+        self.conditions = conditions
+        self.interventions = interventions
+        self.outcome_measures = outcome_measures
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Build the record of a ClinicalTrials.gov rpc row
+        :param row: list, 1 is the NCT number, 4 conditions, 5 interventions, 11 outcome measures
+        :return: NCTRecord
+        """
+        return cls(row[1], flatten_list(row[4]), flatten_list(row[5]), flatten_list(row[11]).replace('●', '').strip())
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+    Asyncio page engine
+
+    Runs blocking page fetches concurrently on one event loop with a bounded number of requests in flight
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from scheduler import Task, MAX_ATTEMPTS, backoff_delay
+
+CONCURRENCY = int(os.environ.get('SCRAPING_CONCURRENCY', 8))
+
+
+class PageEngine:
+    """
+    Fan a fetch function out over many tasks (page numbers, query batches, ...)
+    Free workers pull the next task, failed ones are retried with backoff by whichever worker is free then.
+    """
+
+    def __init__(self, fetch, concurrency=CONCURRENCY, retry_if=None, max_attempts=MAX_ATTEMPTS):
+        """
+        :param fetch: blocking function(task)
+        :param concurrency: fetches in flight
+        :param retry_if: optional predicate(result), True when the result should be fetched again
+        :param max_attempts: runs of a task before it is given up
+        """
+        self.fetch = fetch
+        self.concurrency = max(1, int(concurrency))
+        self.retry_if = retry_if
+        self.max_attempts = max_attempts
+
+    def next_task(self, tasks, delayed):
+        """
+        Return a due retry, else the next new task, else the retry due first
+        :param tasks: shared iterator of payloads
+        :param delayed: retries waiting for their backoff
+        :return: Task or None
+        """
+        now = time.time()
+        for task in delayed:
+            if task.not_before <= now:
+                delayed.remove(task)
+                return task
+        for payload in tasks:
+            return Task(payload)
+        if delayed:
+            task = min(delayed, key=lambda retry: retry.not_before)
+            delayed.remove(task)
+            return task
+        return None
+
+    async def _worker(self, loop, executor, tasks, delayed, in_flight, on_result):
+        """
+        Pull the next task until the shared iterator is exhausted and no retry is pending
+        :param loop: running event loop
+        :param executor: executor running the blocking fetches
+        :param tasks: shared iterator of tasks
+        :param delayed: shared list of retries
+        :param in_flight: shared one-item list counting running fetches, they may still add retries
+        :param on_result: callback(task, result)
+        :return: None
+        """
+        while True:
+            task = self.next_task(tasks, delayed)
+            if task is None:
+                if in_flight[0] == 0:
+                    return
+                await asyncio.sleep(0.1)
+                continue
+
+            in_flight[0] += 1
+            try:
+                wait = task.not_before - time.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                try:
+                    result = await loop.run_in_executor(executor, self.fetch, task.payload)
+                    failed = self.retry_if is not None and self.retry_if(result)
+                except Exception as e:
+                    print(e, task.payload)
+                    result, failed = None, True
+
+                if failed and task.attempt + 1 < self.max_attempts:
+                    task.attempt += 1
+                    task.not_before = time.time() + backoff_delay(task.attempt)
+                    delayed.append(task)
+                    continue
+            finally:
+                in_flight[0] -= 1
+
+            if result is None and failed:
+                print("Giving up on %s after %s attempts" % (task.payload, task.attempt + 1))
+                continue
+            on_result(task.payload, result)
+
+    async def _run(self, tasks, on_result):
+        loop = asyncio.get_running_loop()
+        tasks = iter(tasks)
+        delayed = []
+        in_flight = [0]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            await asyncio.gather(*[
+                self._worker(loop, executor, tasks, delayed, in_flight, on_result) for _ in range(self.concurrency)
+            ])
+
+    def run(self, tasks, on_result=None):
+        """
+        Fetch every task and hand the results to on_result as they complete
+        :param tasks: iterable of tasks passed to fetch
+        :param on_result: callback(task, result), called on the event loop thread
+        :return: list of (task, result) when no callback is given
+        """
+        collected = []
+        if on_result is None:
+            def on_result(task, result):
+                collected.append((task, result))
+
+        asyncio.run(self._run(tasks, on_result))
+        return collected
@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+"""
+    HTML parser backends
+
+    The scraping units read PubMed pages through an ArticleParser, which returns the raw article fields.
+    Formatting the fields into rows stays in scrap_module / scrap_pubmed, so every backend yields the same records.
+    The backend is selected with the HTML_PARSER environment variable: "html.parser" (default) or "lxml".
+"""
+import os
+import re
+from html import unescape
+from bs4 import BeautifulSoup, SoupStrainer, Tag
+from dotenv import load_dotenv
+
+load_dotenv()
+
+HTML_PARSER = os.environ.get('HTML_PARSER', 'html.parser')
+
+CSRF_INPUT_PATTERN = re.compile(r'<input[^>]*\bname=["\']csrfmiddlewaretoken["\'][^>]*>', re.IGNORECASE)
+VALUE_PATTERN = re.compile(r'\bvalue=["\']([^"\']*)["\']', re.IGNORECASE)
+RESULTS_AMOUNT_PATTERN = re.compile(
+    r'<(\w+)[^>]*\bclass=["\'][^"\']*(?<![\w-])results-amount(?![\w-])[^"\']*["\'][^>]*>(.*?)</\1\s*>',
+    re.IGNORECASE | re.DOTALL)
+TAG_PATTERN = re.compile(r'<[^>]+>')
+ARTICLE_START_PATTERN = re.compile(r'<div[^>]*\bclass=["\'][^"\']*(?<![\w-])results-article(?![\w-])', re.IGNORECASE)
+ARTICLES_STRAINER = SoupStrainer('div', class_='results-article')
+
+
+def make_soup(markup, parse_only=None):
+    """
+    Return a BeautifulSoup object built with the configured tree builder
+    :param markup: html text or bytes
+    :param parse_only: optional SoupStrainer
+    :return: BeautifulSoup4 object
+    """
+    features = "lxml" if HTML_PARSER == "lxml" else "html.parser"
+    return BeautifulSoup(markup, features, parse_only=parse_only)
+
+
+# (tag, class) -> field of the single-pass extractor.
+# The class is one class token, or the whole class attribute for the multi-class lookups the extractors used.
+ARTICLE_DISPATCH = {
+    ('div', 'full-view'): 'full_view',
+    ('h1', 'heading-title'): 'title',
+    ('span', 'citation-doi'): 'doi',
+    ('strong', 'current-id'): 'pmid',
+    ('span', 'identifier pmc'): 'pmcid',
+    ('span', 'identifier pubmed'): 'pubmed_id',
+    ('span', 'cit'): 'cit',
+    ('span', 'authors-list-item'): 'author',
+    ('a', 'full-name'): 'full_name',
+    ('div', 'abstract-content selected'): 'abstract',
+    ('div', 'affiliations'): 'affiliations',
+    ('div', 'full-text-links-list'): 'full_text_links',
+    ('div', 'mesh-terms keywords-section'): 'mesh_terms',
+    ('ul', 'keywords-list'): 'keywords_list',
+    ('button', 'keyword-actions-trigger'): 'keyword',
+}
+HEADER_FIELDS = ('title', 'doi', 'pmid', 'pmcid', 'pubmed_id', 'cit')
+# where article_fields reads the header fields and authors from:
+# the first div.full-view (scrap_module) or the whole article (scrap_pubmed)
+FULL_VIEW_SCOPE = 'full_view'
+ARTICLE_SCOPE = 'article'
+PUBLICATION_TYPES_CLASS = 'publication-types keywords-section'
+
+# BeautifulSoup leaves the text of these out of .text
+HIDDEN_TEXT_TAGS = {'script', 'style', 'template'}
+
+
+def prescan_csrf_token(markup):
+    """
+    Return the csrfmiddlewaretoken value of a page without parsing it, or None
+    :param markup: html text
+    :return: string
+    """
+    tag = CSRF_INPUT_PATTERN.search(markup)
+    if tag is None:
+        return None
+    value = VALUE_PATTERN.search(tag.group(0))
+    if value is None:
+        return None
+    return unescape(value.group(1))
+
+
+def prescan_results_amount(markup):
+    """
+    Return the text of the results-amount element without parsing the page, or None
+    :param markup: html text
+    :return: string
+    """
+    amount = RESULTS_AMOUNT_PATTERN.search(markup)
+    if amount is None:
+        return None
+    return unescape(TAG_PATTERN.sub('', amount.group(2)))
+
+
+def trim_to_articles(markup):
+    """
+    Drop everything before the first results-article: the head, scripts, header and search form
+    :param markup: html text
+    :return: string
+    """
+    start = ARTICLE_START_PATTERN.search(markup)
+    if start is None:
+        return markup
+    return markup[start.start():]
+
+
+class ArticleWalk:
+    """
+    State of one walk over an article node
+    """
+
+    def __init__(self):
+        # header fields are collected both inside the first div.full-view and over the whole article
+        self.in_view = False
+        self.view_seen = False
+        self.view = {}
+        self.anywhere = {}
+        self.view_authors = []
+        self.authors = []
+        self.open_authors = []
+
+        self.abstract = None
+        self.affiliations = []
+        self.open_affiliations = []
+        self.full_text_links = []
+        self.mesh_terms = []
+        self.publication_types = []
+
+        # sections in progress, each one only counts the first time it appears
+        self.seen_sections = set()
+        self.section = None
+        self.keywords = None
+        self.keywords_seen = False
+
+
+class ArticleParser:
+    """
+    Interface of a PubMed page parser.
+    The article extractor is shared: it fills every field from one walk of the article subtree,
+    dispatching on (tag, class) through ARTICLE_DISPATCH. Backends only provide the tree primitives.
+    """
+
+    def __init__(self):
+        self.handlers = {key: getattr(self, 'on_' + field) for key, field in ARTICLE_DISPATCH.items()}
+
+    def parse(self, markup, articles_only=False):
+        """
+        Return the parsed document
+        :param markup: html text
+        :param articles_only: build only the div.results-article subtrees
+        """
+        raise NotImplementedError
+
+    def articles(self, document):
+        """Return the div.results-article nodes of a search result page"""
+        raise NotImplementedError
+
+    def text(self, node):
+        """Return all the text under a node"""
+        raise NotImplementedError
+
+    def children(self, node):
+        """Return the child elements of a node, as (element, tag name, class list)"""
+        raise NotImplementedError
+
+    def attribute(self, node, name):
+        """Return an attribute of an element, or None"""
+        raise NotImplementedError
+
+    def article_fields(self, article, header_scope=FULL_VIEW_SCOPE):
+        """
+        Return the raw fields of one article:
+        title, doi, pmid, pmcid, pubmed_id, cit, authors, abstract, affiliations,
+        full_text_links, mesh_terms and publication_types
+        :param article: article node
+        :param header_scope: FULL_VIEW_SCOPE reads the header and authors from the first div.full-view,
+                             or from the whole article when it has none; ARTICLE_SCOPE from the whole article
+        """
+        walk = ArticleWalk()
+        self.walk(article, walk)
+
+        in_view = header_scope == FULL_VIEW_SCOPE and walk.view_seen
+        header = walk.view if in_view else walk.anywhere
+        fields = {field: header.get(field, "") for field in HEADER_FIELDS}
+        fields.update({
+            "authors": [author[0] for author in (walk.view_authors if in_view else walk.authors)],
+            "abstract": walk.abstract or "",
+            "affiliations": [affiliation[0] for affiliation in walk.affiliations],
+            "full_text_links": walk.full_text_links,
+            "mesh_terms": walk.mesh_terms,
+            "publication_types": walk.publication_types,
+        })
+        return fields
+
+    def walk(self, node, walk):
+        """
+        Visit every element under node once, in document order
+        """
+        for child, tag, classes in self.children(node):
+            exits = []
+            if classes:
+                matched = []
+                joined = " ".join(classes)
+                for key in [(tag, name) for name in classes] + [(tag, joined)]:
+                    handler = self.handlers.get(key)
+                    if handler is not None and handler not in matched:
+                        matched.append(handler)
+                if tag == 'div' and PUBLICATION_TYPES_CLASS in joined:
+                    matched.append(self.on_publication_types)
+                for handler in matched:
+                    exit_ = handler(child, walk)
+                    if exit_ is not None:
+                        exits.append(exit_)
+
+            if tag == 'li' and walk.section == 'affiliations':
+                exits.append(self.on_affiliation(child, walk))
+            elif tag == 'sup' and walk.open_affiliations:
+                key = self.text(child).strip()
+                for affiliation in walk.open_affiliations:
+                    if affiliation[2] is None:
+                        affiliation[2] = key
+            elif tag == 'a' and walk.section == 'full_text_links':
+                href = self.attribute(child, 'href')
+                if href is not None:
+                    walk.full_text_links.append(href)
+
+            self.walk(child, walk)
+            for exit_ in reversed(exits):
+                exit_()
+
+    def header_field(self, node, walk, field):
+        if field in walk.anywhere and (not walk.in_view or field in walk.view):
+            return
+        value = self.text(node).strip()
+        walk.anywhere.setdefault(field, value)
+        if walk.in_view:
+            walk.view.setdefault(field, value)
+
+    def on_full_view(self, node, walk):
+        if walk.view_seen:
+            return None
+        walk.view_seen = True
+        walk.in_view = True
+
+        def exit_():
+            walk.in_view = False
+        return exit_
+
+    def on_title(self, node, walk):
+        self.header_field(node, walk, 'title')
+
+    def on_doi(self, node, walk):
+        self.header_field(node, walk, 'doi')
+
+    def on_pmid(self, node, walk):
+        self.header_field(node, walk, 'pmid')
+
+    def on_pmcid(self, node, walk):
+        self.header_field(node, walk, 'pmcid')
+
+    def on_pubmed_id(self, node, walk):
+        self.header_field(node, walk, 'pubmed_id')
+
+    def on_cit(self, node, walk):
+        self.header_field(node, walk, 'cit')
+
+    def on_author(self, node, walk):
+        author = [""]
+        walk.authors.append(author)
+        if walk.in_view:
+            walk.view_authors.append(author)
+        walk.open_authors.append([author, False])
+
+        def exit_():
+            walk.open_authors.pop()
+        return exit_
+
+    def on_full_name(self, node, walk):
+        if not walk.open_authors:
+            return
+        name = self.text(node).strip()
+        for open_author in walk.open_authors:
+            if not open_author[1]:
+                open_author[0][0] = name
+                open_author[1] = True
+
+    def on_abstract(self, node, walk):
+        if walk.abstract is None:
+            walk.abstract = self.text(node).strip()
+
+    def enter_section(self, walk, section):
+        """
+        Enter a section the first time it appears, return the exit callback
+        """
+        if section in walk.seen_sections or walk.section is not None:
+            return None
+        walk.seen_sections.add(section)
+        walk.section = section
+        walk.keywords = None
+        walk.keywords_seen = False
+
+        def exit_():
+            walk.section = None
+            walk.keywords = None
+        return exit_
+
+    def on_affiliations(self, node, walk):
+        return self.enter_section(walk, 'affiliations')
+
+    def on_affiliation(self, node, walk):
+        # [text, node, sup key]
+        affiliation = ["", node, None]
+        walk.affiliations.append(affiliation)
+        walk.open_affiliations.append(affiliation)
+
+        def exit_():
+            walk.open_affiliations.pop()
+            text = self.text(node).strip()
+            affiliation[0] = text[len(affiliation[2] or ""):]
+            affiliation[1] = None
+        return exit_
+
+    def on_full_text_links(self, node, walk):
+        return self.enter_section(walk, 'full_text_links')
+
+    def on_mesh_terms(self, node, walk):
+        return self.enter_section(walk, 'mesh_terms')
+
+    def on_publication_types(self, node, walk):
+        return self.enter_section(walk, 'publication_types')
+
+    def on_keywords_list(self, node, walk):
+        if walk.section not in ('mesh_terms', 'publication_types') or walk.keywords_seen:
+            return None
+        walk.keywords_seen = True
+        walk.keywords = walk.mesh_terms if walk.section == 'mesh_terms' else walk.publication_types
+
+        def exit_():
+            walk.keywords = None
+        return exit_
+
+    def on_keyword(self, node, walk):
+        if walk.keywords is not None:
+            walk.keywords.append(self.text(node).strip())
+
+
+class SoupParser(ArticleParser):
+    """
+    BeautifulSoup backend
+    """
+
+    def parse(self, markup, articles_only=False):
+        if articles_only:
+            return make_soup(trim_to_articles(markup), parse_only=ARTICLES_STRAINER)
+        return make_soup(markup)
+
+    def articles(self, document):
+        return document.find_all('div', {"class": "results-article"})
+
+    def text(self, node):
+        return node.text
+
+    def children(self, node):
+        for child in node.children:
+            if isinstance(child, Tag):
+                yield child, child.name, child.get('class')
+
+    def attribute(self, node, name):
+        return node.attrs.get(name)
+
+
+class LxmlParser(ArticleParser):
+    """
+    lxml backend
+    """
+
+    def __init__(self):
+        super().__init__()
+        import lxml.html
+        self.html = lxml.html
+
+    def parse(self, markup, articles_only=False):
+        if articles_only:
+            # the tree is built in C, skipping the page head is what saves time and memory here
+            return self.html.document_fromstring(trim_to_articles(markup))
+        return self.html.document_fromstring(markup)
+
+    def articles(self, document):
+        return document.xpath("//div[contains(concat(' ', normalize-space(@class), ' '), ' results-article ')]")
+
+    def collect_text(self, node, parts, with_tail=False):
+        """
+        Append the text under node to parts the way BeautifulSoup's .text sees it
+        """
+        if isinstance(node.tag, str) and node.tag not in HIDDEN_TEXT_TAGS:
+            if node.text:
+                parts.append(node.text)
+            for child in node:
+                self.collect_text(child, parts, with_tail=True)
+        if with_tail and node.tail:
+            parts.append(node.tail)
+
+    def text(self, node):
+        parts = []
+        self.collect_text(node, parts)
+        # BeautifulSoup collapses whitespace-only strings that contain a newline to a single newline
+        return "".join('\n' if '\n' in part and not part.strip() else part for part in parts)
+
+    def children(self, node):
+        for child in node:
+            if isinstance(child.tag, str):
+                classes = child.get('class')
+                yield child, child.tag, classes.split() if classes else None
+
+    def attribute(self, node, name):
+        return node.get(name)
+
+
+def get_parser(name=None):
+    """
+    Return the configured ArticleParser
+    :param name: "html.parser" or "lxml", defaults to HTML_PARSER
+    :return: ArticleParser
+    """
+    if (name or HTML_PARSER) == "lxml":
+        return LxmlParser()
+    return SoupParser()
@@ -1,4 +1,7 @@
+import os
+import logging
 from abc import ABC, abstractmethod
+from .helpers import stream_pdf
 
 
 class Site(ABC):
@@ -13,9 +16,16 @@ class Site(ABC):
     def get_pdf_url(self, **args):
         pass
 
-    @abstractmethod
-    def download_pdf(self, **args):
-        pass
+    def download_pdf(self, url):
+        """
+        Stream the pdf of an url to the download folder with the session of the site.
+        The content type is checked on the streamed response, without a HEAD request first.
+        :param url:
+        :return: file name
+        """
+        stream_pdf(self.session, url, os.path.join(self.download_path, self.pdf_name))
+        logging.info("PDF Downloaded")
+        return self.pdf_name
     
     @abstractmethod
     def start_scrape(self):
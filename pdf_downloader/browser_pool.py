@@ -0,0 +1,237 @@
+"""
+    Headless Chrome pool
+
+    The Selenium based sites lease a browser for one article instead of starting Chrome for each.
+    Every Downloader run owns its pool, so runs of concurrent requests never quit each other's browsers.
+    Every browser downloads into a folder of its own, so a finished file is never taken for another
+    article's. Completion is detected from file system events of watchdog, or by polling the folder
+    when watchdog is missing.
+"""
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.chrome.options import Options
+from .webdriver_utils import get_driver_path
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    # watchdog is in requirements.txt, an install without it still works by polling
+    Observer = None
+    FileSystemEventHandler = object
+
+BROWSER_POOL_SIZE = int(os.environ.get('BROWSER_POOL_SIZE', 2))
+# seconds a download may take
+DOWNLOAD_TIMEOUT = 30
+# seconds between two listings of the folder without watchdog
+POLL_INTERVAL = 0.2
+PARTIAL_SUFFIXES = ('.crdownload', '.tmp', '.part')
+
+
+def chrome_options(download_dir):
+    """
+    Return the options of a headless Chrome saving its downloads to download_dir
+    :param download_dir:
+    :return: Options
+    """
+    options = Options()
+    options.add_argument("--headless")
+    options.add_argument('--disable-gpu')
+    options.add_argument('--disable-software-rasterizer')
+    options.add_argument("--window-size=1920x1080")
+    options.add_argument("--disable-notifications")
+    options.add_argument('--no-sandbox')
+    options.add_argument('--verbose')
+    options.add_experimental_option("prefs", {
+        "download.default_directory": download_dir,
+        "download.prompt_for_download": False,
+        "download.directory_upgrade": True,
+        "safebrowsing_for_trusted_sources_enabled": False,
+        "safebrowsing.enabled": False,
+        "plugins.plugins_list": [{"enabled": False, "name": "Chrome PDF Viewer"}],
+        "download.extensions_to_open": "applications/pdf"
+    })
+    return options
+
+
+def finished_download(directory):
+    """
+    Return the path of a completed download of the folder
+    :param directory:
+    :return: str or None
+    """
+    for name in os.listdir(directory):
+        if not name.startswith('.') and not name.endswith(PARTIAL_SUFFIXES):
+            return os.path.join(directory, name)
+    return None
+
+
+class DownloadEvents(FileSystemEventHandler):
+    """
+    Wakes the waiting thread on every change of the download folder
+    """
+
+    def __init__(self, changed):
+        super().__init__()
+        self.changed = changed
+
+    def on_any_event(self, event):
+        self.changed.set()
+
+
+def wait_for_download(directory, timeout=DOWNLOAD_TIMEOUT):
+    """
+    Wait until a download of the folder is complete
+    :param directory: download folder of one browser
+    :param timeout: seconds
+    :return: path of the downloaded file, None on timeout
+    """
+    deadline = time.monotonic() + timeout
+    if Observer is None:
+        while True:
+            path = finished_download(directory)
+            if path or time.monotonic() >= deadline:
+                return path
+            time.sleep(POLL_INTERVAL)
+
+    changed = threading.Event()
+    observer = Observer()
+    observer.schedule(DownloadEvents(changed), directory)
+    observer.start()
+    try:
+        while True:
+            path = finished_download(directory)
+            remaining = deadline - time.monotonic()
+            if path or remaining <= 0:
+                return path
+            changed.wait(remaining)
+            changed.clear()
+    finally:
+        observer.stop()
+        observer.join()
+
+
+class Browser:
+    """
+    Headless Chrome with its own download folder
+    """
+
+    def __init__(self, download_dir):
+        self.download_dir = download_dir
+        os.makedirs(download_dir, exist_ok=True)
+        self.driver = webdriver.Chrome(executable_path=get_driver_path(), options=chrome_options(download_dir))
+        self.enable_download_headless()
+
+    """
+        Source: https://medium.com/@moungpeter/how-to-automate-downloading-files-using-python-selenium-and-headless-chrome-9014f0cdd196
+    """
+    def enable_download_headless(self):
+        self.driver.command_executor._commands["send_command"] = ("POST", '/session/$sessionId/chromium/send_command')
+        params = {'cmd': 'Page.setDownloadBehavior', 'params': {'behavior': 'allow', 'downloadPath': self.download_dir}}
+        self.driver.execute("send_command", params)
+
+    def clear_downloads(self):
+        """
+        Empty the download folder, left overs of a failed article
+        :return: None
+        """
+        for name in os.listdir(self.download_dir):
+            os.remove(os.path.join(self.download_dir, name))
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        finally:
+            shutil.rmtree(self.download_dir, ignore_errors=True)
+
+
+class BrowserPool:
+    """
+    Thread-safe pool of at most size browsers, started on demand and reused across articles
+    """
+
+    def __init__(self, size=BROWSER_POOL_SIZE):
+        self.size = max(1, size)
+        self.root_dir = tempfile.mkdtemp(prefix="browser-downloads-")
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Return an idle browser, starting one while the pool is not full
+        :return: Browser
+        """
+        while True:
+            with self.lock:
+                create = self.created < self.size and self.idle.empty()
+                if create:
+                    self.created += 1
+                    number = self.created
+            if create:
+                try:
+                    return Browser(os.path.join(self.root_dir, "browser-%s-%s" % (number, time.time())))
+                except Exception:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+            try:
+                # a browser dropped by another thread frees a slot, look again now and then
+                return self.idle.get(timeout=1)
+            except queue.Empty:
+                continue
+
+    def discard(self, browser):
+        """
+        Quit a browser that failed, a new one takes its place on demand
+        :param browser: Browser
+        :return: None
+        """
+        with self.lock:
+            self.created -= 1
+        try:
+            browser.quit()
+        except Exception as e:
+            print(e)
+
+    @contextmanager
+    def lease(self):
+        """
+        Lend a browser with an empty download folder for one article
+        :return: Browser
+        """
+        browser = self.acquire()
+        try:
+            browser.clear_downloads()
+            yield browser
+        except WebDriverException:
+            self.discard(browser)
+            raise
+        except BaseException:
+            self.idle.put(browser)
+            raise
+        else:
+            self.idle.put(browser)
+
+    def close(self):
+        """
+        Quit the idle browsers
+        :return: None
+        """
+        while True:
+            try:
+                browser = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            with self.lock:
+                self.created -= 1
+            browser.quit()
+        shutil.rmtree(self.root_dir, ignore_errors=True)
+
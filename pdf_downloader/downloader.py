@@ -1,24 +1,120 @@
-import requests
-from .helpers import csv_parser, contains_nihgov, parse_urls, get_nihgov_url, get_unique_id_from_url
+from http_cache import new_session
+from .helpers import csv_parser, contains_nihgov, parse_urls, get_nihgov_url, get_unique_id_from_url, pmc_id
 import os
-from .sites import NIHGov
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
+from .sites import NIHGov, PMC_PDF_URL
+from .browser_pool import BrowserPool
 import pandas as pd
 from datetime import datetime
 from .exceptions import CanNotCreateFolder
 from utils import retry
+from .resolver_cache import ResolverCache, RESOLVER_CACHE
+import requests
+
+
+# articles downloaded at the same time
+DOWNLOAD_CONCURRENCY = int(os.environ.get('PDF_CONCURRENCY', 8))
+# articles of one publisher host at the same time, PDF_HOST_LIMITS="host=n,..." overrides it per host
+HOST_CONCURRENCY = int(os.environ.get('PDF_HOST_CONCURRENCY', 2))
+HOST_LIMITS = dict(
+    (host.strip(), int(limit)) for host, limit in
+    (item.split('=') for item in os.environ.get('PDF_HOST_LIMITS', '').split(',') if '=' in item)
+)
+
+
+def host_of(url):
+    """
+    Return the host an url downloads from
+    :param url: None for an article found by its PMCID alone, which is fetched from PMC
+    :return: str
+    """
+    return urlsplit(url or PMC_PDF_URL).netloc.lower()
+
+
+class HostSlots:
+    """
+    Per host counts capping the articles downloaded from one publisher at the same time.
+    Slots are taken without waiting, by the scheduling thread only: a step of a busy host stays queued
+    while the workers run the steps of other hosts.
+    """
+
+    def __init__(self, default=HOST_CONCURRENCY, limits=None):
+        self.default = max(1, default)
+        self.limits = HOST_LIMITS if limits is None else limits
+        self.in_use = {}
+
+    def acquire(self, host):
+        """
+        Take a slot of a host
+        :param host:
+        :return: False when the host is at its limit
+        """
+        if self.in_use.get(host, 0) >= max(1, self.limits.get(host, self.default)):
+            return False
+        self.in_use[host] = self.in_use.get(host, 0) + 1
+        return True
+
+    def release(self, host):
+        self.in_use[host] -= 1
+
+
+class SiteDownload:
+    """
+    Site class to try on an url, with its extra arguments
+    """
+    __slots__ = ('klass', 'url', 'kwargs')
+
+    def __init__(self, klass, url, **kwargs):
+        self.klass = klass
+        self.url = url
+        self.kwargs = kwargs
+
+
+class ArticleDownload:
+    """
+    Pdf of one article and the steps left to get it: urls to resolve and sites to try, in order
+    """
+
+    def __init__(self, name, steps):
+        self.name = name
+        self.steps = deque(steps)
+        # rows of the csv the pdf belongs to
+        self.indexes = []
+        self.result = False
 
 
 class Downloader:
-    def __init__(self, csv_name):
+    def __init__(self, csv_name, concurrency=DOWNLOAD_CONCURRENCY):
         self.csv_name = csv_name
+        self.concurrency = max(1, concurrency)
         self.ts = datetime.now().strftime('%Y-%m-%d-%H-%M_%S')
         self.download_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "downloads",
                                          self.ts)
         self.headers = {
             "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.75 Safari/537.36"
         }
-        self.url_resolver_session = requests.session()
-        self.url_resolver_session.headers.update(self.headers)
+        self.host_slots = HostSlots()
+        # one url resolver session per worker thread
+        self.local = threading.local()
+        self.resolver_sessions = []
+        self.resolver_cache = ResolverCache() if RESOLVER_CACHE else None
+        # redirect locations of this run, shared by the worker threads
+        self.resolved = {}
+        # browsers of this run only, started by run
+        self.browser_pool = None
+
+    @property
+    def url_resolver_session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = new_session()
+            session.headers.update(self.headers)
+            self.local.session = session
+            self.resolver_sessions.append(session)
+        return session
 
     def get_data(self):
         csv_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static", "downloads",
@@ -31,6 +127,154 @@ class Downloader:
     #     data = self.get_data()
     #     return data['Full text link']
 
+    def load_resolved(self, data):
+        """
+        Look the redirect urls of every row up in the resolver cache at once
+        :param data: data frame of the csv
+        :return: None
+        """
+        if self.resolver_cache is None:
+            return
+        urls = [url for url_list in data['Full text link'] if isinstance(url_list, str)
+                for url in parse_urls(url_list) if "http" in url and needs_resolving(url)]
+        self.resolved.update(self.resolver_cache.get_many(urls))
+        print("Resolver cache: %s of %s redirect urls known" % (len(self.resolved), len(set(urls))))
+
+    def scrape(self, klass, url, unique_pdf_id, **kwargs):
+        """
+        Download the pdf of one article with a site class
+        :param klass: Site subclass
+        :param url:
+        :param unique_pdf_id: file name of the pdf
+        :param kwargs: extra arguments of the site class
+        :return: file name, False when nothing was downloaded
+        """
+        if getattr(klass, 'uses_browser', False):
+            kwargs['browser_pool'] = self.browser_pool
+        try:
+            site = klass(url, self.download_dir, unique_pdf_id, **kwargs)
+            res = site.start_scrape()
+            if res:
+                print(res, "Source: %s" % klass.__name__)
+            return res
+        except Exception as e:
+            print(e)
+            return False
+
+    def plan(self, row):
+        """
+        Return the steps of the download of an article
+        :param row: pandas row
+        :return: list of SiteDownload and urls to resolve
+        """
+        url_list = row['Full text link']
+        # articles in PMC are fetched straight from their PMCID
+        pmcid = pmc_id(row.get('PMCID'))
+        parsed_list = parse_urls(url_list) if isinstance(url_list, str) else []
+        if contains_nihgov(parsed_list):
+            return [SiteDownload(NIHGov, get_nihgov_url(parsed_list), pmcid=pmcid)]
+        steps = [SiteDownload(NIHGov, None, pmcid=pmcid)] if pmcid else []
+        return steps + [url for url in parsed_list if isinstance(url, str) and "http" in url]
+
+    def resolve(self, url):
+        """
+        Follow the redirects of a full text url to the site it downloads from
+        :param url:
+        :return: SiteDownload, None when no site class handles the url
+        """
+        resolved_url = url_resolver(url, self.url_resolver_session, self.resolved, self.resolver_cache)
+        if resolved_url:
+            if "doi" in resolved_url:
+                resolved_url = url_resolver(resolved_url, self.url_resolver_session, self.resolved,
+                                            self.resolver_cache)
+        url_class = url_classifier(resolved_url)
+        if resolved_url != url:
+            print("Resolved url: %s -> %s" % (url, resolved_url))
+        if url_class:
+            return SiteDownload(url_class, resolved_url)
+        return None
+
+    def run_step(self, article, step):
+        """
+        Run one step of the download of an article, in a worker thread
+        :param article: ArticleDownload
+        :param step: SiteDownload, or an url to resolve
+        :return: file name or False for a site, SiteDownload or None for an url
+        """
+        if isinstance(step, SiteDownload):
+            return self.scrape(step.klass, step.url, article.name, **step.kwargs)
+        return self.resolve(step)
+
+    @staticmethod
+    def queue_next_step(waiting, article):
+        """
+        Queue an article under the host of its next step, None for an url to resolve
+        :param waiting: OrderedDict of host -> deque of ArticleDownload
+        :param article: ArticleDownload
+        :return: None
+        """
+        if not article.steps:
+            return
+        step = article.steps[0]
+        host = host_of(step.url) if isinstance(step, SiteDownload) else None
+        waiting.setdefault(host, deque()).append(article)
+
+    def download(self, data):
+        """
+        Download the pdfs of the csv rows, filling their PDFDownloaded column
+        :param data: data frame of the csv
+        :return: None
+        """
+        # the clinical csv has a row per article and trial: every pdf is downloaded once
+        # and its result goes to all the rows of the article
+        articles = {}
+        for idx, row in data.iterrows():
+            name = pdf_name(row)
+            if name not in articles:
+                articles[name] = ArticleDownload(name, self.plan(row))
+            articles[name].indexes.append(idx)
+
+        # steps wait in one queue per host; a worker only gets a step whose host has a free slot,
+        # so a busy publisher never holds the threads the other hosts could use
+        waiting = OrderedDict()
+        for article in articles.values():
+            self.queue_next_step(waiting, article)
+        running = {}
+        # the steps run in the pool, scheduling and the data frame stay in this thread
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while waiting or running:
+                for host in list(waiting):
+                    queue = waiting[host]
+                    while queue and len(running) < self.concurrency and \
+                            (host is None or self.host_slots.acquire(host)):
+                        article = queue.popleft()
+                        running[executor.submit(self.run_step, article, article.steps.popleft())] = (article, host)
+                    if not queue:
+                        del waiting[host]
+                    else:
+                        # the hosts take turns for the free workers
+                        waiting.move_to_end(host)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    article, host = running.pop(future)
+                    if host is not None:
+                        self.host_slots.release(host)
+                    try:
+                        outcome = future.result()
+                    except Exception as e:
+                        print(e)
+                        outcome = None
+                    if host is None:
+                        if outcome is not None:
+                            article.steps.appendleft(outcome)
+                    elif outcome:
+                        # the first pdf downloaded for an article ends it
+                        article.result = outcome
+                        data.loc[article.indexes, 'PDFDownloaded'] = outcome
+                    if not article.result:
+                        self.queue_next_step(waiting, article)
+
     def run(self):
         try:
             os.mkdir(self.download_dir)
@@ -38,46 +282,17 @@ class Downloader:
             raise CanNotCreateFolder
 
         data = self.get_data()
+        self.load_resolved(data)
 
-        for idx, row in data.iterrows():
-            url_list = row['Full text link']
-            pubmed_link = row['Pubmed link']
-            unique_pdf_id = get_unique_id_from_url(pubmed_link) + ".pdf"
-            if not isinstance(url_list, str) or url_list is None:
-                continue
-
-            parsed_list = parse_urls(url_list)
-            if contains_nihgov(parsed_list):
-                try:
-                    nihgov_obj = NIHGov(get_nihgov_url(parsed_list), self.download_dir, unique_pdf_id)
-                    res = nihgov_obj.start_scrape()
-                    if res:
-                        data.loc[idx, 'PDFDownloaded'] = res
-                        print(res, "Source: NIHGov")
-                except Exception as e:
-                    print(e)
-            else:
-                for url in parsed_list:
-                    if not isinstance(url, str):
-                        continue
-                    if "http" not in url:
-                        continue
-                    resolved_url = url_resolver(url, self.url_resolver_session)
-                    if resolved_url:
-                        if "doi" in resolved_url:
-                            resolved_url = url_resolver(resolved_url, self.url_resolver_session)
-                    url_class = url_classifier(resolved_url)
-                    if resolved_url != url:
-                        print("Resolved url: %s -> %s" % (url, resolved_url))
-                    if url_class:
-                        try:
-                            klass = url_class(resolved_url, self.download_dir, unique_pdf_id)
-                            res = klass.start_scrape()
-                            if res:
-                                data.loc[idx, 'PDFDownloaded'] = res
-                                print(res, "Source: %s" % type(klass).__name__)
-                        except Exception as e:
-                            print(e)
+        self.browser_pool = BrowserPool()
+        try:
+            self.download(data)
+        finally:
+            self.browser_pool.close()
+        for session in self.resolver_sessions:
+            session.close()
+        if self.resolver_cache is not None:
+            self.resolver_cache.close()
 
         print(data)
 
@@ -86,6 +301,15 @@ class Downloader:
         data.to_csv(csv_path, index=False, header=True)
 
 
+def pdf_name(row):
+    """
+    Return the file name of the pdf of a csv row, named after its PMID
+    :param row: pandas row
+    :return: str
+    """
+    return get_unique_id_from_url(row['Pubmed link']) + ".pdf"
+
+
 def url_classifier(url):
     if not url:
         return False
@@ -119,27 +343,56 @@ def url_classifier(url):
     return False
 
 
-@retry(Exception, tries=10, delay=0.5, backoff=1)
-def url_resolver(url, session):
+def needs_resolving(url):
+    """
+    Tell whether an url is a redirect to the article, e.g. a DOI or a handle
+    :param url:
+    :return: bool
+    """
     if "hdl.handle.net" in url or "doi.org" in url or "doi.wiley.com" in url:
-        location = session.head(url).headers.get('Location')
-        if location:
-            return location
-        return False
-    if "academic.oup.com" in url and "article-lookup" in url:
-        location = session.head(url).headers.get('Location')
-        if location:
-            if "http" not in location:
-                return "https://academic.oup.com" + location
-            return location
-        return False
+        return True
+    return "academic.oup.com" in url and "article-lookup" in url
 
-    # if "doi" in url:
-    #     return session.head(url).headers.get('Location')
-    # try:
-    #     location = session.head(url).headers.get('Location')
-    #     if location:
-    #         return location
-    #     raise Exception
-    # except Exception:
-    return url
+
+# 429, 5xx and timeouts are already retried by the session
+@retry((requests.ConnectionError, requests.Timeout), tries=3, delay=0.5, backoff=2)
+def redirect_location(url, session):
+    """
+    Return where a redirect url points to
+    :param url:
+    :param session:
+    :return: location, False when the url does not redirect, None when the request failed
+    """
+    res = session.head(url)
+    location = res.headers.get('Location')
+    if not location:
+        # a 4xx or 5xx answer says nothing about the link, only a successful one without redirect does
+        return False if res.status_code < 400 else None
+    if "academic.oup.com" in url and "http" not in location:
+        return "https://academic.oup.com" + location
+    return location
+
+
+def url_resolver(url, session, resolved=None, cache=None):
+    """
+    Resolve a DOI, handle or OUP article-lookup url, other urls are returned unchanged
+    :param url:
+    :param session:
+    :param resolved: optional dict of url -> location already known, filled with the new ones
+    :param cache: optional ResolverCache the new locations are saved to
+    :return: location, False when the url does not redirect or could not be resolved
+    """
+    if not needs_resolving(url):
+        return url
+    if resolved is not None and url in resolved:
+        return resolved[url]
+
+    location = redirect_location(url, session)
+    if location is None:
+        # failed requests are not remembered, the next article or run tries again
+        return False
+    if resolved is not None:
+        resolved[url] = location
+    if cache is not None:
+        cache.put_many({url: location})
+    return location
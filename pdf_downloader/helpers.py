@@ -1,16 +1,29 @@
 import re
+import os
+import hashlib
 import csv
 import pandas as pd
 import time
+import requests
 from functools import wraps
 from pandas.io.excel import ExcelWriter
 from urllib.parse import urlparse
 import shutil
-from .exceptions import CanNotChangeFileName
+from .exceptions import CanNotChangeFileName, NoDownloadableContentFound, DownloadOperationException
 
 
 pd.set_option('display.max_rows', 1000)
 NIHGOV_BASE = "ncbi.nlm.nih.gov"
+PDF_MAGIC = b"%PDF"
+# a pdf header may come after up to 1024 bytes of junk
+MAGIC_WINDOW = 1024
+CHUNK_SIZE = 64 * 1024
+# interrupted transfers resumed before giving up
+DOWNLOAD_ATTEMPTS = 5
+PART_SUFFIX = ".part"
+RESUMABLE_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+# "bytes start-end/total" of a 206 response
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (\d+)-\d+/(\d+)")
 
 
 def retry(ExceptionToCheck, tries=4, delay=3, backoff=2, logger=None):
@@ -81,20 +94,161 @@ def get_nihgov_url(urls: list):
             return url
 
 
-def is_downloadable(session, url):
+def is_downloadable_response(response):
     """
-    Check if the url contains a downloadable resource
+    Check the content type of a response, a text or html body is not a downloadable resource
     """
-    h = session.head(url, allow_redirects=True)
-    header = h.headers
-    content_type = header.get('content-type')
-    if 'text' in content_type.lower():
+    content_type = (response.headers.get('content-type') or '').lower()
+    if 'text' in content_type:
         return False
-    if 'html' in content_type.lower():
+    if 'html' in content_type:
         return False
     return True
 
 
+def pmc_id(value):
+    """
+    Return the PMCID of a csv cell, e.g. "PMC4628785"
+    :param value: cell value, NaN when empty
+    :return: str or None
+    """
+    if not isinstance(value, str):
+        return None
+    # bare digits may be a PMID, which names another article in PMC
+    value = value.strip()
+    if re.fullmatch(r"PMC\d+", value):
+        return value
+    return None
+
+
+def write_pdf_stream(response, writer, check_magic):
+    """
+    Write the body of a response chunk by chunk
+    :param response: streamed requests.Response
+    :param writer: binary file
+    :param check_magic: True at the start of the file, the first bytes must hold the pdf header
+    :return: None
+    """
+    head = b""
+    for chunk in response.iter_content(CHUNK_SIZE):
+        if check_magic:
+            head += chunk
+            if len(head) < MAGIC_WINDOW:
+                continue
+            if PDF_MAGIC not in head[:MAGIC_WINDOW]:
+                raise NoDownloadableContentFound
+            check_magic = False
+            chunk, head = head, b""
+        writer.write(chunk)
+    if check_magic:
+        if PDF_MAGIC not in head:
+            raise NoDownloadableContentFound
+        writer.write(head)
+
+
+def part_path_of(full_path, url):
+    """
+    Return the part file of a download, one per url so a transfer is never resumed from another url's bytes
+    :param full_path: final path of the pdf
+    :param url:
+    :return: str
+    """
+    return "%s.%s%s" % (full_path, hashlib.sha1(url.encode('utf-8')).hexdigest()[:12], PART_SUFFIX)
+
+
+def range_validator(response):
+    """
+    Return the If-Range value of a full response, a strong ETag or else Last-Modified
+    :param response: requests.Response
+    :return: str or None, None when the body cannot be resumed safely
+    """
+    # offsets count the bytes on disk, which are the decoded ones for a compressed body
+    if response.headers.get("Content-Encoding", "identity").lower() != "identity":
+        return None
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+
+def content_range(response):
+    """
+    Return the start and the total length of a partial response
+    :param response: requests.Response
+    :return: tuple of int, (None, None) when the header is missing or the length unknown
+    """
+    match = CONTENT_RANGE_PATTERN.fullmatch(response.headers.get("Content-Range", "").strip())
+    if match is None:
+        return None, None
+    return int(match.group(1)), int(match.group(2))
+
+
+def stream_pdf(session, url, full_path, attempts=DOWNLOAD_ATTEMPTS, timeout=60):
+    """
+    Download a pdf to disk without holding it in memory.
+    The body goes to a part file of the url. An interrupted transfer is resumed with a Range request
+    guarded by If-Range, and only when the server answers for the same bytes of the same file;
+    anything else starts over. The file is renamed to its final name once complete and the part file
+    is removed when the download fails. A response that does not start like a pdf, e.g. a paywall page,
+    is dropped from its headers or its first kilobyte.
+    :param session:
+    :param url:
+    :param full_path: final path of the pdf
+    :param attempts: transfers tried before giving up
+    :param timeout: seconds
+    :return: full_path
+    """
+    part_path = part_path_of(full_path, url)
+    # the validator and the length of the file being written, known from its first response
+    validator = None
+    total = None
+    try:
+        for attempt in range(attempts):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if offset and offset == total:
+                break
+            headers = {"Range": "bytes=%s-" % offset, "If-Range": validator} if offset and validator else {}
+            try:
+                with session.get(url, headers=headers, stream=True, allow_redirects=True, timeout=timeout) as r:
+                    if r.status_code in (206, 416) and not (headers and content_range(r) == (offset, total)):
+                        # a range of another file, or of a file that changed: start over
+                        print("Unexpected range %s, restarting %s" % (r.headers.get("Content-Range"), url))
+                        validator = total = None
+                        if os.path.exists(part_path):
+                            os.remove(part_path)
+                        continue
+                    r.raise_for_status()
+                    if not is_downloadable_response(r):
+                        raise NoDownloadableContentFound
+                    resumed = r.status_code == 206
+                    if not resumed:
+                        validator = range_validator(r)
+                        length = r.headers.get("Content-Length")
+                        total = int(length) if validator and length and length.isdigit() else None
+                        if total is None:
+                            validator = None
+                    with open(part_path, "ab" if resumed else "wb") as writer:
+                        write_pdf_stream(r, writer, check_magic=not resumed)
+                if total is None or os.path.getsize(part_path) == total:
+                    break
+                raise requests.ConnectionError("Transfer ended at %s of %s bytes" % (os.path.getsize(part_path), total))
+            except RESUMABLE_ERRORS as e:
+                if attempt == attempts - 1:
+                    raise
+                if validator is None and os.path.exists(part_path):
+                    os.remove(part_path)
+                print("%s, resuming %s" % (type(e).__name__, url))
+                time.sleep(min(30, 2 ** attempt))
+        else:
+            raise DownloadOperationException("No complete transfer of %s" % url)
+        os.replace(part_path, full_path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return full_path
+
+
 def get_filename_from_cd(cd):
     """
     Get filename from content-disposition
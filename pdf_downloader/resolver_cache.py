@@ -0,0 +1,76 @@
+"""
+    Persistent redirect cache of the url resolver
+
+    DOI, handle and OUP article-lookup redirects are kept in a local SQLite database, so a run downloading
+    articles seen before skips their HEAD requests. Links that did not redirect are kept as negative
+    entries with a shorter lifetime.
+"""
+import os
+import time
+from dotenv import load_dotenv
+from sqlite_db import SQLiteDatabase, chunks
+
+load_dotenv()
+
+RESOLVER_CACHE = os.environ.get('RESOLVER_CACHE', 'on') == 'on'
+RESOLVER_CACHE_PATH = os.environ.get(
+    'RESOLVER_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache', 'resolver.db'))
+# seconds before a redirect is resolved again, DOI targets rarely move
+RESOLVER_TTL = int(os.environ.get('RESOLVER_TTL', 90 * 24 * 3600))
+# seconds before a link without redirect is tried again
+RESOLVER_NEGATIVE_TTL = int(os.environ.get('RESOLVER_NEGATIVE_TTL', 24 * 3600))
+
+
+class ResolverCache(SQLiteDatabase):
+    """
+    SQLite store of url -> redirect location, a NULL location marks a link that did not redirect
+    """
+
+    def __init__(self, path=RESOLVER_CACHE_PATH, ttl=RESOLVER_TTL, negative_ttl=RESOLVER_NEGATIVE_TTL):
+        super(ResolverCache, self).__init__(path)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        connection = self.connection()
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS redirects (
+                    url TEXT PRIMARY KEY,
+                    location TEXT,
+                    fetched_at REAL NOT NULL,
+                    ttl REAL NOT NULL
+                )
+            """)
+
+    def get_many(self, urls):
+        """
+        Return the fresh entries of the given urls
+        :param urls: iterable of urls
+        :return: dict of url -> location, False for a negative entry
+        """
+        urls = list(set(urls))
+        now = time.time()
+        found = {}
+        connection = self.connection()
+        for chunk in chunks(urls):
+            rows = connection.execute(
+                "SELECT url, location FROM redirects WHERE fetched_at + ttl > ? AND url IN (%s)"
+                % ",".join("?" * len(chunk)), [now] + chunk)
+            for url, location in rows:
+                found[url] = location or False
+        return found
+
+    def put_many(self, locations):
+        """
+        Store resolved urls
+        :param locations: dict of url -> location, False when the url did not redirect
+        :return: None
+        """
+        if not locations:
+            return
+        now = time.time()
+        self.connection().executemany(
+            "INSERT OR REPLACE INTO redirects (url, location, fetched_at, ttl) VALUES (?, ?, ?, ?)",
+            [(url, location or None, now, self.ttl if location else self.negative_ttl)
+             for url, location in locations.items()])
@@ -1,31 +1,19 @@
 from .abstract import Site
-import requests
-from bs4 import BeautifulSoup
-import time
 from urllib.parse import urlparse
 import re
-from .exceptions import NoDownloadableContentFound, NoPDFLinkFound, CanNotGetPageSource, DownloadOperationException
-import logging
+from .exceptions import NoPDFLinkFound, CanNotGetPageSource, DownloadOperationException
 import os
-from .helpers import get_filename_from_cd, is_downloadable, retry, rename_file
-from selenium import webdriver
-from .webdriver_utils import get_driver_path
-from selenium.webdriver.chrome.options import Options
+from .helpers import get_filename_from_cd, retry, rename_file
+from .browser_pool import wait_for_download
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from pathlib import Path
+from parsers import make_soup
+from http_cache import new_session
 
 
-driver_path = get_driver_path()
-chrome_options = Options()
-chrome_options.add_argument("--headless")
-chrome_options.add_argument('--disable-gpu')
-chrome_options.add_argument('--disable-software-rasterizer')
-chrome_options.add_argument("--window-size=1920x1080")
-chrome_options.add_argument("--disable-notifications")
-chrome_options.add_argument('--no-sandbox')
-chrome_options.add_argument('--verbose')
+# serves the pdf of a PMC article, redirecting to its file
+PMC_PDF_URL = "https://www.ncbi.nlm.nih.gov/pmc/articles/%s/pdf/"
 
 
 class NIHGov(Site):
@@ -33,16 +21,17 @@ class NIHGov(Site):
         Sample: https://www.ncbi.nlm.nih.gov/pmc/articles/PMC4628785/
     """
 
-    def __init__(self, url, download_dir, pdf_name):
+    def __init__(self, url, download_dir, pdf_name, pmcid=None):
         super().__init__()
         self.url = url
         self.download_path = download_dir
         self.pdf_name = pdf_name
+        self.pmcid = pmcid
 
         self.headers = {
             "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.75 Safari/537.36"
         }
-        self.session = requests.session()
+        self.session = new_session()
         self.session.headers.update(self.headers)
 
     def get_redirect_url(self):
@@ -55,7 +44,7 @@ class NIHGov(Site):
 
     def get_pdf_url(self):
         html = self.get_page_source().content
-        soup = BeautifulSoup(html, "html.parser")
+        soup = make_soup(html)
         elements = soup.find("div", class_="format-menu").find("ul").find_all("li")
 
         for element in elements:
@@ -68,22 +57,24 @@ class NIHGov(Site):
                 return pdf_link
         raise NoPDFLinkFound
 
-    @retry(Exception, tries=5, delay=2)
-    def download_pdf(self, url):
-        downloadable = is_downloadable(self.session, url)
-        if downloadable:
-            r = self.session.get(url, allow_redirects=True)
-            # filename = get_filename_from_cd(r.headers.get('content-disposition'))
-            filename = self.pdf_name
-            full_path = os.path.join(self.download_path, filename)
-            with open(full_path, 'wb') as writer:
-                writer.write(r.content)
-            logging.info("PDF Downloaded")
-            return filename
-        else:
-            raise NoDownloadableContentFound
+    def download_pmc_pdf(self):
+        """
+        Download the pdf straight from the PMCID, without the redirect and the article page
+        :return: file name, False when PMC has no pdf for it
+        """
+        try:
+            return self.download_pdf(PMC_PDF_URL % self.pmcid)
+        except Exception as e:
+            print(e, "No PMC pdf for %s" % self.pmcid)
+            return False
 
     def start_scrape(self):
+        if self.pmcid:
+            res = self.download_pmc_pdf()
+            if res or not self.url:
+                self.session.close()
+                return res
+
         url = self.get_pdf_url()
         if not url:
             raise NoPDFLinkFound
@@ -107,7 +98,7 @@ class WhiteRose(Site):
         self.headers = {
             "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.75 Safari/537.36"
         }
-        self.session = requests.session()
+        self.session = new_session()
         self.session.headers.update(self.headers)
 
     @retry(Exception, tries=5, delay=2)
@@ -116,7 +107,7 @@ class WhiteRose(Site):
 
     def get_pdf_url(self, **args):
         html = self.get_page_source().content
-        soup = BeautifulSoup(html, "html.parser")
+        soup = make_soup(html)
         elements = soup.find_all("a", href=True, text=re.compile("CLICK TO DOWNLOAD"))
         try:
             pdf_link = elements[-1]['href']
@@ -124,21 +115,6 @@ class WhiteRose(Site):
             raise NoPDFLinkFound
         return pdf_link
 
-    @retry(Exception, tries=5, delay=2)
-    def download_pdf(self, url):
-        downloadable = is_downloadable(self.session, url)
-        if downloadable:
-            r = self.session.get(url, allow_redirects=True)
-            # filename = get_filename_from_cd(r.headers.get('content-disposition'))
-            filename = self.pdf_name
-            full_path = os.path.join(self.download_path, filename)
-            with open(full_path, 'wb') as writer:
-                writer.write(r.content)
-            logging.info("PDF Downloaded")
-            return filename
-        else:
-            raise NoDownloadableContentFound
-
     def start_scrape(self):
         url = self.get_pdf_url()
         if not url:
@@ -166,7 +142,7 @@ class UnitoIt(Site):
         self.headers = {
             "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.75 Safari/537.36"
         }
-        self.session = requests.session()
+        self.session = new_session()
         self.session.headers.update(self.headers)
 
     @retry(Exception, tries=5, delay=2)
@@ -175,7 +151,7 @@ class UnitoIt(Site):
 
     def get_pdf_url(self, **args):
         html = self.get_page_source().content
-        soup = BeautifulSoup(html, "html.parser")
+        soup = make_soup(html)
         elements = soup.find("table", class_="table panel-body").find("tr").find_next_siblings("tr")
 
         try:
@@ -190,20 +166,6 @@ class UnitoIt(Site):
         except Exception:
             raise NoPDFLinkFound
 
-    @retry(Exception, tries=5, delay=2)
-    def download_pdf(self, url):
-        downloadable = is_downloadable(self.session, url)
-        if downloadable:
-            r = self.session.get(url, allow_redirects=True)
-            # filename = get_filename_from_cd(r.headers.get('content-disposition'))
-            filename = self.pdf_name
-            full_path = os.path.join(self.download_path, filename)
-            with open(full_path, 'wb') as writer:
-                writer.write(r.content)
-            logging.info("PDF Downloaded")
-            return filename
-        raise NoPDFLinkFound
-
     def start_scrape(self):
         url = self.get_pdf_url()
         if not url:
@@ -228,7 +190,7 @@ class OUP(Site):
         self.headers = {
             "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.75 Safari/537.36"
         }
-        self.session = requests.session()
+        self.session = new_session()
         self.session.headers.update(self.headers)
 
     @retry(Exception, tries=5, delay=2)
@@ -237,7 +199,7 @@ class OUP(Site):
 
     def get_pdf_url(self, **args):
         html = self.get_page_source().content
-        soup = BeautifulSoup(html, "html.parser")
+        soup = make_soup(html)
         pdf_href = soup.find("a", class_="al-link pdf article-pdfLink", href=True)['href']
         try:
             parsed_url = urlparse(self.url)
@@ -248,19 +210,6 @@ class OUP(Site):
         except Exception:
             raise NoPDFLinkFound
 
-    @retry(Exception, tries=5, delay=2)
-    def download_pdf(self, url):
-        downloadable = is_downloadable(self.session, url)
-        if downloadable:
-            r = self.session.get(url, allow_redirects=True)
-            filename = self.pdf_name
-            full_path = os.path.join(self.download_path, filename)
-            with open(full_path, 'wb') as writer:
-                writer.write(r.content)
-            logging.info("PDF Downloaded")
-            return filename
-        raise NoPDFLinkFound
-
     def start_scrape(self):
         url = self.get_pdf_url()
         if not url:
@@ -276,17 +225,22 @@ class AJMC(Site):
             https://www.ajmc.com/view/amyotrophic-lateral-sclerosis-disease-state-overview
             https://www.ajmc.com/view/introduction-to-pseudobulbar-affect-setting-the-stage-for-recognition-and-familiarity-with-this-challenging-disorder
     """
-    def __init__(self, url, download_dir, pdf_name):
+    # the Downloader passes its browser pool to the sites rendering pages in Chrome
+    uses_browser = True
+
+    def __init__(self, url, download_dir, pdf_name, browser_pool):
         super().__init__()
         self.url = url
         self.download_path = download_dir
         self.pdf_name = pdf_name
-        self.driver = webdriver.Chrome(executable_path=get_driver_path(), options=chrome_options)
+        self.browser_pool = browser_pool
+        # leased from the browser pool by start_scrape
+        self.driver = None
 
         self.headers = {
             "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.75 Safari/537.36"
         }
-        self.session = requests.session()
+        self.session = new_session()
         self.session.headers.update(self.headers)
 
     @retry(Exception, tries=5, delay=2)
@@ -297,27 +251,20 @@ class AJMC(Site):
     def get_pdf_url(self, **args):
         try:
             html = self.get_page_source()
-            soup = BeautifulSoup(html, "html.parser")
+            soup = make_soup(html)
             pdf_href = soup.find("figure", class_="d-block pdf-figure figure").find("a", href=True)['href']
             return pdf_href
         except Exception:
             raise NoPDFLinkFound
 
-    @retry(Exception, tries=5, delay=2)
-    def download_pdf(self, url):
-        downloadable = is_downloadable(self.session, url)
-        if downloadable:
-            r = self.session.get(url, allow_redirects=True)
-            filename = self.pdf_name
-            full_path = os.path.join(self.download_path, filename)
-            with open(full_path, 'wb') as writer:
-                writer.write(r.content)
-            logging.info("PDF Downloaded")
-            return filename
-        raise NoPDFLinkFound
-
     def start_scrape(self):
-        url = self.get_pdf_url()
+        # the browser only renders the article page, the pdf itself is fetched by the session
+        with self.browser_pool.lease() as browser:
+            self.driver = browser.driver
+            try:
+                url = self.get_pdf_url()
+            finally:
+                self.driver = None
         if not url:
             raise NoPDFLinkFound
         res = self.download_pdf(url)
@@ -339,7 +286,7 @@ class Nature(Site):
         self.headers = {
             "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.75 Safari/537.36"
         }
-        self.session = requests.session()
+        self.session = new_session()
         self.session.headers.update(self.headers)
 
     @retry(Exception, tries=5, delay=2)
@@ -349,7 +296,7 @@ class Nature(Site):
     def get_pdf_url(self, **args):
         try:
             html = self.get_page_source().content
-            soup = BeautifulSoup(html, "html.parser")
+            soup = make_soup(html)
             pdf_href = soup.find("div", class_="c-pdf-download u-clear-both").find("a", class_="c-pdf-download__link",
                                                                                    href=True)['href']
             parsed_url = urlparse(self.url)
@@ -360,19 +307,6 @@ class Nature(Site):
         except Exception:
             raise NoPDFLinkFound
 
-    @retry(Exception, tries=5, delay=2)
-    def download_pdf(self, url):
-        downloadable = is_downloadable(self.session, url)
-        if downloadable:
-            r = self.session.get(url, allow_redirects=True)
-            filename = self.pdf_name
-            full_path = os.path.join(self.download_path, filename)
-            with open(full_path, 'wb') as writer:
-                writer.write(r.content)
-            logging.info("PDF Downloaded")
-            return filename
-        raise NoPDFLinkFound
-
     def start_scrape(self):
         url = self.get_pdf_url()
         if not url:
@@ -397,7 +331,7 @@ class BMJ(Site):
         self.headers = {
             "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.75 Safari/537.36"
         }
-        self.session = requests.session()
+        self.session = new_session()
         self.session.headers.update(self.headers)
 
     @retry(Exception, tries=5, delay=2)
@@ -406,7 +340,7 @@ class BMJ(Site):
 
     def get_pdf_url(self, **args):
         html = self.get_page_source().content
-        soup = BeautifulSoup(html, "html.parser")
+        soup = make_soup(html)
         pdf_href = soup.find_all("a", class_="article-pdf-download", href=True)
         if len(pdf_href) > 1:
             pdf_href = pdf_href[1]['href']
@@ -423,16 +357,9 @@ class BMJ(Site):
         except Exception:
             raise NoPDFLinkFound
 
-    @retry(Exception, tries=5, delay=2)
     def download_pdf(self, url):
         try:
-            r = self.session.get(url, allow_redirects=True)
-            filename = self.pdf_name
-            full_path = os.path.join(self.download_path, filename)
-            with open(full_path, 'wb') as writer:
-                writer.write(r.content)
-            logging.info("PDF Downloaded")
-            return filename
+            return super().download_pdf(url)
         except Exception:
             raise NoPDFLinkFound
 
@@ -460,7 +387,7 @@ class Biologists(Site):
         self.headers = {
             "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.75 Safari/537.36"
         }
-        self.session = requests.session()
+        self.session = new_session()
         self.session.headers.update(self.headers)
 
     @retry(Exception, tries=5, delay=2)
@@ -469,29 +396,21 @@ class Biologists(Site):
 
     def get_pdf_url(self, **args):
         html = self.get_page_source().content
-        soup = BeautifulSoup(html, "html.parser")
+        soup = make_soup(html)
         pdf_link = soup.find("meta", {"name": "citation_pdf_url"})['content']
 
-        if not is_downloadable(self.session, pdf_link) or pdf_link is None:
+        if pdf_link is None:
             raise NoPDFLinkFound
-
-        pdf_link_with_ds = pdf_link + "?with-ds=yes"
-        if is_downloadable(self.session, pdf_link_with_ds):
-            pdf_link = pdf_link_with_ds
         return pdf_link
 
-    @retry(Exception, tries=5, delay=2)
     def download_pdf(self, url):
-        try:
-            r = self.session.get(url, allow_redirects=True)
-            filename = self.pdf_name
-            full_path = os.path.join(self.download_path, filename)
-            with open(full_path, 'wb') as writer:
-                writer.write(r.content)
-            logging.info("PDF Downloaded")
-            return filename
-        except Exception:
-            raise NoPDFLinkFound
+        # the version with data supplements first, then the plain pdf
+        for pdf_link in (url + "?with-ds=yes", url):
+            try:
+                return super().download_pdf(pdf_link)
+            except Exception:
+                continue
+        raise NoPDFLinkFound
 
     def start_scrape(self):
         url = self.get_pdf_url()
@@ -516,7 +435,7 @@ class Karger(Site):
         self.headers = {
             "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.75 Safari/537.36"
         }
-        self.session = requests.session()
+        self.session = new_session()
         self.session.headers.update(self.headers)
 
     @retry(Exception, tries=5, delay=2)
@@ -525,28 +444,20 @@ class Karger(Site):
 
     def get_pdf_url(self, **args):
         html = self.get_page_source().content
-        soup = BeautifulSoup(html, "html.parser")
-        pdf_href = soup.find("a", {"onclick": "ga('send', 'event', 'FullText', 'Download', 'FullText PDF');"},
-                             href=True)['href']
+        soup = make_soup(html)
+        pdf_anchor = soup.find("a", {"onclick": "ga('send', 'event', 'FullText', 'Download', 'FullText PDF');"},
+                               href=True)
+        if pdf_anchor is None:
+            raise NoPDFLinkFound
 
         parsed_url = urlparse(self.url)
         root_url = "{scheme}://{netloc}".format(scheme=parsed_url.scheme,
                                                 netloc=parsed_url.netloc)
-        pdf_link = root_url + pdf_href
-
-        if is_downloadable(self.session, pdf_link):
-            return pdf_link
-        raise NoPDFLinkFound
+        return root_url + pdf_anchor['href']
 
     def download_pdf(self, url):
         try:
-            r = self.session.get(url, allow_redirects=True)
-            filename = self.pdf_name
-            full_path = os.path.join(self.download_path, filename)
-            with open(full_path, 'wb') as writer:
-                writer.write(r.content)
-            logging.info("PDF Downloaded")
-            return filename
+            return super().download_pdf(url)
         except Exception:
             raise NoPDFLinkFound
 
@@ -566,84 +477,26 @@ class Wiley(Site):
             https://onlinelibrary.wiley.com/doi/full/10.1002/ajh.24300
             https://onlinelibrary.wiley.com/doi/full/10.1111/jnc.13945
     """
-    def __init__(self, url, download_dir, pdf_name):
+    uses_browser = True
+
+    def __init__(self, url, download_dir, pdf_name, browser_pool):
         super().__init__()
         self.url = url
         self.download_path = download_dir
         self.pdf_name = pdf_name
+        self.browser_pool = browser_pool
 
-        chrome_options.add_experimental_option("prefs", {
-            "download.default_directory": self.download_path,
-            "download.prompt_for_download": False,
-            "download.directory_upgrade": True,
-            "safebrowsing_for_trusted_sources_enabled": False,
-            "safebrowsing.enabled": False,
-            "plugins.plugins_list": [{"enabled": False, "name": "Chrome PDF Viewer"}],
-            "download.extensions_to_open": "applications/pdf"
-        })
-
-        self.driver = webdriver.Chrome(executable_path=get_driver_path(), options=chrome_options)
+        # leased from the browser pool by start_scrape
+        self.browser = None
+        self.driver = None
         self.headers = {
             "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.75 Safari/537.36"
         }
-        self.session = requests.session()
+        self.session = new_session()
         self.session.headers.update(self.headers)
 
         self.pdf_url = ""
 
-    def get_downloaded_file_name(self):
-        downloaded_files = os.listdir(self.download_path)
-        for f in downloaded_files:
-            file_name = Path(f).stem
-            # Check if the file name is not an integer
-            try:
-                int(file_name)
-            except Exception:
-                return f
-        return False
-
-
-    """
-        Source: https://stackoverflow.com/a/51949811
-    """
-    def download_wait(self, directory, timeout, nfiles=None):
-        """
-        Wait for downloads to finish with a specified timeout.
-
-        Args
-        ----
-        directory : str
-            The path to the folder where the files will be downloaded.
-        timeout : int
-            How many seconds to wait until timing out.
-        nfiles : int, defaults to None
-            If provided, also wait for the expected number of files.
-
-        """
-        seconds = 0
-        dl_wait = True
-        while dl_wait and seconds < timeout:
-            time.sleep(1)
-            dl_wait = False
-            files = os.listdir(directory)
-            if nfiles and len(files) != nfiles:
-                dl_wait = True
-
-            for fname in files:
-                if fname.endswith('.crdownload'):
-                    dl_wait = True
-
-            seconds += 1
-        return seconds
-
-    """
-        Source: https://medium.com/@moungpeter/how-to-automate-downloading-files-using-python-selenium-and-headless-chrome-9014f0cdd196
-    """
-    def enable_download_headless(self, browser, download_dir):
-        browser.command_executor._commands["send_command"] = ("POST", '/session/$sessionId/chromium/send_command')
-        params = {'cmd': 'Page.setDownloadBehavior', 'params': {'behavior': 'allow', 'downloadPath': download_dir}}
-        browser.execute("send_command", params)
-
     """
         First Step
     """
@@ -654,7 +507,7 @@ class Wiley(Site):
 
     def get_pdf_page_url(self):
         html = self.get_page_source()
-        soup = BeautifulSoup(html, "html.parser")
+        soup = make_soup(html)
         try:
             pdf_href = soup.find("a", href=True, class_="coolBar__ctrl pdf-download")['href']
             if pdf_href is not None:
@@ -673,8 +526,6 @@ class Wiley(Site):
         pass
 
     def download_pdf(self, **args):
-        self.enable_download_headless(self.driver, self.download_path)
-
         try:
             download_button = self.driver.find_element_by_css_selector('#app-navbar > div.btn-group.navbar-right > div.grouped.right > a')
             self.driver.get(download_button.get_attribute("href"))
@@ -682,20 +533,25 @@ class Wiley(Site):
         except Exception as e:
             print("Authorization required to download the PDF")
             raise DownloadOperationException
-        self.download_wait(self.download_path, 30)
-        file_name = self.get_downloaded_file_name()
-        old_path = os.path.join(self.download_path, file_name)
+        old_path = wait_for_download(self.browser.download_dir)
+        if old_path is None:
+            raise DownloadOperationException
         new_path = os.path.join(self.download_path, self.pdf_name)
-        time.sleep(2)
         rename_file(old_path, new_path)
         return self.pdf_name
 
     def start_scrape(self):
-        self.get_page_source()
-        self.get_pdf_page_url()
-        pdf_name = self.download_pdf()
-        self.driver.quit()
-        self.session.close()
+        try:
+            with self.browser_pool.lease() as browser:
+                self.browser = browser
+                self.driver = browser.driver
+                self.get_page_source()
+                self.get_pdf_page_url()
+                pdf_name = self.download_pdf()
+        finally:
+            self.browser = None
+            self.driver = None
+            self.session.close()
         return pdf_name
 
 
@@ -708,7 +564,7 @@ class UnknownSite(Site):
         self.headers = {
             "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.75 Safari/537.36"
         }
-        self.session = requests.session()
+        self.session = new_session()
         self.session.headers.update(self.headers)
 
     def get_page_source(self):
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+    Query planner
+
+    PubMed serves at most 10,000 results per query, through the search pages as well as through esearch.
+    The planner measures the result count of a keyword with a cheap esearch (retmax=0) and splits it
+    into publication-date windows until every shard is under that limit.
+"""
+import os
+from datetime import date, timedelta
+from eutils import EUtilsUnit
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SHARD_LIMIT = int(os.environ.get('SHARD_LIMIT', 10000))
+# shards scraped at the same time, each with its own page concurrency
+SHARD_CONCURRENCY = int(os.environ.get('SHARD_CONCURRENCY', 2))
+# older than the oldest PubMed citation
+MIN_DATE = date(1700, 1, 1)
+DATE_FORMAT = "%Y/%m/%d"
+
+
+def count_results(term):
+    """
+    Return the PubMed result count of a term without fetching any record
+    :param term:
+    :return: int
+    """
+    unit = EUtilsUnit(keyword=term)
+    try:
+        unit.search()
+    finally:
+        unit.session.close()
+    return unit.total_count
+
+
+def date_term(keyword, start, end):
+    """
+    Restrict a keyword to a publication date window
+    :param keyword:
+    :param start: date
+    :param end: date, inclusive
+    :return: string
+    """
+    return '(%s) AND ("%s"[dp] : "%s"[dp])' % (keyword, start.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT))
+
+
+class QueryPlanner:
+    """
+    Split a keyword into shards of at most `limit` results
+    """
+
+    def __init__(self, keyword, limit=SHARD_LIMIT, count=count_results):
+        self.keyword = keyword
+        self.limit = limit
+        self.count = count
+
+    def plan(self):
+        """
+        Return the shards of the keyword
+        :return: list of (term, count)
+        """
+        total_count = self.count(self.keyword)
+        print("Query planner total count %s" % total_count)
+        if total_count <= self.limit:
+            return [(self.keyword, total_count)]
+
+        # records may carry a publication date a bit ahead of today
+        end = date(date.today().year + 1, 12, 31)
+        shards = self.split(MIN_DATE, end)
+        print("Query planner split %s results into %s shards" % (total_count, len(shards)))
+        return shards
+
+    def split(self, start, end):
+        """
+        Bisect a date window until every part is under the limit
+        :param start: date
+        :param end: date, inclusive
+        :return: list of (term, count)
+        """
+        term = date_term(self.keyword, start, end)
+        count = self.count(term)
+        if count == 0:
+            return []
+        if count <= self.limit:
+            return [(term, count)]
+        if start == end:
+            print("%s results published on %s, only the first %s are reachable" % (count, start, self.limit))
+            return [(term, count)]
+
+        middle = start + timedelta(days=(end - start).days // 2)
+        return self.split(start, middle) + self.split(middle + timedelta(days=1), end)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+    Adaptive rate limiter
+
+    Every host gets a token bucket paced at its target rate and an AIMD concurrency window:
+    the window grows by one request per round trip while responses are fast,
+    and halves (with the rate) on 429, 5xx or timeouts. Retry-After pauses the host for the given time.
+    Limits are per process; jobs running several processes hand each one its share with share().
+"""
+import os
+import time
+import random
+import threading
+import requests
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# requests per second per host, HOST_RATE_LIMITS overrides it per host: "host=rate,host=rate"
+RATE_LIMIT = float(os.environ.get('RATE_LIMIT', 5))
+HOST_RATE_LIMITS = dict(
+    (host.strip(), float(rate)) for host, rate in
+    (item.split('=') for item in os.environ.get('HOST_RATE_LIMITS', '').split(',') if '=' in item)
+)
+# requests in flight per host, the AIMD window moves between 1 and this
+MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', 16))
+INITIAL_CONCURRENCY = 4
+# attempts of one request before the error is returned to the caller
+RETRIES = max(1, int(os.environ.get('REQUEST_RETRIES', 5)))
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+# a response slower than this multiple of the average does not grow the window
+SLOW_FACTOR = 2.0
+THROTTLE_STATUS = {429, 500, 502, 503, 504}
+
+
+def retry_after(response):
+    """
+    Return the seconds of a Retry-After header, given as seconds or as an http date
+    :param response: requests.Response
+    :return: float or None
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostLimiter:
+    """
+    Token bucket and AIMD concurrency window of one host
+    """
+
+    def __init__(self, rate, max_concurrency=MAX_CONCURRENCY):
+        self.target_rate = rate
+        self.rate = rate
+        self.max_concurrency = max_concurrency
+        self.window = float(min(INITIAL_CONCURRENCY, max_concurrency))
+        self.in_flight = 0
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.latency = None
+        self.condition = threading.Condition()
+
+    def refill(self, now):
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Block until the host accepts one more request
+        :return: None
+        """
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.refill(now)
+                if self.in_flight < int(self.window) and now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                if self.in_flight >= int(self.window):
+                    self.condition.wait()
+                else:
+                    self.condition.wait(max(self.blocked_until - now, (1 - self.tokens) / self.rate))
+
+    def release(self, latency=None, throttled=False, pause=None):
+        """
+        Give the slot back and adapt window and rate to the outcome of the request
+        :param latency: seconds the request took
+        :param throttled: the host answered 429/5xx or timed out
+        :param pause: seconds the host asked to wait
+        :return: None
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.window = max(1.0, self.window / 2)
+                self.rate = max(self.target_rate / 16, self.rate / 2)
+                if pause:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + pause)
+            elif latency is not None:
+                slow = self.latency is not None and latency > self.latency * SLOW_FACTOR
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                if not slow:
+                    self.window = min(self.max_concurrency, self.window + 1 / self.window)
+                    self.rate = min(self.target_rate, self.rate + self.target_rate / 10)
+            self.condition.notify_all()
+
+
+limiters = {}
+limiters_lock = threading.Lock()
+rate_share = 1.0
+
+
+def share(count):
+    """
+    Give this process 1/count of every host rate, for jobs that run count processes
+    :param count: number of processes
+    :return: None
+    """
+    global rate_share
+    with limiters_lock:
+        rate_share = 1.0 / max(1, count)
+        limiters.clear()
+
+
+def set_rate(host, rate):
+    """
+    Set the target rate of a host, unless HOST_RATE_LIMITS already does
+    :param host:
+    :param rate: requests per second
+    :return: None
+    """
+    HOST_RATE_LIMITS.setdefault(host, rate)
+
+
+def limiter_for(host):
+    """
+    Return the limiter of a host, shared by all sessions of the process
+    :param host:
+    :return: HostLimiter
+    """
+    with limiters_lock:
+        limiter = limiters.get(host)
+        if limiter is None:
+            rate = HOST_RATE_LIMITS.get(host, RATE_LIMIT) * rate_share
+            limiter = limiters[host] = HostLimiter(rate)
+        return limiter
+
+
+class ThrottledSession(requests.Session):
+    """
+    requests session paced by the host limiters, retrying throttled requests with exponential backoff.
+    Redirects are followed after the slot of the first hop is released, every hop takes its own slot.
+    """
+
+    def follow_redirects(self, response, request, **kwargs):
+        """
+        Follow the redirects of a response the way requests.Session.send does
+        :return: final requests.Response, with the hops in its history
+        """
+        history = [hop for hop in self.resolve_redirects(response, request, **kwargs)]
+        if history:
+            history.insert(0, response)
+            response = history.pop()
+            response.history = history
+        return response
+
+    def send(self, request, **kwargs):
+        allow_redirects = kwargs.pop('allow_redirects', True)
+        response = self.send_throttled(request, **kwargs)
+        if allow_redirects:
+            response = self.follow_redirects(response, request, **kwargs)
+        return response
+
+    def send_throttled(self, request, **kwargs):
+        """
+        Send one request without following redirects, retrying timeouts, 429 and 5xx
+        :param request: requests.PreparedRequest
+        :return: requests.Response
+        """
+        limiter = limiter_for(urlsplit(request.url).hostname)
+        for attempt in range(RETRIES):
+            delay = min(MAX_BACKOFF, BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.5)
+            limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = super(ThrottledSession, self).send(request, allow_redirects=False, **kwargs)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                limiter.release(throttled=True)
+                if attempt == RETRIES - 1:
+                    raise
+                print("%s, retrying %s in %.1f seconds" % (type(e).__name__, request.url, delay))
+                time.sleep(delay)
+                continue
+            except Exception:
+                limiter.release()
+                raise
+
+            if response.status_code not in THROTTLE_STATUS:
+                limiter.release(latency=time.monotonic() - start)
+                return response
+
+            pause = retry_after(response)
+            limiter.release(throttled=True, pause=pause)
+            if attempt == RETRIES - 1:
+                return response
+            print("%s, retrying %s in %.1f seconds" % (response.status_code, request.url, pause or delay))
+            response.close()
+            if pause is None:
+                time.sleep(delay)
+        return response
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""
+    Result channel
+
+    Streams parsed rows from scraping workers to the job coordinator as compact batches
+"""
+import queue
+
+# seconds between two checks of the producers while the channel is empty
+POLL_INTERVAL = 0.5
+
+
+class ResultChannel:
+    """
+    Queue of row batches shared by the workers of one job.
+    Rows travel as tuples so the field names are not pickled once per row.
+    Every producer closes its side once; the coordinator drains until all of them are closed.
+    """
+
+    def __init__(self, channel=None, producers=1):
+        """
+        :param channel: queue.Queue for threads or multiprocessing.Queue for processes
+        :param producers: number of producers that will call close()
+        """
+        self.queue = channel if channel is not None else queue.Queue()
+        self.producers = producers
+
+    def send(self, rows):
+        """
+        Send one batch of rows
+        :param rows: list of tuples
+        :return: None
+        """
+        if rows:
+            self.queue.put(rows)
+
+    def close(self):
+        """
+        Mark one producer as finished
+        :return: None
+        """
+        self.queue.put(None)
+
+    def __iter__(self):
+        return self.drain()
+
+    def drain(self, alive=None):
+        """
+        Yield the batches until every producer closed its side
+        :param alive: optional callable, False once no producer runs any more; the batches they sent are
+            still drained, then the iteration ends without waiting for the close() of a killed process
+        :return: generator of lists of tuples
+        """
+        open_producers = self.producers
+        stopped = False
+        while open_producers > 0:
+            try:
+                batch = self.queue.get() if alive is None else self.queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if stopped:
+                    print("%s producers stopped without closing the channel" % open_producers)
+                    return
+                stopped = not alive()
+                continue
+            if batch is None:
+                open_producers -= 1
+                continue
+            yield batch
+
+
+class ResultTable:
+    """
+    Rows of a job stored once, as dicts keyed by the field names.
+    The CSV view and the JSON view are both produced from that single copy.
+    With a sink the rows are written to the CSV stream as they arrive instead, and the JSON view
+    is read back from the finished file. Mirrors get the same batches, e.g. the Excel export.
+    """
+
+    def __init__(self, header, fields, unique=None, unique_key=None, sink=None, mirrors=()):
+        """
+        :param header: CSV header line
+        :param fields: dict keys of a row, in CSV column order
+        :param unique: optional field, or tuple of fields, rows repeating a value already seen are dropped
+        :param unique_key: optional callable turning the tuple of unique values into the dedupe key,
+            a row it returns None for is always kept
+        :param sink: optional csv_stream.CSVStream the rows are appended to
+        :param mirrors: writers with write_rows(rows) that get every batch too
+        """
+        self.header = header
+        self.fields = fields
+        self.sink = sink
+        self.mirrors = list(mirrors)
+        self.count = 0
+        self.rows = []
+        self.unique = None
+        self.unique_key = unique_key
+        if unique is not None:
+            self.unique = [fields.index(field) for field in ((unique,) if isinstance(unique, str) else unique)]
+        self.seen = set()
+
+    def __len__(self):
+        return self.count
+
+    def extend(self, batch):
+        """
+        Add a batch received from the channel
+        :param batch: list of tuples
+        :return: None
+        """
+        fields = self.fields
+        if self.unique is not None:
+            unique_rows = []
+            for row in batch:
+                key = tuple(row[index] for index in self.unique)
+                if self.unique_key is not None:
+                    key = self.unique_key(key)
+                    if key is None:
+                        unique_rows.append(row)
+                        continue
+                if key not in self.seen:
+                    self.seen.add(key)
+                    unique_rows.append(row)
+            batch = unique_rows
+        self.count += len(batch)
+        for mirror in self.mirrors:
+            mirror.write_rows(batch)
+        if self.sink is not None:
+            self.sink.write_rows(batch)
+        else:
+            self.rows.extend(dict(zip(fields, row)) for row in batch)
+
+    def csv_rows(self):
+        """
+        Yield the CSV lines, header first
+        :return: generator
+        """
+        yield self.header
+        for row in self.rows:
+            yield list(row.values())
+
+    def records(self):
+        """
+        Return the rows as JSON-ready dicts
+        :return: list
+        """
+        if self.sink is not None:
+            return [dict(zip(self.fields, row)) for row in self.sink.iter_rows()]
+        return self.rows
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""
+    Work queue scheduler
+
+    Pages and NCT batches are put on one shared queue and pulled by whichever worker is free.
+    A failed task is retried with exponential backoff until it runs out of attempts.
+"""
+import os
+import time
+import queue
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# runs of a task before it is given up
+MAX_ATTEMPTS = int(os.environ.get('TASK_ATTEMPTS', 3))
+BACKOFF = 2.0
+MAX_BACKOFF = 60.0
+# longest nap of a worker waiting for a delayed task
+POLL_INTERVAL = 0.5
+
+
+class WorkersStopped(Exception):
+    """Raised when a worker stopped while the queue still had tasks for it"""
+    pass
+
+
+def backoff_delay(attempt, backoff=BACKOFF):
+    """
+    Return the seconds before the given retry of a task
+    :param attempt: 1 for the first retry
+    :return: float
+    """
+    return min(MAX_BACKOFF, backoff * 2 ** (attempt - 1))
+
+
+class Task:
+    """
+    Payload of a work queue with its attempt count and the time it may run again
+    """
+    __slots__ = ('payload', 'attempt', 'not_before')
+
+    def __init__(self, payload, attempt=0, not_before=0.0):
+        self.payload = payload
+        self.attempt = attempt
+        self.not_before = not_before
+
+    def ready(self):
+        return time.time() >= self.not_before
+
+
+class WorkQueue:
+    """
+    Shared task queue of one job.
+    Works over queue.Queue for threads or multiprocessing.JoinableQueue for processes:
+    close() waits until every task, retries included, is done, then stops the workers.
+    """
+
+    def __init__(self, channel=None, workers=1, max_attempts=MAX_ATTEMPTS, backoff=BACKOFF):
+        """
+        :param channel: queue.Queue or multiprocessing.JoinableQueue, may be bounded
+        :param workers: number of workers pulling from the queue
+        :param max_attempts: runs of a task before it is given up
+        :param backoff: seconds before the first retry, doubled on every further retry
+        """
+        self.queue = channel if channel is not None else queue.Queue()
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+    def put(self, payload, alive=None):
+        """
+        Add a task, blocks while a bounded queue is full
+        :param payload: picklable for process workers
+        :param alive: optional callable, False once a worker stopped; the wait then ends with WorkersStopped
+        :return: None
+        """
+        self.put_item(Task(payload), alive)
+
+    def put_item(self, item, alive=None):
+        """
+        Put a task or a stop marker on the queue
+        :param item: Task or None
+        :param alive: see put()
+        :return: None
+        """
+        if alive is None:
+            self.queue.put(item)
+            return
+        while True:
+            try:
+                self.queue.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                if not alive():
+                    raise WorkersStopped("A worker stopped with the queue full")
+
+    def worker(self):
+        """
+        Return the view of the queue a worker pulls from, create it inside the worker
+        :return: Worker
+        """
+        return Worker(self)
+
+    def close(self, alive=None):
+        """
+        Wait until every task is done, then send the workers their stop marker
+        :param alive: optional callable, False once a worker stopped; the wait then ends with WorkersStopped
+        :return: None
+        """
+        if alive is None:
+            self.queue.join()
+        else:
+            # join() has no timeout, it waits in a helper thread while the workers are watched
+            joined = threading.Thread(target=self.queue.join, daemon=True)
+            joined.start()
+            while True:
+                joined.join(POLL_INTERVAL)
+                if not joined.is_alive():
+                    break
+                if not alive():
+                    raise WorkersStopped("A worker stopped before its tasks were done")
+        for _ in range(self.workers):
+            self.put_item(None, alive)
+
+    def stop(self, alive):
+        """
+        Send the stop markers without waiting for the tasks, once a worker stopped:
+        the workers left finish the queued tasks and quit
+        :param alive: callable, False once no worker runs any more
+        :return: None
+        """
+        try:
+            for _ in range(self.workers):
+                self.put_item(None, alive)
+        except WorkersStopped:
+            pass
+
+
+class Worker:
+    """
+    One worker's side of a work queue.
+    Retries wait in the worker itself rather than on the shared queue: putting them back could block
+    on a bounded queue that only the workers drain. They stay unfinished for close() meanwhile.
+    """
+
+    def __init__(self, work_queue):
+        self.work_queue = work_queue
+        self.queue = work_queue.queue
+        self.delayed = []
+        self.stopped = False
+
+    def next_delayed(self):
+        """
+        Pop the retry that is due first
+        :return: Task
+        """
+        task = min(self.delayed, key=lambda delayed: delayed.not_before)
+        self.delayed.remove(task)
+        return task
+
+    def get(self):
+        """
+        Return the next task, waiting for it if needed, None when the job is over
+        :return: Task or None
+        """
+        while True:
+            if self.delayed:
+                task = min(self.delayed, key=lambda delayed: delayed.not_before)
+                if task.ready() or self.stopped:
+                    self.delayed.remove(task)
+                    time.sleep(max(0.0, task.not_before - time.time()))
+                    return task
+                try:
+                    task = self.queue.get(timeout=min(POLL_INTERVAL, task.not_before - time.time()))
+                except queue.Empty:
+                    continue
+            elif self.stopped:
+                return None
+            else:
+                task = self.queue.get()
+
+            if task is None:
+                # the stop marker only comes once every task is done, retries included
+                self.queue.task_done()
+                self.stopped = True
+                continue
+            return task
+
+    def get_nowait(self):
+        """
+        Return a task that can run right now, or None
+        :return: Task or None
+        """
+        if self.delayed and min(delayed.not_before for delayed in self.delayed) <= time.time():
+            return self.next_delayed()
+        if self.stopped:
+            return None
+        try:
+            task = self.queue.get_nowait()
+        except queue.Empty:
+            return None
+        if task is None:
+            self.queue.task_done()
+            self.stopped = True
+        return task
+
+    def finish(self, task, ok=True, payload=None):
+        """
+        Mark a task as done, or keep it for a retry with backoff when it failed and has attempts left
+        :param task: Task
+        :param ok: False when the task failed
+        :param payload: optional part of the payload to retry instead of all of it
+        :return: None
+        """
+        if not ok:
+            attempt = task.attempt + 1
+            if attempt < self.work_queue.max_attempts:
+                task.payload = task.payload if payload is None else payload
+                task.attempt = attempt
+                task.not_before = time.time() + backoff_delay(attempt, self.work_queue.backoff)
+                self.delayed.append(task)
+                return
+            print("Giving up after %s attempts" % attempt)
+        self.queue.task_done()
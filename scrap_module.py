@@ -2,18 +2,35 @@
 """
     Scraping module for only pumbed
 """
-import requests
-from bs4 import BeautifulSoup
 import time
-import re
-import pandas
-from pandas.io.excel import ExcelWriter
 import os
-import csv
-from multiprocessing import Process, Manager
 import math
 from werkzeug.utils import secure_filename
-from utils import write_csv, excel_out, get_thread_range_pumbed
+from utils import split_affiliations
+from page_engine import PageEngine, CONCURRENCY
+from result_channel import ResultChannel, ResultTable
+from csv_stream import CSVStream
+from xlsx_stream import XLSXStream
+from eutils import EUtilsUnit
+from article_cache import ArticleStore, ARTICLE_CACHE, pmid_from_link, pmid_key
+from http_cache import new_session
+from query_planner import QueryPlanner, SHARD_CONCURRENCY
+from session_pool import SessionPool, CSRF_REJECTED
+from parsers import get_parser, prescan_csrf_token, prescan_results_amount
+import threading
+
+# "html" scrapes the rendered search pages, "eutils" uses esearch/efetch
+BACKEND = os.environ.get('SCRAPING_BACKEND', 'html')
+
+HEADER = [
+    "Pubmed link", "Title", "Date", "Abstract", "Authors", "Author affiliation", "Author email", "PMCID", "DOI",
+    "Full text link", "Mesh terms", "Publication type"
+]
+FIELDS = [
+    "Pubmed link", "heading_title", "date", "abstract", "authors_list", "affiliation", "author_email", "pmcid", "doi",
+    "full_text_links", "mesh_terms", "publication_types"
+]
+PAGE_SIZE = 100
 
 
 class ScrapingUnit:
@@ -21,74 +38,63 @@ class ScrapingUnit:
         Scraping Unit
         """
 
-    def __init__(self, keyword, csrfmiddlewaretoken="", page_number=1, session=None):
+    def __init__(self, keyword, csrfmiddlewaretoken="", page_number=1, session=None, channel=None, store=None):
         self.keyword = keyword
         self.base_url = "https://pubmed.ncbi.nlm.nih.gov/"
         self.csrfmiddlewaretoken = csrfmiddlewaretoken
         self.page_number = page_number
         self.total_count = 0
+        self.channel = channel
+        self.store = store
         self.results_dict = []
-        self.results = []
+        self.parser = get_parser()
 
         if session is None:
-            self.session = requests.session()
+            self.session = new_session()
             headers = {
                 "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36"
             }
 
             res = self.session.get(self.base_url, headers=headers)
-            soup = self.get_soup(res)
-            self.get_middleware_token(soup)
+            self.get_middleware_token(res.text)
         else:
             self.session = session
         self.count = 0
+        # set when PubMed refused the csrf token of the session
+        self.csrf_rejected = False
 
     def get_soup(self, response):
         """
-            Return soup object from http response
+            Return parsed document holding only the result articles of a http response
         :param response:
-        :return: BeautifulSoup4 object
+        :return: document of the configured parser backend
         """
-        return BeautifulSoup(response.text, "html.parser")
+        return self.parser.parse(response.text, articles_only=True)
 
-    def get_middleware_token(self, soup):
+    def get_middleware_token(self, html):
         """
-            Get csrfmiddlewaretoken from Soup
-        :param soup:
+            Get csrfmiddlewaretoken from the page html, without parsing it
+        :param html:
         :return: None
         """
-        try:
-            self.csrfmiddlewaretoken = soup.find('input', {'name': 'csrfmiddlewaretoken'}).attrs['value']
-        except Exception as e:
-            print(e, self.page_number)
+        token = prescan_csrf_token(html)
+        if token is None:
+            print("csrfmiddlewaretoken not found", self.page_number)
+        else:
+            self.csrfmiddlewaretoken = token
 
-    def get_total_count(self, soup):
+    def get_total_count(self, html):
         """
-            Get Total count of search results
-        :param soup:
+            Get Total count of search results from the page html, without parsing it
+        :param html:
         :return: None
         """
-        if soup.find('div', {'class': 'results-amount'}):
-            self.total_count = int(soup.find('div', {'class': 'results-amount'}).
-                               text.strip().replace('results', '').replace(',', '').strip())
+        results_text = prescan_results_amount(html)
+        if results_text is not None:
+            self.total_count = int(results_text.strip().replace('results', '').replace(',', '').strip())
         else:
             self.total_count = 0
 
-    def get_text(self, soup, ele, condition):
-        """
-        Get Text of Element from soup by condition
-        :param soup:
-        :param ele:
-        :param condition:
-        :return: string
-        """
-        try:
-            return soup.find(ele, condition).text.strip()
-        except Exception as e:
-            # print(ele, condition)
-            pass
-        return ""
-
     def ajdust_abstract(self, abstract):
         """
         Remove unnecessary blanks and paragraphs
@@ -104,144 +110,81 @@ class ScrapingUnit:
         full_text += slices[len(slices) - 1].strip()
         return full_text
 
-    def get_affiliations(self, article):
-        """
-        Return affiliation and author email
-        :param article:
-        :return: string, string
-        """
-        affiliations_div = article.find('div', {'class': 'affiliations'})
-        affiliation = ""
-        author_email = []
-        if affiliations_div:
-            first = True
-            for li in affiliations_div.find_all('li'):
-                sup_key = self.get_text(li, 'sup', {})
-                text = li.text.strip()[len(sup_key):]
-                if first:
-                    affiliation = text
-                    first = False
-
-                lst = re.findall('\S+@\S+', text)
-                if len(lst) > 0:
-                    for email in lst:
-                        author_email.append(email.strip().strip(",").strip(".").strip(";"))
-                        text = text.replace(email, '').strip()
-
-                    affiliation = text.replace("Electronic address:", "").replace("Electronic address", '')\
-                        .strip().strip(",").strip(".").strip(";")
-
-        return affiliation, author_email
-
-    def get_date(self, full_view):
-        """
-            Return date of Absctact
-            """
-        text = self.get_text(full_view, 'span', {"class": "cit"})
-        return text.split(";")[0]
-
-    def get_header_information(self, article):
+    def get_header_information(self, fields):
         """
         Return title, DOI, link, author names, abstract, affiliation and author email
-        :param article:
+        :param fields: raw article fields from the parser
         :return: dict
         """
-        full_view = article.find('div', {'class': 'full-view'})
-        heading_title = self.get_text(full_view, 'h1', {'class': 'heading-title'})
-        doi = self.get_text(full_view, 'span', {'class': 'citation-doi'}).strip('doi:')
-        pmid = self.get_text(full_view, 'strong', {'class': 'current-id'})
-        pmcid = self.get_text(full_view, 'span', {'class': 'identifier pmc'}).strip("PMCID:").strip()
-        date = self.get_date(full_view)
-        authors_list = []
-        authors_spans = full_view.find_all('span', {'class': 'authors-list-item'})
-        for author_span in authors_spans:
-            name = self.get_text(author_span, 'a', {'class': 'full-name'})
-            authors_list.append(name)
-
-        abstract = self.get_text(article, 'div', {'class': 'abstract-content selected'}).replace('\n\n', '')
+        abstract = fields['abstract'].replace('\n\n', '')
         abstract = self.ajdust_abstract(abstract)
 
-        affiliation, author_email = self.get_affiliations(article)
+        affiliation, author_email = split_affiliations(fields['affiliations'])
 
         return {
-            "Pubmed link": "%s%s" % (self.base_url, pmid),
-            "heading_title": heading_title,
-            "date": date,
+            "Pubmed link": "%s%s" % (self.base_url, fields['pmid']),
+            "heading_title": fields['title'],
+            "date": fields['cit'].split(";")[0],
             "abstract": abstract,
-            "authors_list": ", \n".join(authors_list),
+            "authors_list": ", \n".join(fields['authors']),
             "affiliation": affiliation,
             "author_email": ", \n".join(author_email),
-            "pmcid": pmcid,
-            "doi": doi,
+            "pmcid": fields['pmcid'].strip("PMCID:").strip(),
+            "doi": fields['doi'].strip('doi:'),
         }
 
-    def get_full_text_links(self, article):
-        """
-        Return full text links from soup
-        :param article:
-        :return: array
+    def build_row(self, article):
         """
-        full_text_links = []
-        full_text_links_list_div = article.find('div', {'class': 'full-text-links-list'})
-        if full_text_links_list_div:
-            atags = full_text_links_list_div.find_all('a')
-            for tag in atags:
-                full_text_links.append(tag.attrs['href'])
-
-        return full_text_links
-
-    def get_mesh_terms(self, article):
-        """
-        Return array of mesh terms from soup
-        :param article:
-        :return: array
-        """
-        mesh_terms = []
-        mesh_div = article.find('div', {'class': 'mesh-terms keywords-section'})
-        if mesh_div:
-            keyword_list = mesh_div.find('ul', {'class': 'keywords-list'})
-            if keyword_list:
-                for button in keyword_list.find_all('button', {'class': 'keyword-actions-trigger'}):
-                    mesh_terms.append(button.text.strip())
-        return mesh_terms
-
-    def get_publication_types(self, article):
-        """
-        Return publication types from soup
-        :param article:
-        :return: array
+        Return the row of one article
+        :param article: article node of the parser backend
+        :return: dict
         """
-        pub_types = []
-        pub_types_div = article.select('div[class*="publication-types keywords-section"]')
-        if len(pub_types_div) > 0:
-            keyword_list = pub_types_div[0].find('ul', {'class': 'keywords-list'})
-            if keyword_list:
-                for button in keyword_list.find_all('button', {'class': 'keyword-actions-trigger'}):
-                    pub_types.append(button.text.strip())
-        return pub_types
+        fields = self.parser.article_fields(article)
+        infor = self.get_header_information(fields)
+        infor['full_text_links'] = ",\n".join(fields['full_text_links'])
+        infor['mesh_terms'] = ", \n".join(fields['mesh_terms'])
+        infor['publication_types'] = ", \n".join(fields['publication_types'])
+        return infor
 
     def parse_soup(self, soup):
         """
         Parse soup object to get necessary information
-        :param soup: BeautifulSoup4 Object
+        :param soup: document of the configured parser backend
         :return: None
         """
-        articles_div = soup.find_all('div', {"class": "results-article"})
         results_data = []
-        for article in articles_div:
-            infor = self.get_header_information(article)
-            infor['full_text_links'] = ",\n".join(self.get_full_text_links(article))
-            infor['mesh_terms'] = ", \n".join(self.get_mesh_terms(article))
-            infor['publication_types'] = ", \n".join(self.get_publication_types(article))
-            results_data.append(infor)
+        for article in self.parser.articles(soup):
+            results_data.append(self.build_row(article))
             self.count += 1
 
-        lines = []
-        for row in results_data:
-            lines.append(list(row.values()))
+        self.emit(results_data)
+
+    def unique_soup(self, soup):
+        """
+        Parse the article page PubMed redirects to when a query matches a single article
+        :param soup: fully parsed document
+        :return: None
+        """
+        infor = self.build_row(soup)
+        if infor["heading_title"]:
+            self.count += 1
+            self.emit([infor])
 
-        self.results_dict += results_data
-        self.results += lines
+    def emit(self, results_data):
+        """
+        Stream parsed rows to the channel, or keep them on the unit when it has none.
+        Rows also go to the article store when the unit has one.
+        :param results_data: list of dicts
+        :return: None
+        """
+        if self.store is not None:
+            # a row whose page had no PMID cannot be looked up again, it is not stored
+            rows = ((pmid_from_link(row["Pubmed link"]), row) for row in results_data)
+            self.store.put_many({pmid: list(row.values()) for pmid, row in rows if pmid})
+        if self.channel is not None:
+            self.channel.send([tuple(row.values()) for row in results_data])
+        else:
+            self.results_dict += results_data
 
     def next_page(self):
         """
@@ -254,7 +197,7 @@ class ScrapingUnit:
         milliseconds = int(round(time.time() * 1000))
         data = {
             "term": self.keyword,
-            "size": 100,
+            "size": PAGE_SIZE,
             "page": self.page_number,
             "no_cache": "yes",
             "no-cache": milliseconds,
@@ -268,25 +211,26 @@ class ScrapingUnit:
             "content-type": "application/x-www-form-urlencoded; charset=UTF-8",
             "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36"
         }
-        res = None
-        while res is None:
-            try:
-                res = self.session.post(url=url, data=data, headers=headers, timeout=60)
-                time.sleep(1)
-            except Exception as e:
-                print(e, self.page_number)
-                time.sleep(1)
+        # pacing and retries are done by the session
+        try:
+            res = self.session.post(url=url, data=data, headers=headers, timeout=60)
+        except Exception as e:
+            print(e, self.page_number)
+            return
+        if res.status_code == CSRF_REJECTED:
+            print("csrfmiddlewaretoken rejected", self.page_number)
+            self.csrf_rejected = True
+            return
 
-        soup = self.get_soup(res)
-        self.get_middleware_token(soup)
-        self.parse_soup(soup)
+        self.get_middleware_token(res.text)
+        self.parse_soup(self.get_soup(res))
 
     def do_scraping(self):
         if self.page_number < 2:
             print("Scraping is starting in page %s" % self.page_number)
             data = {
                 "term": self.keyword,
-                "size": 100,
+                "size": PAGE_SIZE,
                 "format": "abstract"
             }
             headers = {
@@ -295,11 +239,13 @@ class ScrapingUnit:
 
             res = self.session.get(self.base_url, params=data, headers=headers)
             print(res.status_code)
-            soup = self.get_soup(res)
-            self.get_middleware_token(soup)
-            self.get_total_count(soup)
+            self.get_middleware_token(res.text)
+            self.get_total_count(res.text)
             print(self.total_count)
-            self.parse_soup(soup)
+            if self.total_count == 0 and prescan_results_amount(res.text) is None:
+                self.unique_soup(self.parser.parse(res.text))
+            else:
+                self.parse_soup(self.get_soup(res))
         else:
             self.next_page()
             # print(self.results_dict)
@@ -307,84 +253,166 @@ class ScrapingUnit:
         print("Scraping was ended for page %s" % self.page_number)
 
 
-class MultiThread(Process):
+def scrap_page(keyword, pool, page_number, channel, store=None):
     """
-        Threading module
-        """
-    def __init__(self, keyword, csrfmiddlewaretoken, page_range, session, results, results_dict):
-        super(MultiThread, self).__init__()
-        self.page_range = page_range
-        self.keyword = keyword
-        self.csrfmiddlewaretoken = csrfmiddlewaretoken
-        self.session = session
-        self.results = results
-        self.results_dict = results_dict
-
-    def run(self):
-        print(self.page_range)
-        for page_number in self.page_range:
-            unit = ScrapingUnit(keyword=self.keyword,
-                                csrfmiddlewaretoken=self.csrfmiddlewaretoken,
-                                page_number=page_number)
-            while True:
-                unit.do_scraping()
-                if len(unit.results) > 0:
-                    print("Before", page_number, len(self.results), len(self.results_dict))
-                    self.results += unit.results
-                    self.results_dict += unit.results_dict
-                    print("After", page_number, len(self.results), len(self.results_dict))
-                    break
-
-
-def Scraping_Job(keyword, result_folder):
-    dirname = os.path.dirname(__file__)
+    Scrap one result page with a session of the pool, the page engine retries it when it comes back empty
+    :param keyword:
+    :param pool: SessionPool
+    :param page_number:
+    :param channel: ResultChannel the parsed rows are streamed to
+    :param store: optional ArticleStore the parsed rows are saved to
+    :return: ScrapingUnit
+    """
+    pooled = pool.acquire()
+    unit = ScrapingUnit(keyword=keyword,
+                        csrfmiddlewaretoken=pooled.csrfmiddlewaretoken or "",
+                        page_number=page_number,
+                        session=pooled.session,
+                        channel=channel,
+                        store=store)
+    try:
+        unit.do_scraping()
+    finally:
+        pool.release(pooled, token=unit.csrfmiddlewaretoken, stale=unit.csrf_rejected)
+    return unit
+
+
+def page_is_empty(unit):
+    return unit.count == 0
+
+
+def run_eutils(keyword, channel, concurrency):
+    """
+    Fetch every efetch batch of the keyword concurrently
+    :param keyword:
+    :param channel: ResultChannel the parsed rows are streamed to
+    :param concurrency:
+    :return: None
+    """
+    unit = EUtilsUnit(keyword=keyword, channel=channel)
+    unit.search()
+    print("E-utilities total count %s" % unit.total_count)
+    engine = PageEngine(lambda retstart: unit.parse_xml(unit.fetch_batch(retstart)), concurrency=concurrency)
+    engine.run(unit.batch_starts(), lambda retstart, result: None)
+    unit.session.close()
+
+
+def run_cached(keyword, channel, concurrency, store, pool):
+    """
+    Resolve the PMIDs of the keyword, send the stored rows and scrape only the missing articles
+    :param keyword:
+    :param channel: ResultChannel the rows are streamed to
+    :param concurrency:
+    :param store: ArticleStore
+    :param pool: SessionPool
+    :return: False when the PMID set could not be resolved
+    """
+    try:
+        pmids = EUtilsUnit(keyword=keyword).search_ids()
+    except Exception as e:
+        print("PMID resolution failed", e)
+        return False
+
+    cached = store.get_many(pmids)
+    channel.send([tuple(record) for record in cached.values()])
+    missing = [pmid for pmid in pmids if pmid not in cached]
+    print("Article cache", len(pmids), "articles", len(missing), "to fetch", store.stats())
+
+    terms = [" OR ".join("%s[pmid]" % pmid for pmid in missing[start:start + PAGE_SIZE])
+             for start in range(0, len(missing), PAGE_SIZE)]
+    engine = PageEngine(
+        lambda term: scrap_page(term, pool, 1, channel, store=store),
+        concurrency=concurrency,
+        retry_if=page_is_empty
+    )
+    engine.run(terms, lambda term, page_unit: None)
+    return True
+
+
+def run_shard(keyword, channel, concurrency, backend, pool, store=None):
+    """
+    Scrap one query of at most 10,000 results
+    :param keyword:
+    :param channel: ResultChannel the parsed rows are streamed to
+    :param concurrency:
+    :param backend: "html" or "eutils"
+    :param pool: SessionPool the html pages are fetched with
+    :param store: optional ArticleStore
+    :return: None
+    """
+    if backend == "eutils":
+        run_eutils(keyword, channel, concurrency)
+        return
+
+    if store is not None and run_cached(keyword, channel, concurrency, store, pool):
+        return
+
+    unit = scrap_page(keyword, pool, 1, channel)
+    engine = PageEngine(
+        lambda page_number: scrap_page(keyword, pool, page_number, channel),
+        concurrency=concurrency,
+        retry_if=page_is_empty
+    )
+    engine.run(range(2, math.ceil(unit.total_count/PAGE_SIZE) + 1), lambda page_number, page_unit: None)
+
+
+def plan_shards(keyword):
+    """
+    Split the keyword into date shards under the PubMed result window
+    :param keyword:
+    :return: list of terms, the keyword itself when its count cannot be measured
+    """
+    try:
+        return [term for term, count in QueryPlanner(keyword).plan()]
+    except Exception as e:
+        print("Query planning failed", e)
+        return [keyword]
 
-    manager = Manager()
-    results = manager.list()
-    results_dict = manager.list()
-
-    results.append([
-        "Pubmed link", "Title", "Date", "Abstract", "Authors", "Author affiliation", "Author email", "PMCID", "DOI",
-        "Full text link", "Mesh terms", "Publication type"
-    ])
-
-    total_count = 0
-    unit = ScrapingUnit(keyword=keyword)
-    unit.do_scraping()
-    session = unit.session
-
-    results += unit.results
-    results_dict += unit.results_dict
-    total_count += unit.total_count
-    csrfmiddlewaretoken = unit.csrfmiddlewaretoken
-
-    threads = []
-    # Thread count
-    thread_count = 4
-    ranges = get_thread_range_pumbed(thread_count=thread_count, total_count=math.ceil(total_count/100))
-
-    for page_range in ranges:
-        thread = MultiThread(
-            keyword=keyword,
-            csrfmiddlewaretoken=csrfmiddlewaretoken,
-            page_range=page_range,
-            session=session,
-            results=results,
-            results_dict=results_dict
-        )
-        thread.start()
-        threads.append(thread)
-
-    for thread in threads:
-        thread.join()
+
+def Scraping_Job(keyword, result_folder, concurrency=CONCURRENCY, backend=BACKEND):
+    dirname = os.path.dirname(__file__)
 
     file_name = secure_filename(keyword)
     file_name = file_name[:200]
-
     csv_file = os.path.join(dirname, result_folder, "%s.csv" % file_name)
-    write_csv(csv_file, results[:])
-
     excel_relational_path = os.path.join(result_folder, "%s.xlsx" % file_name)
-    excel_absolute_path = os.path.join(dirname, excel_relational_path)
-    excel_out(csv_file, excel_absolute_path)
-    return results_dict[:], excel_relational_path, file_name
+    excel = XLSXStream(os.path.join(dirname, excel_relational_path), HEADER)
+
+    channel = ResultChannel()
+    # date shards do not overlap, but results move between pages while they are scraped
+    table = ResultTable(HEADER, FIELDS, unique="Pubmed link", unique_key=pmid_key,
+                        sink=CSVStream(csv_file, HEADER), mirrors=[excel])
+
+    def run_pages():
+        store = None
+        try:
+            store = ArticleStore(namespace="scrap_module") if ARTICLE_CACHE and backend == "html" else None
+            shards = plan_shards(keyword)
+            shard_concurrency = min(SHARD_CONCURRENCY, len(shards))
+            # one warmed session per page in flight, shared by the shards
+            pool = SessionPool(concurrency * shard_concurrency)
+            engine = PageEngine(
+                lambda term: run_shard(term, channel, concurrency, backend, pool, store),
+                concurrency=shard_concurrency
+            )
+            try:
+                engine.run(shards, lambda term, result: None)
+            finally:
+                pool.close()
+            if store is not None:
+                print("Article cache", store.stats())
+        finally:
+            # the page threads are done, their connections are closed with the store
+            if store is not None:
+                store.close()
+            channel.close()
+
+    producer = threading.Thread(target=run_pages)
+    producer.start()
+    for batch in channel:
+        table.extend(batch)
+        print("Received", len(batch), "Total", len(table))
+    producer.join()
+    table.sink.close()
+    excel.close()
+    return table.records(), excel_relational_path, file_name
@@ -4,18 +4,24 @@
 """
 
 import requests
-from bs4 import BeautifulSoup
 import re
-import pandas
-from pandas.io.excel import ExcelWriter
 import os
-import csv
 import time
+import threading
 from dotenv import load_dotenv
-from multiprocessing import Process, Manager
-import math
+from multiprocessing import Process, Queue, JoinableQueue
 from werkzeug.utils import secure_filename
-from utils import write_csv, excel_out, get_thread_range
+from utils import split_affiliations
+from result_channel import ResultChannel, ResultTable
+from csv_stream import CSVStream
+from xlsx_stream import XLSXStream
+from parsers import get_parser, prescan_csrf_token, prescan_results_amount, ARTICLE_SCOPE
+from eutils import EUtilsUnit, ESEARCH_MAX
+from nct_batcher import NCTBatcher
+from scheduler import WorkQueue, WorkersStopped
+from article_cache import ArticleStore, ARTICLE_CACHE, pmid_key
+from http_cache import new_session
+from rate_limiter import share
 
 
 load_dotenv()
@@ -24,7 +30,24 @@ API_KEY = os.environ.get('API_KEY')
 PREMIUM_PROXY = os.environ.get('PREMIUM_PROXY')
 GENERAL_PROXY = os.environ.get('GENERAL_PROXY')
 CREDENTIAL = os.environ.get('CREDENTIAL')
-NCT_COUNT = 500
+# NCT records per task of the work queue, the processes assemble their batches from these
+NCT_COUNT = 100
+# processes of a job, the host rate limits are split between them
+PROCESS_COUNT = int(os.environ.get('PUBMED_PROCESSES', 5))
+# tasks waiting for a PubMed process, the clinical stage blocks when the queue is full
+BATCH_QUEUE_SIZE = PROCESS_COUNT * 10
+PAGE_SIZE = 200
+NCT_PATTERN = re.compile(r'NCT\d{8}')
+HEADER = [
+    "Pubmed link", "Title", "Date", "Abstract", "Authors", "Author affiliation", "Author email", "PMCID", "DOI",
+    "Full text link", "Mesh terms", "Publication type", "NCT number", "Conditions", "Interventions",
+    "Outcome measures"
+]
+FIELDS = [
+    "Pubmed link", "heading_title", "date", "abstract", "authors_list", "affiliation", "author_email", "pmcid", "doi",
+    "full_text_links", "mesh_terms", "publication_types", "nct_number", "conditions", "interventions",
+    "outcome_measures"
+]
 
 """
 Scraping module extended with Clinical NCT numbers
@@ -32,17 +55,37 @@ It is using for /clinical_scrap route in application
 """
 
 
+def index_nct_records(nct_records):
+    """
+    Index NCT records by NCT number, the first record of a number wins
+    :param nct_records: list of clinical.NCTRecord
+    :return: dict
+    """
+    nct_index = {}
+    for nct in nct_records:
+        nct_index.setdefault(nct.nct_number, nct)
+    return nct_index
+
+
 class ScrapingUnit:
     """Scraping Unit"""
-    def __init__(self, nct_records=None, page_number=1, csrfmiddlewaretoken="", session=None):
+    def __init__(self, nct_records=None, page_number=1, csrfmiddlewaretoken="", session=None, channel=None,
+                 store=None, nct_index=None):
         self.nct_records = nct_records
+        if nct_index is None:
+            nct_index = index_nct_records(nct_records or [])
+        self.nct_index = nct_index
+        # last request failure of do_scraping, reset by the caller
+        self.error = None
         self.base_url = "https://pubmed.ncbi.nlm.nih.gov/"
         self.csrfmiddlewaretoken = csrfmiddlewaretoken
         self.total_count = 0
         self.nct = ''
         self.page_number = page_number
+        self.channel = channel
+        self.store = store
         self.results_dict = []
-        self.results = []
+        self.parser = get_parser()
         self.premium_proxy = {
             'http': 'http://{}@{}'.format(CREDENTIAL, PREMIUM_PROXY),
             'https': 'https://{}@{}'.format(CREDENTIAL, PREMIUM_PROXY)
@@ -53,20 +96,14 @@ class ScrapingUnit:
         }
 
         if session is None:
-            self.session = requests.session()
+            self.session = new_session()
             headers = {
                 "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36"
             }
 
-            while True:
-                try:
-                    res = self.session.get(self.base_url, headers=headers)
-                    soup = self.get_soup(res)
-                    self.get_middleware_token(soup)
-                    break
-                except Exception as e:
-                    print(e)
-                    continue
+            # retried with backoff by the session, a failure here is not transient
+            res = self.session.get(self.base_url, headers=headers, timeout=60)
+            self.get_middleware_token(res.text)
 
         else:
             self.session = session
@@ -74,52 +111,38 @@ class ScrapingUnit:
 
     def get_soup(self, response):
         """
-        Return soup object from http response
+        Return parsed document holding only the result articles of a http response
         :param response
-        :return: BeautifulSoup4 object
+        :return: document of the configured parser backend
         """
-        return BeautifulSoup(response.text, "html.parser")
+        return self.parser.parse(response.text, articles_only=True)
 
-    def get_middleware_token(self, soup):
+    def get_middleware_token(self, html):
         """
-        Get csrfmiddlewaretoken from Soup
-        :param soup
+        Get csrfmiddlewaretoken from the page html, without parsing it
+        :param html
         :return: None
         """
-        try:
-            self.csrfmiddlewaretoken = soup.find('input', {'name': 'csrfmiddlewaretoken'}).attrs['value']
-        except Exception as e:
-            print(e)
+        token = prescan_csrf_token(html)
+        if token is None:
+            print("csrfmiddlewaretoken not found")
+        else:
+            self.csrfmiddlewaretoken = token
 
-    def get_total_count(self, soup):
+    def get_total_count(self, html):
         """
-        Get Total count of search results
-        :param soup
+        Get Total count of search results from the page html, without parsing it
+        :param html
         :return: None
         """
-        try:
-            results_text = soup.find(attrs={'class': 'results-amount'}).text
-            if 'No' in results_text:
-                self.total_count = 0
-            else:
-                self.total_count = int(results_text.replace('results', '').replace(',', '').strip())
-        except Exception as ex:
-            print(type(ex).__name__, ex.args)
+        results_text = prescan_results_amount(html)
+        if results_text is None:
+            # a search matching a single article lands on the article page, which has no results amount
             self.total_count = 1
-
-    def get_text(self, soup, ele, condition):
-        """
-        Get Text of Element from soup by condition
-        :param soup
-        :param ele
-        :param condition
-        :return: string
-        """
-        try:
-            return soup.find(ele, condition).text.strip()
-        except Exception as e:
-            pass
-        return ""
+        elif 'No' in results_text:
+            self.total_count = 0
+        else:
+            self.total_count = int(results_text.replace('results', '').replace(',', '').strip())
 
     def ajdust_abstract(self, abstract):
         """
@@ -136,389 +159,489 @@ class ScrapingUnit:
         full_text += slices[len(slices) - 1].strip()
         return full_text
 
-    def get_affiliations(self, article):
-        """
-        Return affiliation and author email
-        :param article
-        :return: string, string
-        """
-        affiliations_div = article.find('div', {'class': 'affiliations'})
-        affiliation = ""
-        author_email = []
-        if affiliations_div:
-            first = True
-            for li in affiliations_div.find_all('li'):
-                sup_key = self.get_text(li, 'sup', {})
-                text = li.text.strip()[len(sup_key):]
-                if first:
-                    affiliation = text
-                    first = False
-
-                lst = re.findall('\S+@\S+', text)
-                if len(lst) > 0:
-                    for email in lst:
-                        author_email.append(email.strip().strip(",").strip(".").strip(";"))
-                        text = text.replace(email, '').strip()
-
-                    affiliation = text.replace("Electronic address:", "").replace("Electronic address", '')\
-                        .strip().strip(",").strip(".").strip(";")
-
-        return affiliation, author_email
-
-    def get_date(self, full_view):
-        """Return date of Absctact"""
-        text = self.get_text(full_view, 'span', {"class": "cit"})
-        return text.split(";")[0]
-
-    def get_cond_inter_out(self, condition):
-        """Get Conditions from Html content"""
-        conditions = ''
-        condition_soup = BeautifulSoup(condition, 'html.parser')
-        lis = condition_soup.find_all('li')
-        for li in lis:
-            if conditions == '':
-                conditions += li.text.replace('\n', '').strip()
-            else:
-                conditions += ' | {}'.format(li.text.replace('\n', '').strip())
-        return conditions
-
-    def get_header_information(self, article):
+    def get_header_information(self, fields):
         """
         Return title, DOI, link, author names, abstract, affiliation and author email
-        :param article
+        :param fields: raw article fields from the parser
         :return: dict
         """
-        # full_view = article.find('div', {'class': 'full-view'})
-        full_view = article
-        heading_title = self.get_text(full_view, 'h1', {'class': 'heading-title'})
-        doi = self.get_text(full_view, 'span', {'class': 'citation-doi'}).strip('doi:')
-        pmid = self.get_text(full_view, 'strong', {'class': 'current-id'})
-        pmcid = self.get_text(full_view, 'span', {'class': 'identifier pmc'}).strip("PMCID:").strip()
+        pmcid = fields['pmcid'].strip("PMCID:").strip()
         if pmcid == '':
-            pmcid = self.get_text(full_view, 'span', {'class': 'identifier pubmed'}).strip("PMCID:").strip()
-        date = self.get_date(full_view)
-        authors_list = ''
-        authors_spans = full_view.find_all('span', {'class': 'authors-list-item'})
-        for author_span in authors_spans:
-            name = self.get_text(author_span, 'a', {'class': 'full-name'})
-            if authors_list == '':
-                authors_list += name
-            else:
-                authors_list += ' | {}'.format(name)
+            pmcid = fields['pubmed_id'].strip("PMCID:").strip()
 
-        abstract = self.get_text(article, 'div', {'class': 'abstract-content selected'}).replace('\n', ' ')
+        abstract = fields['abstract'].replace('\n', ' ')
         abstract = self.ajdust_abstract(abstract)
 
-        affiliation, author_email = self.get_affiliations(article)
+        affiliation, author_email = split_affiliations(fields['affiliations'])
 
         return {
-            "Pubmed link": "%s%s".strip() % (self.base_url, pmid),
-            "heading_title": heading_title,
-            "date": date,
+            "Pubmed link": "%s%s".strip() % (self.base_url, fields['pmid']),
+            "heading_title": fields['title'],
+            "date": fields['cit'].split(";")[0],
             "abstract": abstract,
-            "authors_list": authors_list,
+            "authors_list": " | ".join(fields['authors']),
             "affiliation": affiliation,
             "author_email": "|".join(author_email),
             "pmcid": pmcid,
-            "doi": doi,
+            "doi": fields['doi'].strip('doi:'),
         }
 
-    def get_full_text_links(self, article):
-        """
-        Return full text links from soup
-        :param article
-        :return: array
-        """
-        full_text_links = []
-        full_text_links_list_div = article.find('div', {'class': 'full-text-links-list'})
-        if full_text_links_list_div:
-            atags = full_text_links_list_div.find_all('a')
-            for tag in atags:
-                full_text_links.append(tag.attrs['href'])
-
-        return full_text_links
-
-    def get_mesh_terms(self, article):
-        """
-        Return array of mesh terms from soup
-        :param article
-        :return: array
-        """
-        mesh_terms = []
-        mesh_div = article.find('div', {'class': 'mesh-terms keywords-section'})
-        if mesh_div:
-            keyword_list = mesh_div.find('ul', {'class': 'keywords-list'})
-            if keyword_list:
-                for button in keyword_list.find_all('button', {'class': 'keyword-actions-trigger'}):
-                    mesh_terms.append(button.text.strip())
-        return mesh_terms
-
-    def get_publication_types(self, article):
-        """
-        Return publication types from soup
-        :param article
-        :return: array
-        """
-        pub_types = []
-        pub_types_div = article.select('div[class*="publication-types keywords-section"]')
-        if len(pub_types_div) > 0:
-            keyword_list = pub_types_div[0].find('ul', {'class': 'keywords-list'})
-            if keyword_list:
-                for button in keyword_list.find_all('button', {'class': 'keyword-actions-trigger'}):
-                    pub_types.append(button.text.strip())
-        return pub_types
-
-    def get_NCT(self, article):
-        article_text = article.text
-        for nct in self.nct_records:
-            if nct[1] in article_text:
-                return nct
+    def cited_trials(self, article):
+        """
+        Return the NCT numbers an article cites, in order of appearance
+        :param article: article node of the parser backend
+        :return: list
+        """
+        return list(dict.fromkeys(NCT_PATTERN.findall(self.parser.text(article))))
 
-    def parse_soup(self, soup):
+    def article_record(self, article, nct_ids):
         """
-        Parse soup object to get necessary information
-        :param soup: BeautifulSoup4 Object
-        :return: None
+        Return the NCT independent part of an article, as kept in the article store
+        :param article: article node of the parser backend
+        :param nct_ids: NCT numbers cited by the article
+        :return: dict with the pmid, the first 12 columns and the NCT numbers cited by the article
         """
-        articles_div = soup.find_all('div', {"class": "results-article"})
-        results_data = []
-        for article in articles_div:
-            infor = self.get_header_information(article)
-            infor['full_text_links'] = " | ".join(self.get_full_text_links(article))
-            infor['mesh_terms'] = " | ".join(self.get_mesh_terms(article))
-            infor['publication_types'] = " | ".join(self.get_publication_types(article))
-            infor['nct_number'] = self.get_NCT(article)
-            if infor['nct_number'] is not None:
-                infor['nct_number'] = infor['nct_number'][1]
-            else:
-                continue
-            infor['conditions'] = self.get_cond_inter_out(self.get_NCT(article)[4])
-            infor['interventions'] = self.get_cond_inter_out(self.get_NCT(article)[5])
-            infor['outcome_measures'] = self.get_cond_inter_out(self.get_NCT(article)[11]).replace('●', '').strip()
-            results_data.append(infor)
-            self.count += 1
+        # the header and authors are read from the whole article, not only its div.full-view
+        fields = self.parser.article_fields(article, header_scope=ARTICLE_SCOPE)
+        infor = self.get_header_information(fields)
+        infor['full_text_links'] = " | ".join(fields['full_text_links'])
+        infor['mesh_terms'] = " | ".join(fields['mesh_terms'])
+        infor['publication_types'] = " | ".join(fields['publication_types'])
+        return {
+            "pmid": fields['pmid'],
+            "row": list(infor.values()),
+            "nct_ids": nct_ids,
+        }
 
-        lines = []
-        for row in results_data:
-            lines.append(list(row.values()))
+    def rows_from_record(self, record):
+        """
+        Join an article record with every NCT record of the job it cites
+        :param record: dict returned by article_record
+        :return: list of dicts, one per matched trial
+        """
+        rows = []
+        for nct_id in record['nct_ids']:
+            nct = self.nct_index.get(nct_id)
+            if nct is None:
+                continue
+            infor = dict(zip(FIELDS, record['row']))
+            infor['nct_number'] = nct.nct_number
+            infor['conditions'] = nct.conditions
+            infor['interventions'] = nct.interventions
+            infor['outcome_measures'] = nct.outcome_measures
+            rows.append(infor)
+        return rows
+
+    def rows_from_records(self, records):
+        """
+        Return the rows of article records cited by the NCT records
+        :param records: list of dicts returned by article_record
+        :return: list of dicts
+        """
+        rows = []
+        for record in records:
+            rows += self.rows_from_record(record)
+        return rows
 
-        self.results_dict += results_data
-        self.results += lines
+    def emit_records(self, records):
+        """
+        Emit the rows of article records cited by the NCT records
+        :param records: list of dicts returned by article_record
+        :return: None
+        """
+        rows = self.rows_from_records(records)
+        self.count += len(rows)
+        self.emit(rows)
 
-    def unique_soup(self, soup):
-        results_data = []
-        infor = self.get_header_information(soup)
-        infor['full_text_links'] = " | ".join(self.get_full_text_links(soup))
-        infor['mesh_terms'] = " | ".join(self.get_mesh_terms(soup))
-        infor['publication_types'] = " | ".join(self.get_publication_types(soup))
-        infor['nct_number'] = self.get_NCT(soup)[1]
-        infor['conditions'] = self.get_cond_inter_out(self.get_NCT(soup)[4])
-        infor['interventions'] = self.get_cond_inter_out(self.get_NCT(soup)[5])
-        infor['outcome_measures'] = self.get_cond_inter_out(self.get_NCT(soup)[11]).replace('●', '').strip()
-        results_data.append(infor)
-        self.count += 1
-
-        lines = []
-        for row in results_data:
-            lines.append(list(row.values()))
-
-        self.results_dict += results_data
-        self.results += lines
-
-    def next_page(self, keyword):
-        """
-            Scrap Next page
-        """
-
-        print("Scraping is starting in page %s" % self.page_number)
-
-        url = "%smore/" % self.base_url
-        milliseconds = int(round(time.time() * 1000))
-        data = {
-            "term": keyword,
-            "size": 200,
-            "page": self.page_number,
-            "no_cache": "yes",
-            "no-cache": milliseconds,
-            "csrfmiddlewaretoken": self.csrfmiddlewaretoken,
-            "format": "abstract"
-        }
+    def parse_articles(self, articles):
+        """
+        Return the rows of the given articles, the store keeps every article, cited trials or not
+        :param articles: article nodes of the parser backend
+        :return: list of dicts
+        """
+        records = []
+        for article in articles:
+            nct_ids = self.cited_trials(article)
+            if self.store is None and not any(nct_id in self.nct_index for nct_id in nct_ids):
+                continue
+            records.append(self.article_record(article, nct_ids))
 
-        headers = {
-            "referer": "https://pubmed.ncbi.nlm.nih.gov/?term=%s&size=200&pos=%s" % (keyword, self.page_number - 1),
-            "origin": "https://pubmed.ncbi.nlm.nih.gov",
-            "content-type": "application/x-www-form-urlencoded; charset=UTF-8",
-            "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36"
-        }
-        res = None
-        while res is None:
-            try:
-                res = self.session.post(url=url, data=data, headers=headers, timeout=60)
-            except Exception as e:
-                print(e, self.page_number)
+        if self.store is not None:
+            self.store.put_many({record['pmid']: record for record in records if record['pmid']})
+        return self.rows_from_records(records)
 
-        soup = self.get_soup(res)
-        self.get_middleware_token(soup)
-        self.parse_soup(soup)
+    def parse_soup(self, soup):
+        """
+        Parse soup object to get necessary information
+        :param soup: document of the configured parser backend
+        :return: list of dicts
+        """
+        return self.parse_articles(self.parser.articles(soup))
 
-        print("Scraping was ended for page %s" % self.page_number)
-        if self.total_count > self.page_number * 200:
-            self.page_number += 1
-            return self.next_page(keyword=keyword)
+    def emit(self, results_data):
+        """
+        Stream parsed rows to the channel, or keep them on the unit when it has none
+        :param results_data: list of dicts
+        :return: None
+        """
+        if self.channel is not None:
+            self.channel.send([tuple(row.values()) for row in results_data])
+        else:
+            self.results_dict += results_data
 
-        return None
+    def unique_soup(self, soup):
+        return self.parse_articles([soup])
 
-    def do_scraping(self, keyword=None):
+    def fetch_page(self, keyword):
+        """
+        Fetch the current result page, the first one from the search page, the next ones from /more/
+        :param keyword:
+        :return: requests.Response, None when the request failed
+        """
         if self.page_number < 2:
-            print("Scraping is starting in page %s" % self.page_number)
+            url = self.base_url
             data = {
                 "term": keyword,
-                "size": 200,
+                "size": PAGE_SIZE,
                 "format": "abstract",
             }
             headers = {
                 "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/86.0.4240.183 Safari/537.36"
             }
+        else:
+            url = "%smore/" % self.base_url
+            milliseconds = int(round(time.time() * 1000))
+            data = {
+                "term": keyword,
+                "size": PAGE_SIZE,
+                "page": self.page_number,
+                "no_cache": "yes",
+                "no-cache": milliseconds,
+                "csrfmiddlewaretoken": self.csrfmiddlewaretoken,
+                "format": "abstract"
+            }
+            headers = {
+                "referer": "https://pubmed.ncbi.nlm.nih.gov/?term=%s&size=200&pos=%s" % (keyword, self.page_number - 1),
+                "origin": "https://pubmed.ncbi.nlm.nih.gov",
+                "content-type": "application/x-www-form-urlencoded; charset=UTF-8",
+                "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36"
+            }
 
-            while True:
-                try:
-                    res = self.session.get(self.base_url, params=data, headers=headers)
-                    if res.status_code != requests.codes.ok:
-                        print("Scraping was ended for page %s" % self.page_number)
-                        return None
-                    soup = self.get_soup(res)
-                    self.get_middleware_token(soup)
-                    self.get_total_count(soup)
-                    if self.total_count == 0:
-                        print("Scraping was ended for page %s" % self.page_number)
-                        return None
-                    if self.total_count == 1:
-                        self.unique_soup(soup)
-                    else:
-                        self.parse_soup(soup)
-                    break
-                except Exception as e:
-                    print(e, keyword)
-                    time.sleep(1)
-                    continue
+        try:
+            if self.page_number < 2:
+                res = self.session.get(url, params=data, headers=headers, timeout=60)
+            else:
+                res = self.session.post(url=url, data=data, headers=headers, timeout=60)
+        except Exception as e:
+            print(e, keyword)
+            self.error = e
+            return None
+        if res.status_code != requests.codes.ok:
+            self.error = res.status_code
+            return None
+        return res
+
+    def iter_pages(self, keyword):
+        """
+        Yield the rows of the query page by page, starting at the current page_number.
+        Stopping the iteration stops the scraping, nothing is kept on the unit.
+        :param keyword:
+        :return: generator of lists of dicts
+        """
+        while True:
+            print("Scraping is starting in page %s" % self.page_number)
+            res = self.fetch_page(keyword)
+            if res is None:
+                print("Scraping was ended for page %s" % self.page_number)
+                return
+            self.get_middleware_token(res.text)
+            if self.page_number < 2:
+                self.get_total_count(res.text)
+                if self.total_count == 0:
+                    print("Scraping was ended for page %s" % self.page_number)
+                    return
+
+            try:
+                if self.page_number < 2 and self.total_count == 1:
+                    # single article page, there is no results-article to restrict the parse to
+                    rows = self.unique_soup(self.parser.parse(res.text))
+                else:
+                    rows = self.parse_soup(self.get_soup(res))
+            except Exception as e:
+                print(e, keyword)
+                self.error = e
+                rows = []
 
             print("Scraping was ended for page %s" % self.page_number)
-            if self.total_count > self.page_number * 200:
-                self.page_number += 1
-                return self.do_scraping(keyword=keyword)
-            return None
-        else:
-            self.next_page(keyword=keyword)
+            yield rows
+            if self.total_count <= self.page_number * PAGE_SIZE:
+                return
+            self.page_number += 1
+
+    def do_scraping(self, keyword=None):
+        """
+        Emit the rows of every page of the query
+        :param keyword:
+        :return: None
+        """
+        for rows in self.iter_pages(keyword):
+            self.count += len(rows)
+            self.emit(rows)
 
 
 class MultiThread(Process):
     """
         Threading module
+        Scrapes the NCT records of the shared work queue in batches sized by an NCTBatcher
         """
-    def __init__(self, nct_records, csrfmiddlewaretoken, _range, session, results, results_dict):
+    def __init__(self, work_queue, csrfmiddlewaretoken, channel, processes=1):
         super(MultiThread, self).__init__()
-        self._range = _range
-        self.nct_records = nct_records
-        self._rearrange = []
+        self.work_queue = work_queue
+        self.processes = processes
         self.csrfmiddlewaretoken = csrfmiddlewaretoken
-        self.session = session
-        self.results = results
-        self.results_dict = results_dict
+        self.channel = channel
+        self.batcher = NCTBatcher()
 
-    def make_rearrange(self):
-        count = len(self._range)  # NCT_COUNT + 1
+    def scrap_pmids(self, unit, query, store):
+        """
+        Resolve the PMIDs of a query with a POST to esearch, emit the stored articles and scrape the missing ones
+        :param unit: ScrapingUnit
+        :param query:
+        :param store: ArticleStore or None
+        :return: True when done, False when the results are truncated or a page failed, None when esearch failed
+        """
+        search = EUtilsUnit(keyword=query)
+        try:
+            pmids = search.search_ids()
+        except Exception as e:
+            print("PMID resolution failed", e)
+            return None
+        finally:
+            search.session.close()
+        if search.total_count > len(pmids):
+            print("Batch matches %s articles, more than esearch returns" % search.total_count)
+            return False
+
+        cached = store.get_many(pmids) if store is not None else {}
+        unit.emit_records(list(cached.values()))
+        missing = [pmid for pmid in pmids if pmid not in cached]
+        print("Batch matches", len(pmids), "articles", len(missing), "to fetch")
+        for start in range(0, len(missing), PAGE_SIZE):
+            unit.page_number = 1
+            unit.do_scraping(keyword=" OR ".join("%s[pmid]" % pmid for pmid in missing[start:start + PAGE_SIZE]))
+        return unit.error is None
+
+    def scrap_batch(self, unit, batch, store):
+        """
+        Scrap the articles citing the trials of one batch
+        :param unit: ScrapingUnit
+        :param batch: list of NCTRecord
+        :param store: ArticleStore or None
+        :return: False when the batch failed or its results were truncated
+        """
+        # articles are matched against the trials of their batch only, an article citing trials
+        # of several batches is found again by the queries of the other batches
+        unit.nct_records = batch
+        unit.nct_index = index_nct_records(batch)
+        unit.error = None
+        query = self.batcher.query(batch)
+        print("Batch of %s NCT records, %s to %s" % (len(batch), batch[0].nct_number, batch[-1].nct_number))
+
+        if store is not None or not self.batcher.fits_get(query):
+            done = self.scrap_pmids(unit, query, store)
+            if done is not None or not self.batcher.fits_get(query):
+                return bool(done)
+
+        unit.page_number = 1
+        unit.do_scraping(keyword=query)
+        # PubMed does not page past 10,000 results
+        return unit.error is None and unit.total_count <= ESEARCH_MAX
+
+    def run_batch(self, unit, batch, store):
+        """
+        Scrap a batch, splitting it in half while it fails
+        :return: list of NCTRecord that still failed on their own
+        """
+        failed = []
+        pending = [batch]
+        while pending:
+            batch = pending.pop()
+            start = time.monotonic()
+            try:
+                ok = self.scrap_batch(unit, batch, store)
+            except Exception as e:
+                print(e, len(batch))
+                ok = False
+            self.batcher.observe(len(batch), time.monotonic() - start, ok)
+            if not ok:
+                halves = self.batcher.split(batch)
+                if not halves:
+                    failed += batch
+                pending.extend(reversed(halves))
+        return failed
 
-        # if count of range is less than NCT_COUNT, it will be added directly.
-        if len(self._range) < NCT_COUNT:
-            self._rearrange = [self._range]
-        else:
-            for i in range(count):
-                item = []
-                if i == count-1:
-                    for j in range(i*NCT_COUNT, len(self._range)):
-                        item.append(self._range[j])
-                else:
-                    for j in range(i*NCT_COUNT, (i+1)*NCT_COUNT):
-                        item.append(self._range[j])
-                self._rearrange.append(item)
-        # print(self._rearrange)
-
-    def make_query(self, _ran):
-        query = '('
-        for i in _ran:
-            query += '(' + self.nct_records[i][1] + ') OR '
-        print(query[:-4] + ")")
-        return query[:-4] + ")"
-        # return query[:-4] + """) AND ((clinicalstudy[Filter] OR clinicaltrial[Filter] OR clinicaltrialphasei[Filter] OR
-        #         clinicaltrialphaseii[Filter] OR clinicaltrialphaseiii[Filter] OR clinicaltrialphaseiv[Filter]
-        #         OR controlledclinicaltrial[Filter] OR pragmaticclinicaltrial[Filter]))"""
+    def run(self):
+        try:
+            share(self.processes)
+            # the store is opened in the child process, sqlite connections do not survive a fork
+            store = ArticleStore(namespace="scrap_pubmed") if ARTICLE_CACHE else None
+            unit = ScrapingUnit(csrfmiddlewaretoken=self.csrfmiddlewaretoken, channel=self.channel, store=store)
+            worker = self.work_queue.worker()
+            for task in iter(worker.get, None):
+                # take a full batch, or whatever arrived when the clinical stage is behind
+                tasks = [task]
+                while sum(len(queued.payload) for queued in tasks) < self.batcher.size:
+                    queued = worker.get_nowait()
+                    if queued is None:
+                        break
+                    tasks.append(queued)
+
+                records = [nct for task in tasks for nct in task.payload]
+                failed = set()
+                # the tasks are always finished, else close() waits for them forever
+                try:
+                    while records:
+                        # without the article store a batch goes through the search page, its term must fit the url
+                        size = self.batcher.batch_size(records, get=store is None)
+                        batch, records = records[:size], records[size:]
+                        failed.update(nct.nct_number for nct in self.run_batch(unit, batch, store))
+                except Exception as e:
+                    print("Batch failed", e)
+                    failed.update(nct.nct_number for nct in batch + records)
+                for task in tasks:
+                    retry = [nct for nct in task.payload if nct.nct_number in failed]
+                    worker.finish(task, ok=not retry, payload=retry)
+            if store is not None:
+                print("Article cache", store.stats())
+                store.close()
+        finally:
+            self.channel.close()
+
+
+class BatchFeeder(threading.Thread):
+    """
+    Groups the NCT records into tasks as they arrive from the clinical stage.
+    put() blocks while the queue is full, which holds the clinical stage back when PubMed falls behind.
+    The records fed so far and the error that stopped the job are kept for it.
+    """
+
+    def __init__(self, numbers, work_queue, workers=()):
+        """
+        :param numbers: iterable of NCTRecord
+        :param work_queue: WorkQueue over a bounded JoinableQueue, closed once the records are exhausted
+        :param workers: processes pulling from the queue, the feeder stops waiting when one of them died
+        """
+        super(BatchFeeder, self).__init__()
+        self.numbers = numbers
+        self.work_queue = work_queue
+        self.workers = workers
+        self.count = 0
+        self.error = None
+
+    def all_alive(self):
+        return all(worker.is_alive() for worker in self.workers)
+
+    def any_alive(self):
+        return any(worker.is_alive() for worker in self.workers)
+
+    def feed(self):
+        """
+        Put the records on the queue in tasks of NCT_COUNT
+        :return: None
+        """
+        batch = []
+        try:
+            for nct in self.numbers:
+                batch.append(nct)
+                self.count += 1
+                if len(batch) == NCT_COUNT:
+                    self.work_queue.put(batch, alive=self.all_alive)
+                    batch = []
+        except WorkersStopped:
+            raise
+        except Exception as e:
+            print("Clinical stage failed after %s NCT records" % self.count, e)
+            self.error = e
+        # the records received before a failure are scraped too
+        if batch:
+            self.work_queue.put(batch, alive=self.all_alive)
 
     def run(self):
-        self.make_rearrange()
-        unit = ScrapingUnit(nct_records=self.nct_records, csrfmiddlewaretoken=self.csrfmiddlewaretoken)
-        for _ran in self._rearrange:
-            # print()
-            # print(self.make_query(_ran))
-            # print()
-            unit.do_scraping(keyword=self.make_query(_ran))
-            if len(unit.results) > 0:
-                print("Before", len(self.results), len(self.results_dict))
-                self.results += unit.results
-                self.results_dict += unit.results_dict
-                print("After", len(self.results), len(self.results_dict))
+        try:
+            self.feed()
+            self.work_queue.close(alive=self.all_alive)
+        except WorkersStopped as e:
+            print(e)
+            self.error = self.error or e
+            self.work_queue.stop(alive=self.any_alive)
+        finally:
+            # ends the clinical stream, e.g. the page prefetching of the API client
+            close = getattr(self.numbers, 'close', None)
+            if close is not None:
+                close()
+        print("Clinical stage finished with %s NCT records" % self.count)
 
 
 def Pubmed_Job(keyword, numbers, result_folder):
     """
     Scraping module extended with Clinical NCT numbers
+    :param keyword: dict with conditions_disease and other_terms
+    :param numbers: iterable of NCTRecord, consumed while the PubMed stage is already running
+    :param result_folder:
+    :return: records, excel file, file name; the excel file is empty when no NCT record arrived.
+        An error of the clinical stage is raised once the batches fed before it are scraped and saved.
     """
     dir_name = os.path.dirname(__file__)
 
-    manager = Manager()
-    results = manager.list()
-    results_dict = manager.list()
+    keyword = '{} {}'.format(keyword['conditions_disease'], keyword['other_terms'])
+    file_name = secure_filename(keyword)
+    file_name = file_name[:200]
+    csv_file = os.path.join(dir_name, result_folder, "%s.csv" % file_name)
+    excel_relational_path = os.path.join(result_folder, "%s.xlsx" % file_name)
+    excel = XLSXStream(os.path.join(dir_name, excel_relational_path), HEADER)
 
-    results.append([
-        "Pubmed link", "Title", "Date", "Abstract", "Authors", "Author affiliation", "Author email", "PMCID", "DOI",
-        "Full text link", "Mesh terms", "Publication type", "NCT number", "Conditions", "Interventions",
-        "Outcome measures"
-    ])
+    # an article citing trials of several batches is found by each of those batch queries
+    table = ResultTable(HEADER, FIELDS, unique=("Pubmed link", "nct_number"), unique_key=pmid_key,
+                        sink=CSVStream(csv_file, HEADER), mirrors=[excel])
 
     unit = ScrapingUnit()
-    session = unit.session
     csrfmiddlewaretoken = unit.csrfmiddlewaretoken
 
+    process_count = PROCESS_COUNT
+    work_queue = WorkQueue(JoinableQueue(maxsize=BATCH_QUEUE_SIZE), workers=process_count)
+    channel = ResultChannel(Queue(), producers=process_count)
     threads = []
-    # Thread count
-    thread_count = 5
-    ranges = get_thread_range(thread_count=thread_count, total_count=math.ceil(len(numbers)))
-    print('Thread ranges', ranges)
-
-    for _range in ranges:
-        if len(_range) > 0:
-            thread = MultiThread(
-                nct_records=numbers,
-                csrfmiddlewaretoken=csrfmiddlewaretoken,
-                _range=_range,
-                session=session,
-                results=results,
-                results_dict=results_dict
-            )
-            thread.start()
-            threads.append(thread)
-
+    for _ in range(process_count):
+        thread = MultiThread(
+            work_queue=work_queue,
+            csrfmiddlewaretoken=csrfmiddlewaretoken,
+            channel=channel,
+            processes=process_count
+        )
+        thread.start()
+        threads.append(thread)
+
+    feeder = BatchFeeder(numbers, work_queue, workers=threads)
+    feeder.start()
+
+    # drain before joining, a process cannot exit while its queue buffer is unflushed
+    for batch in channel.drain(alive=feeder.any_alive):
+        table.extend(batch)
+        print("Received", len(batch), "Total", len(table))
+
+    feeder.join()
     for thread in threads:
         thread.join()
 
-    keyword = '{} {}'.format(keyword['conditions_disease'], keyword['other_terms'])
-
-    file_name = secure_filename(keyword)
-    file_name = file_name[:200]
-
-    csv_file = os.path.join(dir_name, result_folder, "%s.csv" % file_name)
-    write_csv(csv_file, results[:])
-
-    excel_relational_path = os.path.join(result_folder, "%s.xlsx" % file_name)
-    excel_absolute_path = os.path.join(dir_name, excel_relational_path)
-    excel_out(csv_file, excel_absolute_path)
-    return results_dict[:], excel_relational_path, file_name
+    if feeder.count == 0:
+        table.sink.discard()
+        excel.discard()
+    else:
+        table.sink.close()
+        excel.close()
+    if feeder.error is not None:
+        # the files keep the batches scraped before the failure, the request reports the error
+        raise feeder.error
+    if feeder.count == 0:
+        return [], '', file_name
+    return table.records(), excel_relational_path, file_name
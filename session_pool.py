@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+    PubMed session pool
+
+    Keeps warmed sessions, each with its csrf cookie and token and its keep-alive connections,
+    for the page workers of a job. A session is warmed once with a GET of the homepage
+    and warmed again only when PubMed rejects its token.
+"""
+import queue
+import threading
+from http_cache import new_session
+from parsers import prescan_csrf_token
+
+PUBMED_URL = "https://pubmed.ncbi.nlm.nih.gov/"
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36"
+# status of a POST whose csrf token is no longer valid
+CSRF_REJECTED = 403
+
+
+def warm_up(session, base_url=PUBMED_URL):
+    """
+    Load the homepage, which sets the csrf cookie of the session
+    :param session:
+    :param base_url:
+    :return: csrfmiddlewaretoken, None when the page has none
+    """
+    res = session.get(base_url, headers={"user-agent": USER_AGENT}, timeout=60)
+    return prescan_csrf_token(res.text)
+
+
+class PooledSession:
+    """
+    Session of the pool with the csrf token that goes with its cookie
+    """
+    __slots__ = ('session', 'csrfmiddlewaretoken')
+
+    def __init__(self, session, csrfmiddlewaretoken=None):
+        self.session = session
+        self.csrfmiddlewaretoken = csrfmiddlewaretoken
+
+
+class SessionPool:
+    """
+    Thread-safe pool of at most size sessions, created on demand.
+    acquire() blocks while all of them are in use.
+    """
+
+    def __init__(self, size, base_url=PUBMED_URL):
+        """
+        :param size: sessions in the pool, the number of pages scraped at the same time
+        :param base_url: page the csrf token is read from
+        """
+        self.size = max(1, int(size))
+        self.base_url = base_url
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Return an idle session, warming it when it has no valid token
+        :return: PooledSession
+        """
+        try:
+            pooled = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            pooled = PooledSession(new_session()) if create else self.idle.get()
+
+        if pooled.csrfmiddlewaretoken is None:
+            try:
+                pooled.csrfmiddlewaretoken = warm_up(pooled.session, self.base_url)
+            except Exception:
+                self.release(pooled)
+                raise
+            if pooled.csrfmiddlewaretoken is None:
+                print("csrfmiddlewaretoken not found while warming a session")
+        return pooled
+
+    def release(self, pooled, token=None, stale=False):
+        """
+        Give a session back to the pool
+        :param pooled: PooledSession
+        :param token: newer token read from the responses, kept for the next page
+        :param stale: True when PubMed rejected the token, the session is warmed again on its next use
+        :return: None
+        """
+        if stale:
+            pooled.csrfmiddlewaretoken = None
+        elif token:
+            pooled.csrfmiddlewaretoken = token
+        self.idle.put(pooled)
+
+    def close(self):
+        """
+        Close the idle sessions
+        :return: None
+        """
+        while True:
+            try:
+                self.idle.get_nowait().session.close()
+            except queue.Empty:
+                return
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+    SQLite database of the local caches
+
+    The article store and the url resolver cache are SQLite files shared by the threads of a job and by
+    the gunicorn workers. Every thread gets its own connection; close() closes all of them.
+"""
+import os
+import sqlite3
+import threading
+
+# SQLite limit on bound parameters per statement
+SQL_CHUNK = 500
+
+
+def chunks(items, size=SQL_CHUNK):
+    """
+    Split a list into slices small enough for one statement
+    :param items: list
+    :param size: items per slice
+    :return: generator of lists
+    """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class SQLiteDatabase:
+    """
+    One connection per thread; WAL mode lets readers run while another process writes.
+    The connections opened by every thread are tracked so close() releases them all.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+    def connection(self):
+        """
+        Return the connection of the calling thread
+        :return: sqlite3.Connection
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # used by its own thread only, but closed from the thread calling close()
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            with self.connections_lock:
+                self.connections.append(connection)
+        return connection
+
+    def close(self):
+        """
+        Close the connections of every thread, call it once the threads are done
+        :return: None
+        """
+        with self.connections_lock:
+            connections, self.connections = self.connections, []
+            self.local = threading.local()
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,33 @@
+import threading
+import ctgov_api
+from ctgov_api import ClinicalTrialsClient
+
+
+class Session:
+    def close(self):
+        pass
+
+
+def endless_pages(page_token=None):
+    number = int(page_token or 0) + 1
+    studies = [{'protocolSection': {'identificationModule': {'nctId': "NCT%08d" % (number * 10 + n)}}}
+               for n in range(2)]
+    return {'totalCount': 1000, 'studies': studies, 'nextPageToken': str(number)}
+
+
+def test_fetcher_ends_when_the_consumer_stops(monkeypatch):
+    monkeypatch.setattr(ctgov_api, 'STOP_POLL_INTERVAL', 0.05)
+    client = ClinicalTrialsClient({'conditions_disease': 'cancer'}, prefetch=1, session=Session())
+    client.fetch_page = endless_pages
+    fetcher_done = threading.Event()
+    fetch_pages = client.fetch_pages
+
+    def watched_fetch_pages(pages, stop):
+        fetch_pages(pages, stop)
+        fetcher_done.set()
+
+    client.fetch_pages = watched_fetch_pages
+    records = client.iter_records()
+    assert [next(records).nct_number for _ in range(3)] == ["NCT00000010", "NCT00000011", "NCT00000020"]
+    records.close()
+    assert fetcher_done.wait(2)
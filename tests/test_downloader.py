@@ -0,0 +1,71 @@
+import threading
+import pandas as pd
+import pytest
+from pdf_downloader import downloader
+from pdf_downloader.downloader import Downloader, HostSlots
+
+
+def csv_rows(pmids, links):
+    return pd.DataFrame({
+        'Pubmed link': ["https://pubmed.ncbi.nlm.nih.gov/%s" % pmid for pmid in pmids],
+        'Full text link': links,
+        'PDFDownloaded': pd.Series([False] * len(pmids), dtype=object),
+    })
+
+
+@pytest.fixture
+def unit(monkeypatch):
+    monkeypatch.setattr(downloader, 'RESOLVER_CACHE', False)
+    return Downloader("export.csv", concurrency=2)
+
+
+def test_rows_of_one_article_download_its_pdf_once(unit):
+    data = csv_rows([1, 2, 1, 1], ["https://www.nature.com/articles/1", "https://www.nature.com/articles/2",
+                                   "https://www.nature.com/articles/1", "https://www.nature.com/articles/1"])
+    downloads = []
+    lock = threading.Lock()
+
+    def scrape(klass, url, unique_pdf_id, **kwargs):
+        with lock:
+            downloads.append(unique_pdf_id)
+        return unique_pdf_id
+
+    unit.scrape = scrape
+    unit.download(data)
+    assert sorted(downloads) == ["1.pdf", "2.pdf"]
+    assert list(data['PDFDownloaded']) == ["1.pdf", "2.pdf", "1.pdf", "1.pdf"]
+
+
+def test_busy_host_does_not_hold_the_workers(unit):
+    unit.host_slots = HostSlots(default=1, limits={})
+    data = csv_rows([1, 2, 3], ["https://www.nature.com/articles/1", "https://www.nature.com/articles/2",
+                                "https://www.bmj.com/content/3"])
+    other_host_done = threading.Event()
+    seen = []
+
+    def scrape(klass, url, unique_pdf_id, **kwargs):
+        if "nature.com" in url:
+            # the first nature article only ends once the bmj one ran next to it
+            seen.append(other_host_done.wait(5))
+        else:
+            other_host_done.set()
+        return unique_pdf_id
+
+    unit.scrape = scrape
+    unit.download(data)
+    assert seen == [True, True]
+    assert list(data['PDFDownloaded']) == ["1.pdf", "2.pdf", "3.pdf"]
+
+
+def test_next_url_is_tried_after_a_failure(unit):
+    data = csv_rows([1], ["https://www.nature.com/articles/1,https://www.bmj.com/content/1"])
+    tried = []
+
+    def scrape(klass, url, unique_pdf_id, **kwargs):
+        tried.append(klass.__name__)
+        return unique_pdf_id if klass.__name__ == "BMJ" else False
+
+    unit.scrape = scrape
+    unit.download(data)
+    assert tried == ["Nature", "BMJ"]
+    assert list(data['PDFDownloaded']) == ["1.pdf"]
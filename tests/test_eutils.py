@@ -0,0 +1,98 @@
+"""
+    EUtilsUnit against a local stand-in of the E-utilities server serving recorded esearch/efetch responses
+
+    The records are the articles of pubmed_more_page.html, so the rows can be compared with the HTML scraper's.
+"""
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+import pytest
+from http_cache import CachedSession
+from eutils import EUtilsUnit
+from parsers import SoupParser
+from test_parsers import read_fixture, module_unit, FIXTURES
+
+RECORDED = {
+    '/esearch.fcgi': ('eutils_esearch.json', 'application/json'),
+    '/efetch.fcgi': ('eutils_efetch.xml', 'text/xml; charset=UTF-8'),
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.server.requests.append((self.path, parse_qs(self.rfile.read(length).decode('utf-8'))))
+        if self.path not in RECORDED:
+            self.send_error(404)
+            return
+        name, content_type = RECORDED[self.path]
+        with open(os.path.join(FIXTURES, name), 'rb') as fixture:
+            body = fixture.read()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def eutils_unit(server):
+    unit = EUtilsUnit("covid pregnancy", session=CachedSession(mode='off'))
+    unit.base_url = "http://127.0.0.1:%s/" % server.server_address[1]
+    return unit
+
+
+def html_rows():
+    parser = SoupParser()
+    unit = module_unit(parser)
+    articles = parser.articles(parser.parse(read_fixture('pubmed_more_page.html'), articles_only=True))
+    return [unit.build_row(article) for article in articles]
+
+
+def test_rows_match_the_html_scraper(server):
+    unit = eutils_unit(server)
+    unit.do_scraping()
+
+    assert unit.total_count == 3
+    assert [path for path, form in server.requests] == ['/esearch.fcgi', '/efetch.fcgi']
+    search_form, fetch_form = [form for path, form in server.requests]
+    assert search_form['term'] == ["covid pregnancy"]
+    assert search_form['usehistory'] == ['y']
+    assert fetch_form['WebEnv'] == ["MCID_5f1a2b3c4d5e6f7a8b9c0d1e"]
+    assert fetch_form['query_key'] == ['1']
+    assert fetch_form['retstart'] == ['0']
+
+    expected_rows = html_rows()
+    assert [list(row) for row in unit.results_dict] == [list(row) for row in expected_rows]
+    for row, expected in zip(unit.results_dict, expected_rows):
+        # the citation line of the page keeps the punctuation around the DOI
+        assert row['doi'] == expected['doi'].strip().strip('.')
+        # the HTML scraper keeps only the last section of a structured abstract
+        assert row['abstract'].split("\n\n")[-1] == expected['abstract']
+        for field in ('doi', 'abstract'):
+            del row[field], expected[field]
+        assert row == expected
+
+
+def test_search_ids_in_relevance_order(server):
+    unit = eutils_unit(server)
+    assert unit.search_ids() == ["32512345", "31000001", "30000002"]
+    assert unit.total_count == 3
+    path, form = server.requests[0]
+    assert form['sort'] == ['relevance']
+    assert 'usehistory' not in form
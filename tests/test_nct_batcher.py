@@ -0,0 +1,20 @@
+from nct_record import NCTRecord
+from nct_batcher import NCTBatcher
+
+
+def records(count):
+    return [NCTRecord("NCT%08d" % number, "", "", "") for number in range(count)]
+
+
+def test_get_batch_fits_the_url():
+    batcher = NCTBatcher(size=2000, max_size=2000)
+    pending = records(2000)
+    size = batcher.batch_size(pending, get=True)
+    assert batcher.fits_get(batcher.query(pending[:size]))
+    assert not batcher.fits_get(batcher.query(pending[:size + 1]))
+
+
+def test_batch_size_without_get_limit():
+    batcher = NCTBatcher(size=2000, max_size=2000)
+    assert batcher.batch_size(records(2000)) == 2000
+    assert batcher.batch_size(records(5), get=True) == 5
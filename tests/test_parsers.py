@@ -0,0 +1,229 @@
+"""
+    Parity of the parser backends with the BeautifulSoup extractors they replaced
+
+    The baseline_* functions below are the extractors scrap_module and scrap_pubmed used before the
+    parser interface, kept here as the reference the rows of both backends are compared to.
+"""
+import os
+import re
+import pytest
+from bs4 import BeautifulSoup
+import scrap_module
+import scrap_pubmed
+from parsers import SoupParser, LxmlParser
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as fixture:
+        return fixture.read()
+
+
+def get_text(soup, ele, condition):
+    try:
+        return soup.find(ele, condition).text.strip()
+    except Exception:
+        pass
+    return ""
+
+
+def ajdust_abstract(abstract):
+    slices = abstract.split('\n')
+    full_text = ""
+    for i in range(len(slices) - 2):
+        if slices[i + 1].strip() == '' and slices[i + 2].strip() == '':
+            full_text += slices[i].strip() + '\n\n'
+    full_text += slices[len(slices) - 1].strip()
+    return full_text
+
+
+def get_affiliations(article):
+    affiliations_div = article.find('div', {'class': 'affiliations'})
+    affiliation = ""
+    author_email = []
+    if affiliations_div:
+        first = True
+        for li in affiliations_div.find_all('li'):
+            sup_key = get_text(li, 'sup', {})
+            text = li.text.strip()[len(sup_key):]
+            if first:
+                affiliation = text
+                first = False
+
+            lst = re.findall(r'\S+@\S+', text)
+            if len(lst) > 0:
+                for email in lst:
+                    author_email.append(email.strip().strip(",").strip(".").strip(";"))
+                    text = text.replace(email, '').strip()
+
+                affiliation = text.replace("Electronic address:", "").replace("Electronic address", '')\
+                    .strip().strip(",").strip(".").strip(";")
+
+    return affiliation, author_email
+
+
+def get_full_text_links(article):
+    full_text_links = []
+    full_text_links_list_div = article.find('div', {'class': 'full-text-links-list'})
+    if full_text_links_list_div:
+        for tag in full_text_links_list_div.find_all('a'):
+            full_text_links.append(tag.attrs['href'])
+    return full_text_links
+
+
+def get_keywords(section):
+    keywords = []
+    if section:
+        keyword_list = section.find('ul', {'class': 'keywords-list'})
+        if keyword_list:
+            for button in keyword_list.find_all('button', {'class': 'keyword-actions-trigger'}):
+                keywords.append(button.text.strip())
+    return keywords
+
+
+def get_mesh_terms(article):
+    return get_keywords(article.find('div', {'class': 'mesh-terms keywords-section'}))
+
+
+def get_publication_types(article):
+    pub_types_div = article.select('div[class*="publication-types keywords-section"]')
+    return get_keywords(pub_types_div[0] if pub_types_div else None)
+
+
+def baseline_module_row(article):
+    """
+    Row of scrap_module: header and authors from div.full-view
+    """
+    full_view = article.find('div', {'class': 'full-view'})
+    authors_list = [get_text(span, 'a', {'class': 'full-name'})
+                    for span in full_view.find_all('span', {'class': 'authors-list-item'})]
+    abstract = get_text(article, 'div', {'class': 'abstract-content selected'}).replace('\n\n', '')
+    affiliation, author_email = get_affiliations(article)
+    return [
+        "https://pubmed.ncbi.nlm.nih.gov/%s" % get_text(full_view, 'strong', {'class': 'current-id'}),
+        get_text(full_view, 'h1', {'class': 'heading-title'}),
+        get_text(full_view, 'span', {"class": "cit"}).split(";")[0],
+        ajdust_abstract(abstract),
+        ", \n".join(authors_list),
+        affiliation,
+        ", \n".join(author_email),
+        get_text(full_view, 'span', {'class': 'identifier pmc'}).strip("PMCID:").strip(),
+        get_text(full_view, 'span', {'class': 'citation-doi'}).strip('doi:'),
+        ",\n".join(get_full_text_links(article)),
+        ", \n".join(get_mesh_terms(article)),
+        ", \n".join(get_publication_types(article)),
+    ]
+
+
+def baseline_pubmed_row(article):
+    """
+    Article columns of scrap_pubmed: header and authors from the whole article,
+    an empty PMCID column takes the PMID
+    """
+    full_view = article
+    authors_list = [get_text(span, 'a', {'class': 'full-name'})
+                    for span in full_view.find_all('span', {'class': 'authors-list-item'})]
+    abstract = get_text(article, 'div', {'class': 'abstract-content selected'}).replace('\n', ' ')
+    affiliation, author_email = get_affiliations(article)
+    pmcid = get_text(full_view, 'span', {'class': 'identifier pmc'}).strip("PMCID:").strip()
+    if pmcid == '':
+        pmcid = get_text(full_view, 'span', {'class': 'identifier pubmed'}).strip("PMCID:").strip()
+    return [
+        "https://pubmed.ncbi.nlm.nih.gov/%s" % get_text(full_view, 'strong', {'class': 'current-id'}),
+        get_text(full_view, 'h1', {'class': 'heading-title'}),
+        get_text(full_view, 'span', {"class": "cit"}).split(";")[0],
+        ajdust_abstract(abstract),
+        " | ".join(authors_list),
+        affiliation,
+        "|".join(author_email),
+        pmcid,
+        get_text(full_view, 'span', {'class': 'citation-doi'}).strip('doi:'),
+        " | ".join(get_full_text_links(article)),
+        " | ".join(get_mesh_terms(article)),
+        " | ".join(get_publication_types(article)),
+    ]
+
+
+def baseline_articles(markup):
+    return BeautifulSoup(markup, 'html.parser').find_all('div', {"class": "results-article"})
+
+
+def module_unit(parser):
+    unit = scrap_module.ScrapingUnit("keyword", session=object())
+    unit.parser = parser
+    return unit
+
+
+def pubmed_unit(parser):
+    unit = scrap_pubmed.ScrapingUnit(session=object())
+    unit.parser = parser
+    return unit
+
+
+PARSERS = [SoupParser, LxmlParser]
+
+
+@pytest.mark.parametrize('parser_class', PARSERS)
+def test_results_page_scrap_module_rows(parser_class):
+    markup = read_fixture('pubmed_more_page.html')
+    parser = parser_class()
+    unit = module_unit(parser)
+    rows = [list(unit.build_row(article).values()) for article in parser.articles(parser.parse(markup, articles_only=True))]
+    assert rows == [baseline_module_row(article) for article in baseline_articles(markup)]
+    assert len(rows) == 3
+
+
+@pytest.mark.parametrize('parser_class', PARSERS)
+def test_results_page_scrap_pubmed_rows(parser_class):
+    markup = read_fixture('pubmed_more_page.html')
+    parser = parser_class()
+    unit = pubmed_unit(parser)
+    records = [unit.article_record(article, unit.cited_trials(article))
+               for article in parser.articles(parser.parse(markup, articles_only=True))]
+    assert [record['row'] for record in records] == [baseline_pubmed_row(article) for article in baseline_articles(markup)]
+    assert records[0]['row'][4] == "Jane Doe | John Roé | Extra Person"
+    assert records[0]['nct_ids'] == ["NCT01234567", "NCT07654321"]
+    assert records[1]['row'][7] == "31000001"
+
+
+@pytest.mark.parametrize('parser_class', PARSERS)
+def test_single_article_page_rows(parser_class):
+    markup = read_fixture('pubmed_single_article.html')
+    parser = parser_class()
+    soup = BeautifulSoup(markup, 'html.parser')
+
+    assert list(module_unit(parser).build_row(parser.parse(markup)).values()) == baseline_module_row(soup)
+    record = pubmed_unit(parser).article_record(parser.parse(markup), [])
+    assert record['row'] == baseline_pubmed_row(soup)
+    assert record['pmid'] == "29000003"
+
+
+@pytest.mark.parametrize('markup, total_count', [
+    ('<div class="results-amount">\n  <span class="value">1,234</span>\n  results\n</div>', 1234),
+    ('<div class="results-amount"><em class="altered-search-explanation">No results were found.</em></div>', 0),
+    (read_fixture('pubmed_single_article.html'), 1),
+])
+def test_scrap_pubmed_total_count(markup, total_count):
+    unit = scrap_pubmed.ScrapingUnit(session=object())
+    unit.get_total_count(markup)
+    assert unit.total_count == total_count
+
+
+def test_scrap_module_does_not_store_rows_without_pmid():
+    class Store:
+        def __init__(self):
+            self.entries = {}
+
+        def put_many(self, entries):
+            self.entries.update(entries)
+
+    parser = SoupParser()
+    unit = module_unit(parser)
+    unit.store = Store()
+    articles = parser.articles(parser.parse(read_fixture('pubmed_more_page.html'), articles_only=True))
+    rows = [unit.build_row(article) for article in articles]
+    rows.append(dict(rows[0], **{"Pubmed link": "https://pubmed.ncbi.nlm.nih.gov/"}))
+    unit.emit(rows)
+    assert sorted(unit.store.entries) == ["30000002", "31000001", "32512345"]
+    assert len(unit.results_dict) == 4
@@ -0,0 +1,62 @@
+import queue
+import pytest
+import scrap_pubmed
+from nct_record import NCTRecord
+from scheduler import WorkQueue, WorkersStopped
+from scrap_pubmed import BatchFeeder
+
+
+def records(count):
+    return [NCTRecord("NCT%08d" % number, "", "", "") for number in range(count)]
+
+
+def failing_numbers(count):
+    yield from records(count)
+    raise RuntimeError("page 3 failed")
+
+
+def queued_tasks(work_queue):
+    tasks = []
+    while True:
+        task = work_queue.queue.get_nowait()
+        work_queue.queue.task_done()
+        if task is None:
+            return tasks
+        tasks.append(task)
+
+
+def test_feeder_keeps_the_count_and_the_error(monkeypatch):
+    monkeypatch.setattr(scrap_pubmed, 'NCT_COUNT', 2)
+    work_queue = WorkQueue(queue.Queue(), workers=1)
+    work_queue.close = lambda alive=None: work_queue.queue.put(None)
+    feeder = BatchFeeder(failing_numbers(5), work_queue)
+    feeder.run()
+    assert feeder.count == 5
+    assert isinstance(feeder.error, RuntimeError)
+    assert [len(task.payload) for task in queued_tasks(work_queue)] == [2, 2, 1]
+
+
+def test_feeder_without_error(monkeypatch):
+    monkeypatch.setattr(scrap_pubmed, 'NCT_COUNT', 2)
+    work_queue = WorkQueue(queue.Queue(), workers=1)
+    work_queue.close = lambda alive=None: work_queue.queue.put(None)
+    feeder = BatchFeeder(iter(records(3)), work_queue)
+    feeder.run()
+    assert (feeder.count, feeder.error) == (3, None)
+    assert [len(task.payload) for task in queued_tasks(work_queue)] == [2, 1]
+
+
+class DeadWorker:
+    def is_alive(self):
+        return False
+
+
+def test_feeder_stops_waiting_for_dead_workers(monkeypatch):
+    monkeypatch.setattr(scrap_pubmed, 'NCT_COUNT', 2)
+    work_queue = WorkQueue(queue.Queue(maxsize=1), workers=2)
+    numbers = iter(records(6))
+    feeder = BatchFeeder(numbers, work_queue, workers=[DeadWorker(), DeadWorker()])
+    feeder.run()
+    assert isinstance(feeder.error, WorkersStopped)
+    assert feeder.count == 4
+    assert work_queue.queue.qsize() == 1
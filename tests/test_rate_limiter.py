@@ -0,0 +1,120 @@
+import time
+import requests
+from requests.adapters import BaseAdapter
+import rate_limiter
+from rate_limiter import HostLimiter, ThrottledSession
+
+
+def test_window_grows_while_responses_are_fast():
+    limiter = HostLimiter(rate=100, max_concurrency=6)
+    assert limiter.window == 4
+    for _ in range(4):
+        limiter.acquire()
+        limiter.release(latency=0.1)
+    # one more request after a round trip of the whole window
+    assert 4.9 < limiter.window < 5
+    assert limiter.in_flight == 0
+
+
+def test_slow_response_does_not_grow_the_window():
+    limiter = HostLimiter(rate=100)
+    limiter.acquire()
+    limiter.release(latency=0.1)
+    window = limiter.window
+    limiter.acquire()
+    limiter.release(latency=1.0)
+    assert limiter.window == window
+
+
+def test_throttle_halves_window_and_rate():
+    limiter = HostLimiter(rate=8)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.window == 2
+    assert limiter.rate == 4
+    for _ in range(10):
+        limiter.in_flight += 1
+        limiter.release(throttled=True)
+    assert limiter.window == 1
+    assert limiter.rate == 0.5
+
+
+def test_fast_responses_restore_the_rate():
+    limiter = HostLimiter(rate=10)
+    limiter.rate = 5
+    for _ in range(10):
+        limiter.in_flight += 1
+        limiter.release(latency=0.1)
+    assert limiter.rate == 10
+
+
+def test_token_bucket_paces_the_requests():
+    limiter = HostLimiter(rate=20)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.acquire()
+        limiter.release(latency=0.001)
+    # the first token is there already, the next four take 1/20 s each
+    assert time.monotonic() - start >= 0.18
+
+
+def test_retry_after_blocks_the_host():
+    limiter = HostLimiter(rate=100)
+    limiter.acquire()
+    limiter.release(throttled=True, pause=0.3)
+    start = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - start >= 0.25
+
+
+class Adapter(BaseAdapter):
+    """
+    Answers with the given status codes in turn
+    """
+
+    def __init__(self, statuses, headers=None):
+        super(Adapter, self).__init__()
+        self.statuses = list(statuses)
+        self.headers = headers or {}
+        self.calls = 0
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = self.statuses[min(self.calls, len(self.statuses) - 1)]
+        response.headers.update(self.headers)
+        response.url = request.url
+        response.request = request
+        response._content = b""
+        self.calls += 1
+        return response
+
+    def close(self):
+        pass
+
+
+def throttled_session(monkeypatch, adapter):
+    monkeypatch.setattr(rate_limiter, 'limiters', {})
+    monkeypatch.setattr(rate_limiter, 'BACKOFF', 0.01)
+    session = ThrottledSession()
+    session.mount('http://', adapter)
+    return session
+
+
+def test_throttled_request_is_retried(monkeypatch):
+    adapter = Adapter([503, 429, 200], headers={'Retry-After': '0'})
+    session = throttled_session(monkeypatch, adapter)
+    assert session.get("http://host.test/page").status_code == 200
+    assert adapter.calls == 3
+    limiter = rate_limiter.limiters['host.test']
+    # halved twice, then grown by the successful request
+    assert limiter.window == 2
+    assert limiter.in_flight == 0
+
+
+def test_last_throttled_response_is_returned(monkeypatch):
+    monkeypatch.setattr(rate_limiter, 'RETRIES', 2)
+    adapter = Adapter([503])
+    session = throttled_session(monkeypatch, adapter)
+    assert session.get("http://host.test/page").status_code == 503
+    assert adapter.calls == 2
+    assert rate_limiter.limiters['host.test'].in_flight == 0
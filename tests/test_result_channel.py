@@ -0,0 +1,25 @@
+from result_channel import ResultTable
+from article_cache import pmid_key
+
+FIELDS = ["Pubmed link", "heading_title", "nct_number"]
+HEADER = ["Pubmed link", "Title", "NCT number"]
+
+
+def test_rows_are_deduped_on_the_pmid():
+    table = ResultTable(HEADER, FIELDS, unique="Pubmed link", unique_key=pmid_key)
+    table.extend([("https://pubmed.ncbi.nlm.nih.gov/32512345", "first", ""),
+                  ("https://pubmed.ncbi.nlm.nih.gov/32512345/", "same article", "")])
+    table.extend([("https://pubmed.ncbi.nlm.nih.gov/32512345", "next batch", "")])
+    assert [row["heading_title"] for row in table.records()] == ["first"]
+
+
+def test_rows_without_pmid_are_all_kept():
+    table = ResultTable(HEADER, FIELDS, unique=("Pubmed link", "nct_number"), unique_key=pmid_key)
+    table.extend([("https://pubmed.ncbi.nlm.nih.gov/", "no pmid", "NCT01234567"),
+                  ("https://pubmed.ncbi.nlm.nih.gov/", "another one", "NCT01234567"),
+                  ("https://pubmed.ncbi.nlm.nih.gov/31000001", "cites two trials", "NCT01234567"),
+                  ("https://pubmed.ncbi.nlm.nih.gov/31000001", "cites two trials", "NCT07654321"),
+                  ("https://pubmed.ncbi.nlm.nih.gov/31000001", "cites two trials", "NCT07654321")])
+    assert len(table) == 4
+    assert [row["nct_number"] for row in table.records()] == ["NCT01234567", "NCT01234567",
+                                                              "NCT01234567", "NCT07654321"]
@@ -0,0 +1,99 @@
+import queue
+import threading
+import pytest
+import scheduler
+from scheduler import WorkQueue, WorkersStopped, backoff_delay
+
+
+def test_backoff_delay_doubles_up_to_the_cap():
+    assert [backoff_delay(attempt, 2.0) for attempt in (1, 2, 3)] == [2.0, 4.0, 8.0]
+    assert backoff_delay(20, 2.0) == scheduler.MAX_BACKOFF
+
+
+def run_workers(work_queue, handle, count):
+    """
+    Start count threads that pull tasks and pass them to handle(payload), which returns ok and the payload to retry
+    """
+    def run():
+        worker = work_queue.worker()
+        while True:
+            task = worker.get()
+            if task is None:
+                return
+            ok, payload = handle(task.payload)
+            worker.finish(task, ok, payload)
+
+    threads = [threading.Thread(target=run, daemon=True) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def test_failed_tasks_are_retried_before_close_returns():
+    runs = {}
+    lock = threading.Lock()
+
+    def handle(payload):
+        with lock:
+            runs[payload] = runs.get(payload, 0) + 1
+            # every odd task fails on its first run
+            return payload % 2 == 0 or runs[payload] > 1, None
+
+    work_queue = WorkQueue(queue.Queue(maxsize=2), workers=3, backoff=0.01)
+    threads = run_workers(work_queue, handle, 3)
+    for payload in range(10):
+        work_queue.put(payload)
+    work_queue.close()
+    for thread in threads:
+        thread.join(5)
+        assert not thread.is_alive()
+    assert runs == dict((payload, 1 if payload % 2 == 0 else 2) for payload in range(10))
+
+
+def test_part_of_the_payload_is_retried():
+    runs = []
+
+    def handle(payload):
+        runs.append(payload)
+        # the first id of a batch fails once, only the rest of the batch runs again
+        return len(runs) > 1, payload[1:]
+
+    work_queue = WorkQueue(workers=1, backoff=0.01)
+    threads = run_workers(work_queue, handle, 1)
+    work_queue.put(["a", "b", "c"])
+    work_queue.close()
+    threads[0].join(5)
+    assert runs == [["a", "b", "c"], ["b", "c"]]
+
+
+def test_task_is_given_up_after_its_attempts():
+    runs = []
+
+    def handle(payload):
+        runs.append(payload)
+        return False, None
+
+    work_queue = WorkQueue(workers=2, max_attempts=3, backoff=0.01)
+    threads = run_workers(work_queue, handle, 2)
+    work_queue.put("page")
+    work_queue.close()
+    for thread in threads:
+        thread.join(5)
+        assert not thread.is_alive()
+    assert runs == ["page"] * 3
+
+
+def test_close_ends_when_the_workers_stopped(monkeypatch):
+    monkeypatch.setattr(scheduler, 'POLL_INTERVAL', 0.05)
+    work_queue = WorkQueue(queue.Queue(maxsize=1), workers=1)
+    work_queue.put("page")
+    with pytest.raises(WorkersStopped):
+        work_queue.close(alive=lambda: False)
+
+
+def test_put_ends_when_the_workers_stopped(monkeypatch):
+    monkeypatch.setattr(scheduler, 'POLL_INTERVAL', 0.05)
+    work_queue = WorkQueue(queue.Queue(maxsize=1), workers=1)
+    work_queue.put("page", alive=lambda: True)
+    with pytest.raises(WorkersStopped):
+        work_queue.put("next page", alive=lambda: False)
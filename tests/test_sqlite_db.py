@@ -0,0 +1,35 @@
+import sqlite3
+import threading
+import pytest
+from article_cache import ArticleStore
+from pdf_downloader.resolver_cache import ResolverCache
+
+
+def test_close_closes_the_connections_of_every_thread(tmp_path):
+    cache = ResolverCache(path=str(tmp_path / "resolver.db"))
+    cache.put_many({"https://doi.org/10.1000/1": "https://example.org/1"})
+
+    def lookup():
+        assert cache.get_many(["https://doi.org/10.1000/1"]) == {"https://doi.org/10.1000/1": "https://example.org/1"}
+
+    threads = [threading.Thread(target=lookup) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    connections = list(cache.connections)
+    assert len(connections) == 5
+
+    cache.close()
+    assert cache.connections == []
+    for connection in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            connection.execute("SELECT 1")
+
+
+def test_store_reopens_after_close(tmp_path):
+    store = ArticleStore("test", path=str(tmp_path / "articles.db"))
+    store.put_many({"1": ["row"]})
+    store.close()
+    assert store.get_many(["1", "2"]) == {"1": ["row"]}
+    store.close()
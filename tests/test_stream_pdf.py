@@ -0,0 +1,136 @@
+import os
+import pytest
+import requests
+from pdf_downloader import helpers
+from pdf_downloader.helpers import stream_pdf
+
+PDF_A = b"%PDF-1.4 A " + b"a" * 5000
+PDF_B = b"%PDF-1.4 B " + b"b" * 7000
+
+
+class Response:
+    def __init__(self, status_code, body, headers, fail_after=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers
+        self.fail_after = fail_after
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(self.status_code)
+
+    def iter_content(self, size):
+        for start in range(0, len(self.body), 1000):
+            if self.fail_after is not None and start >= self.fail_after:
+                raise requests.ConnectionError("connection reset")
+            yield self.body[start:start + 1000]
+
+
+class Server:
+    """
+    Serves one file per url, honouring Range and If-Range; the first transfer of a url may break
+    """
+
+    def __init__(self, files, etags=None, fail_after=None):
+        self.files = files
+        self.etags = etags or {}
+        self.fail_after = fail_after
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        headers = headers or {}
+        self.requests.append((url, dict(headers)))
+        body = self.files[url]
+        base = {"Content-Type": "application/pdf"}
+        etag = self.etags.get(url)
+        if etag:
+            base["ETag"] = etag
+        range_header = headers.get("Range")
+        if range_header and headers.get("If-Range", etag) == etag:
+            start = int(range_header[len("bytes="):-1])
+            return Response(206, body[start:], dict(base, **{
+                "Content-Range": "bytes %s-%s/%s" % (start, len(body) - 1, len(body)),
+                "Content-Length": str(len(body) - start)}))
+        fail_after, self.fail_after = self.fail_after, None
+        return Response(200, body, dict(base, **{"Content-Length": str(len(body))}), fail_after)
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(helpers.time, "sleep", lambda seconds: None)
+
+
+def test_interrupted_transfer_is_resumed(tmp_path):
+    path = str(tmp_path / "1.pdf")
+    server = Server({"a": PDF_A}, etags={"a": '"v1"'}, fail_after=2000)
+    assert stream_pdf(server, "a", path) == path
+    with open(path, "rb") as pdf:
+        assert pdf.read() == PDF_A
+    assert server.requests[1][1] == {"Range": "bytes=2000-", "If-Range": '"v1"'}
+    assert os.listdir(str(tmp_path)) == ["1.pdf"]
+
+
+def test_failed_download_leaves_nothing_to_resume(tmp_path):
+    path = str(tmp_path / "1.pdf")
+    failing = Server({"a": PDF_A}, etags={"a": '"v1"'}, fail_after=2000)
+    with pytest.raises(requests.ConnectionError):
+        stream_pdf(failing, "a", path, attempts=1)
+    assert os.listdir(str(tmp_path)) == []
+
+    # another url for the same article starts from the first byte
+    server = Server({"b": PDF_B}, etags={"b": '"v1"'})
+    stream_pdf(server, "b", path)
+    with open(path, "rb") as pdf:
+        assert pdf.read() == PDF_B
+    assert server.requests == [("b", {})]
+
+
+def test_changed_file_restarts_from_zero(tmp_path):
+    path = str(tmp_path / "1.pdf")
+    server = Server({"a": PDF_A}, etags={"a": '"v1"'}, fail_after=2000)
+    get = server.get
+
+    def changing_get(url, headers=None, **kwargs):
+        if headers:
+            # the file changed between the two transfers, If-Range no longer matches
+            server.files[url] = PDF_B
+            server.etags[url] = '"v2"'
+        return get(url, headers, **kwargs)
+
+    server.get = changing_get
+    stream_pdf(server, "a", path)
+    with open(path, "rb") as pdf:
+        assert pdf.read() == PDF_B
+
+
+def test_range_of_another_length_restarts_from_zero(tmp_path):
+    path = str(tmp_path / "1.pdf")
+    server = Server({"a": PDF_A}, etags={"a": '"v1"'}, fail_after=2000)
+    get = server.get
+
+    def other_length_get(url, headers=None, **kwargs):
+        res = get(url, headers, **kwargs)
+        if res.status_code == 206:
+            res.headers["Content-Range"] = "bytes 2000-8999/9000"
+        return res
+
+    server.get = other_length_get
+    stream_pdf(server, "a", path)
+    with open(path, "rb") as pdf:
+        assert pdf.read() == PDF_A
+    assert server.requests[-1] == ("a", {})
+
+
+def test_no_validator_restarts_from_zero(tmp_path):
+    path = str(tmp_path / "1.pdf")
+    server = Server({"a": PDF_A}, fail_after=2000)
+    stream_pdf(server, "a", path)
+    with open(path, "rb") as pdf:
+        assert pdf.read() == PDF_A
+    assert [headers for url, headers in server.requests] == [{}, {}]
@@ -0,0 +1,45 @@
+from pdf_downloader.downloader import url_resolver
+
+DOI = "https://doi.org/10.1000/example"
+
+
+class Response:
+    def __init__(self, status_code, location=None):
+        self.status_code = status_code
+        self.headers = {'Location': location} if location else {}
+
+
+class Session:
+    def __init__(self, response):
+        self.response = response
+
+    def head(self, url):
+        return self.response
+
+
+class Cache:
+    def __init__(self):
+        self.entries = {}
+
+    def put_many(self, locations):
+        self.entries.update(locations)
+
+
+def resolve(response):
+    resolved, cache = {}, Cache()
+    location = url_resolver(DOI, Session(response), resolved, cache)
+    return location, resolved, cache.entries
+
+
+def test_redirect_is_cached():
+    assert resolve(Response(302, "https://example.org/article")) == (
+        "https://example.org/article", {DOI: "https://example.org/article"}, {DOI: "https://example.org/article"})
+
+
+def test_success_without_redirect_is_a_negative_entry():
+    assert resolve(Response(200)) == (False, {DOI: False}, {DOI: False})
+
+
+def test_error_status_is_not_cached():
+    assert resolve(Response(404)) == (False, {}, {})
+    assert resolve(Response(503)) == (False, {}, {})
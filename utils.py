@@ -1,8 +1,6 @@
 import time
 from functools import wraps
-import csv
-from pandas.io.excel import ExcelWriter
-import pandas
+import re
 
 
 def retry(ExceptionToCheck, tries=4, delay=3, backoff=2, logger=None):
@@ -30,55 +28,27 @@ def retry(ExceptionToCheck, tries=4, delay=3, backoff=2, logger=None):
     return deco_retry
 
 
-def write_csv(csv_file, data):
+def split_affiliations(texts):
     """
-    Write lines to csv named as filename
+    Return the affiliation and the author emails found in affiliation texts
+    :param texts: affiliation texts in page order
+    :return: string, array
     """
-    with open(csv_file, 'w', encoding='utf-8', newline='') as writeFile:
-        writer = csv.writer(writeFile, delimiter=',')
-        writer.writerows(data)
-
-
-def excel_out(csv_file, excel_file):
-    # convert csv file to excel format
-    with ExcelWriter(excel_file) as ew:
-        df = pandas.read_csv(csv_file)
-        df.to_excel(ew, sheet_name="sheet1", index=False)
-
-
-def get_thread_range(thread_count, total_count):
-    """
-    Divide total units into array of threads
-    @return: array
-    """
-    ranges = []
-    for i in range(thread_count):
-        ranges.append([])
-    count = 0
-    while count < total_count:
-        for i in range(thread_count):
-            count += 1
-            ranges[i].append(count-1)
-            if count == total_count:
-                break
-
-    return ranges
-
-
-def get_thread_range_pumbed(thread_count, total_count):
-    """
-    Divide total units into array of threads
-    @return: array
-    """
-    ranges = []
-    for i in range(thread_count):
-        ranges.append([])
-    count = 1
-    while count < total_count:
-        for i in range(thread_count):
-            count += 1
-            ranges[i].append(count)
-            if count == total_count:
-                break
-
-    return ranges
+    affiliation = ""
+    author_email = []
+    first = True
+    for text in texts:
+        if first:
+            affiliation = text
+            first = False
+
+        lst = re.findall(r'\S+@\S+', text)
+        if len(lst) > 0:
+            for email in lst:
+                author_email.append(email.strip().strip(",").strip(".").strip(";"))
+                text = text.replace(email, '').strip()
+
+            affiliation = text.replace("Electronic address:", "").replace("Electronic address", '')\
+                .strip().strip(",").strip(".").strip(";")
+
+    return affiliation, author_email
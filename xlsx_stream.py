@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+    Streaming Excel writer
+
+    Appends the rows of a job to an openpyxl write-only workbook as the batches arrive,
+    so the export does not read the csv back into a DataFrame.
+    Cells longer than Excel allows are truncated and a full sheet rolls over to the next one.
+"""
+import os
+from openpyxl import Workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+# Excel limits
+MAX_CELL_LENGTH = 32767
+MAX_ROWS = 1048576
+SHEET_NAME = "sheet%s"
+PART_SUFFIX = '.part'
+
+
+def excel_value(value):
+    """
+    Return a value Excel accepts: no control characters, at most MAX_CELL_LENGTH characters
+    :param value:
+    :return: string, None for an empty cell
+    """
+    if value is None or value == '':
+        return None
+    if not isinstance(value, str):
+        return value
+    value = ILLEGAL_CHARACTERS_RE.sub('', value)
+    if len(value) > MAX_CELL_LENGTH:
+        value = value[:MAX_CELL_LENGTH]
+    return value
+
+
+class XLSXStream:
+    """
+    Excel file written row batch by row batch, every sheet starts with the header
+    """
+
+    def __init__(self, path, header, max_rows=MAX_ROWS):
+        """
+        :param path: final path of the xlsx file
+        :param header: header line of every sheet
+        :param max_rows: rows of a sheet, header included
+        """
+        self.path = path
+        self.header = header
+        self.max_rows = max_rows
+        self.count = 0
+        self.workbook = Workbook(write_only=True)
+        self.sheets = 0
+        self.add_sheet()
+
+    def add_sheet(self):
+        """
+        Start the next sheet
+        :return: None
+        """
+        self.sheets += 1
+        self.sheet = self.workbook.create_sheet(SHEET_NAME % self.sheets)
+        self.sheet.append(self.header)
+        self.sheet_rows = 1
+
+    def write_rows(self, rows):
+        """
+        Append a batch of rows
+        :param rows: list of tuples in header order
+        :return: None
+        """
+        for row in rows:
+            if self.sheet_rows >= self.max_rows:
+                self.add_sheet()
+            self.sheet.append([excel_value(value) for value in row])
+            self.sheet_rows += 1
+        self.count += len(rows)
+
+    def close(self):
+        """
+        Save the workbook and move it to its final name
+        :return: path of the xlsx file
+        """
+        part_path = self.path + PART_SUFFIX
+        self.workbook.save(part_path)
+        os.replace(part_path, self.path)
+        return self.path
+
+    def discard(self):
+        """
+        Drop the workbook, for a job that ends without result
+        :return: None
+        """
+        # saving is the only way to release the temporary files of the write-only sheets
+        part_path = self.path + PART_SUFFIX
+        self.workbook.save(part_path)
+        os.remove(part_path)